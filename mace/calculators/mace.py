@@ -43,6 +43,9 @@ class MACECalculator(Calculator):
         charges_key: str, Array field of atoms object where atomic charges are stored
         model_type: str, type of model to load
                     Options: [MACE, DipoleMACE, EnergyDipoleMACE]
+        skin: float, Verlet skin (in Angstroms). If > 0, the neighbour list is built with
+                r_max + skin and reused until an atom has moved by more than skin / 2
+                or the cell changed
 
     Dipoles are returned in units of Debye
     """
@@ -57,6 +60,7 @@ class MACECalculator(Calculator):
         charges_key="Qs",
         model_type="MACE",
         compile_mode=None,
+        skin: float = 0.0,
         **kwargs,
     ):
         Calculator.__init__(self, **kwargs)
@@ -144,6 +148,9 @@ class MACECalculator(Calculator):
             [int(z) for z in self.models[0].atomic_numbers]
         )
         self.charges_key = charges_key
+        self.verlet_neighborhood = (
+            data.VerletNeighborhood(cutoff=self.r_max, skin=skin) if skin > 0 else None
+        )
         try:
             self.heads = self.models[0].heads
         except:
@@ -217,6 +224,11 @@ class MACECalculator(Calculator):
 
         # prepare data
         config = data.config_from_atoms(atoms, charges_key=self.charges_key)
+        neighborhood = None
+        if self.verlet_neighborhood is not None:
+            neighborhood = self.verlet_neighborhood.get_neighborhood(
+                positions=config.positions, pbc=config.pbc, cell=config.cell
+            )
         data_loader = torch_geometric.dataloader.DataLoader(
             dataset=[
                 data.AtomicData.from_config(
@@ -224,6 +236,7 @@ class MACECalculator(Calculator):
                     z_table=self.z_table,
                     cutoff=self.r_max,
                     heads=self.heads,
+                    neighborhood=neighborhood,
                 )
             ],
             batch_size=1,
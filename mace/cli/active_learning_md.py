@@ -62,6 +62,12 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         default=False,
     )
+    parser.add_argument(
+        "--skin",
+        help="Verlet skin (in Ang) used to reuse the neighbour list across steps, 0 to disable",
+        type=float,
+        default=0.0,
+    )
     parser.add_argument(
         "--info_prefix",
         help="prefix for energy, forces and stress keys",
@@ -148,6 +154,7 @@ def main():
         mace_fname,
         args.device,
         default_dtype=args.default_dtype,
+        skin=args.skin,
     )
 
     NSTEPS = args.nsteps
@@ -35,6 +35,12 @@ def parse_args() -> argparse.Namespace:
         default="float64",
     )
     parser.add_argument("--batch_size", help="batch size", type=int, default=64)
+    parser.add_argument(
+        "--num_workers",
+        help="number of processes parsing the configurations",
+        type=int,
+        default=1,
+    )
     parser.add_argument(
         "--compute_stress",
         help="compute stress",
@@ -71,18 +77,15 @@ def main():
         param.requires_grad = False
 
     # Load data and prepare input
-    atoms_list = ase.io.read(args.configs, index=":")
+    atoms_list = data.read_xyz(args.configs, index=":", num_workers=args.num_workers)
     configs = [data.config_from_atoms(atoms) for atoms in atoms_list]
 
     z_table = utils.AtomicNumberTable([int(z) for z in model.atomic_numbers])
 
     data_loader = torch_geometric.dataloader.DataLoader(
-        dataset=[
-            data.AtomicData.from_config(
-                config, z_table=z_table, cutoff=float(model.r_max)
-            )
-            for config in configs
-        ],
+        dataset=data.AtomicData.from_configs(
+            configs, z_table=z_table, cutoff=float(model.r_max)
+        ),
         batch_size=args.batch_size,
         shuffle=False,
         drop_last=False,
@@ -4,14 +4,18 @@
 
 import argparse
 import logging
-from typing import List
+import os
+from typing import List, Sequence, Tuple
 
 
 import ase.data
 import ase.io
 import numpy as np
 import torch
+from ase.calculators.singlepoint import SinglePointCalculator
+from torch.utils.data import ConcatDataset
 
+from mace import data
 from mace.calculators import MACECalculator, mace_mp
 
 try:
@@ -24,7 +28,9 @@ def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--configs_pt",
-        help="path to XYZ configurations for the pretraining",
+        help="path to XYZ configurations for the pretraining, or to a directory of "
+        "HDF5 shards written by preprocess_data, which are filtered without reading "
+        "their structures",
         required=True,
     )
     parser.add_argument(
@@ -92,6 +98,12 @@ def parse_args() -> argparse.Namespace:
         default=1.0,
     )
     parser.add_argument("--seed", help="random seed", type=int, default=42)
+    parser.add_argument(
+        "--num_workers",
+        help="number of processes parsing the configurations",
+        type=int,
+        default=1,
+    )
     return parser.parse_args()
 
 
@@ -148,6 +160,122 @@ def filter_atoms(
         )
 
 
+def filter_atoms_list(
+    atoms_list: List[ase.Atoms], element_subset: List[str], filtering_type: str
+) -> np.ndarray:
+    """
+    Boolean mask of the atoms of atoms_list passing filter_atoms, computed at once from
+    element bitmasks rather than one set comparison per configuration.
+    """
+    if len(atoms_list) == 0:
+        return np.zeros(0, dtype=bool)
+    compositions = data.composition_masks(
+        np.concatenate([atoms.numbers for atoms in atoms_list]),
+        [len(atoms) for atoms in atoms_list],
+    )
+    return data.match_compositions(
+        compositions,
+        [ase.data.atomic_numbers[symbol] for symbol in element_subset],
+        filtering_type,
+    )
+
+
+def config_to_atoms(config: data.Configuration) -> ase.Atoms:
+    """Atoms of a configuration, with its energy, forces and stress as calculator results"""
+    atoms = ase.Atoms(
+        numbers=config.atomic_numbers,
+        positions=config.positions,
+        cell=config.cell,
+        pbc=config.pbc,
+    )
+    results = {}
+    if config.energy is not None:
+        results["energy"] = config.energy
+    if config.forces is not None:
+        results["forces"] = config.forces
+    if config.stress is not None and config.stress_weight > 0.0:
+        results["stress"] = config.stress
+    atoms.calc = SinglePointCalculator(atoms, **results)
+    atoms.info["config_type"] = config.config_type
+    return atoms
+
+
+def read_shards(directory: str, indices: Sequence[int]) -> List[ase.Atoms]:
+    """
+    Atoms of the configurations at indices of the concatenation of the HDF5 shards of
+    directory (as in query_shards), reading only those configurations
+    """
+    dataset = ConcatDataset(
+        [
+            data.HDF5Dataset(file, r_max=None, z_table=None)
+            for file in data.list_shards(directory)
+        ]
+    )
+    offsets = np.concatenate([[0], dataset.cumulative_sizes])
+    atoms_list = []
+    for index in indices:
+        shard = np.searchsorted(dataset.cumulative_sizes, index, side="right")
+        config, _ = dataset.datasets[shard].get_config(int(index - offsets[shard]))
+        atoms_list.append(config_to_atoms(config))
+    return atoms_list
+
+
+def select_pretraining_indices(
+    args: argparse.Namespace, selected: np.ndarray
+) -> np.ndarray:
+    """
+    Indices of the pretraining configurations passing the filter (selected), completed
+    by random other configurations when there are fewer than args.num_samples
+    """
+    indices = np.flatnonzero(selected)
+    if args.num_samples is not None and len(indices) <= args.num_samples:
+        logging.info(
+            f"Number of configurations after filtering {len(indices)} "
+            f"is less than the number of samples {args.num_samples}, "
+            "selecting random configurations for the rest."
+        )
+        random_indices = np.random.choice(
+            np.flatnonzero(~selected),
+            args.num_samples - len(indices),
+            replace=False,
+        )
+        indices = np.concatenate([indices, random_indices])
+    return indices
+
+
+def read_pretraining_set(
+    args: argparse.Namespace, elements: List[str]
+) -> Tuple[List[ase.Atoms], np.ndarray]:
+    """
+    Pretraining configurations, filtered by elements if args.filtering_type is set,
+    and their indices in args.configs_pt. From a directory of shards, the filter uses
+    the composition bitmasks of the shards and only the kept structures are read.
+    """
+    if os.path.isdir(args.configs_pt):
+        files = data.list_shards(args.configs_pt)
+        num_configs = len(data.query_shards(files, [], "none"))
+        if args.filtering_type is None:
+            indices = np.arange(num_configs)
+        else:
+            selected = np.zeros(num_configs, dtype=bool)
+            selected[
+                data.query_shards(
+                    files,
+                    [ase.data.atomic_numbers[symbol] for symbol in elements],
+                    "combinations",
+                )
+            ] = True
+            indices = select_pretraining_indices(args, selected)
+        return read_shards(args.configs_pt, indices), indices
+
+    atoms_list = data.read_xyz(args.configs_pt, index=":", num_workers=args.num_workers)
+    if args.filtering_type is None:
+        return atoms_list, np.arange(len(atoms_list))
+    selected = filter_atoms_list(atoms_list, elements, "combinations")
+    indices = select_pretraining_indices(args, selected)
+    return [atoms_list[i] for i in indices], indices
+
+
 class FPS:
     def __init__(self, atoms_list: List[ase.Atoms], n_samples: int):
         self.n_samples = n_samples
@@ -205,63 +333,24 @@ def select_samples(
         calc = MACECalculator(
             model_paths=args.model, device=args.device, default_dtype=args.default_dtype
         )
-    atoms_list_ft = ase.io.read(args.configs_ft, index=":")
+    atoms_list_ft = data.read_xyz(args.configs_ft, index=":", num_workers=args.num_workers)
 
-    if args.filtering_type != None:
-        all_species_ft = np.unique([x.symbol for atoms in atoms_list_ft for x in atoms])
+    all_species_ft = np.unique([x.symbol for atoms in atoms_list_ft for x in atoms])
+    if args.filtering_type is not None:
         logging.info(
             "Filtering configurations based on the finetuning set, "
             f"filtering type: combinations, elements: {all_species_ft}"
         )
-        if args.descriptors is not None:
-            logging.info("Loading descriptors")
-            descriptors = np.load(args.descriptors, allow_pickle=True)
-            atoms_list_pt = ase.io.read(args.configs_pt, index=":")
-            for i, atoms in enumerate(atoms_list_pt):
-                atoms.info["mace_descriptors"] = descriptors[i]
-            atoms_list_pt_filtered = [
-                x
-                for x in atoms_list_pt
-                if filter_atoms(x, all_species_ft, "combinations")
-            ]
-        else:
-            atoms_list_pt = ase.io.read(args.configs_pt, index=":")
-            atoms_list_pt_filtered = [
-                x
-                for x in atoms_list_pt
-                if filter_atoms(x, all_species_ft, "combinations")
-            ]
-        if len(atoms_list_pt_filtered) <= args.num_samples:
-            logging.info(
-                f"Number of configurations after filtering {len(atoms_list_pt_filtered)} "
-                f"is less than the number of samples {args.num_samples}, "
-                "selecting random configurations for the rest."
-            )
-            atoms_list_pt_minus_filtered = [
-                x for x in atoms_list_pt if x not in atoms_list_pt_filtered
-            ]
-            atoms_list_pt_random_inds = np.random.choice(
-                list(range(len(atoms_list_pt_minus_filtered))),
-                args.num_samples - len(atoms_list_pt_filtered),
-                replace=False,
-            )
-            atoms_list_pt = atoms_list_pt_filtered + [
-                atoms_list_pt_minus_filtered[ind] for ind in atoms_list_pt_random_inds
-            ]
-        else:
-            atoms_list_pt = atoms_list_pt_filtered
-
-    else:
-        atoms_list_pt = ase.io.read(args.configs_pt, index=":")
-        if args.descriptors is not None:
-            logging.info(
-                "Loading descriptors for the pretraining set from {}".format(
-                    args.descriptors
-                )
+    atoms_list_pt, indices_pt = read_pretraining_set(args, list(all_species_ft))
+    if args.descriptors is not None:
+        logging.info(
+            "Loading descriptors for the pretraining set from {}".format(
+                args.descriptors
             )
-            descriptors = np.load(args.descriptors, allow_pickle=True)
-            for i, atoms in enumerate(atoms_list_pt):
-                atoms.info["mace_descriptors"] = descriptors[i]
+        )
+        descriptors = np.load(args.descriptors, allow_pickle=True)
+        for atoms, i in zip(atoms_list_pt, indices_pt):
+            atoms.info["mace_descriptors"] = descriptors[i]
 
     if args.num_samples is not None and args.num_samples < len(atoms_list_pt):
         if args.descriptors is None:
@@ -2,73 +2,29 @@
 # new hdf5 file that is ready for training with on-the-fly dataloading
 
 import ast
+import functools
 import json
 import logging
 import multiprocessing as mp
 import os
 import random
+import re
 from glob import glob
-from typing import List, Tuple
 
 import h5py
 import numpy as np
 import tqdm
 
 from mace import data, tools
-from mace.data.utils import save_configurations_as_HDF5
-from mace.modules import compute_statistics
-from mace.tools import torch_geometric
+from mace.data.utils import (
+    read_atoms_file,
+    save_configurations_as_columnar_HDF5,
+    save_configurations_as_HDF5,
+)
 from mace.tools.scripts_utils import get_atomic_energies, get_dataset_from_xyz, get_dataset_from_h5, get_dataset_from_extxyzs
 from mace.tools.utils import AtomicNumberTable
 
 
-def compute_stats_target(
-    file: str,
-    z_table: AtomicNumberTable,
-    r_max: float,
-    atomic_energies: Tuple,
-    batch_size: int,
-):
-    train_dataset = data.HDF5Dataset(file, z_table=z_table, r_max=r_max)
-    train_loader = torch_geometric.dataloader.DataLoader(
-        dataset=train_dataset,
-        batch_size=batch_size,
-        shuffle=False,
-        drop_last=True,
-        num_workers=0,
-    )
-
-    avg_num_neighbors, mean, std = compute_statistics(train_loader, atomic_energies)
-    output = [avg_num_neighbors, mean, std]
-    return output
-
-
-def pool_compute_stats(inputs: List):
-    path_to_files, z_table, r_max, atomic_energies, batch_size, num_process = inputs
-
-    with mp.Pool(processes=num_process) as pool:
-        re = [
-            pool.apply_async(
-                compute_stats_target,
-                args=(
-                    file,
-                    z_table,
-                    r_max,
-                    atomic_energies,
-                    batch_size,
-                ),
-            )
-            for file in glob(path_to_files + "/*")
-        ]
-
-        pool.close() # redundent
-        pool.join()  # redundent
-
-    results = [r.get() for r in tqdm.tqdm(re)]
-    # import ipdb; ipdb.set_trace()
-    return np.average(results, axis=0)
-
-
 def split_array(a: np.ndarray, max_size: int):
     drop_last = False
     if len(a) % 2 == 1:
@@ -93,16 +49,504 @@ def get_prime_factors(n: int):
             n = n / i
     return factors
 
+def save_shard(configurations, process, f, r_max=None, h5_format="grouped"):
+    if h5_format == "columnar":
+        save_configurations_as_columnar_HDF5(configurations, f, r_max=r_max)
+    else:
+        save_configurations_as_HDF5(configurations, process, f, r_max=r_max)
+
 # Define Task for Multiprocessiing
-def multi_train_hdf5(process, h5_prefix, drop_last, split_train):
+def multi_train_hdf5(process, h5_prefix, drop_last, split_train, r_max=None, h5_format="grouped"):
     with h5py.File(h5_prefix + "train/train_" + str(process)+".h5", "w") as f:
         f.attrs["drop_last"] = drop_last
-        save_configurations_as_HDF5(split_train, process, f)
+        save_shard(split_train, process, f, r_max=r_max, h5_format=h5_format)
 
-def multi_valid_hdf5(process, h5_prefix, drop_last, split_valid):
+def multi_valid_hdf5(process, h5_prefix, drop_last, split_valid, r_max=None, h5_format="grouped"):
     with h5py.File(h5_prefix + "val/val_" + str(process)+".h5", "w") as f:
         f.attrs["drop_last"] = drop_last
-        save_configurations_as_HDF5(split_valid, process, f)
+        save_shard(split_valid, process, f, r_max=r_max, h5_format=h5_format)
+
+def convert_shards_to_mmap(args, r_max=None):
+    """
+    Convert the h5 files (or directories of h5 files) given as train, valid and test
+    files into MmapDataset directories under h5_prefix
+    """
+    jobs = []
+    for path, sub_dir in (
+        (args.train_file, "train"),
+        (args.valid_file, "val"),
+        (args.test_file, "test"),
+    ):
+        if path is None:
+            continue
+        shards = [path] if os.path.isfile(path) else sorted(glob(path + "/*.h5"))
+        for shard in shards:
+            name = os.path.splitext(os.path.basename(shard))[0]
+            jobs.append((shard, args.h5_prefix + sub_dir + "_mmap/" + name, r_max))
+    logging.info(f"Converting {len(jobs)} h5 files to memory-mapped arrays")
+    with mp.Pool(processes=args.num_process) as pool:
+        pool.starmap(data.convert_hdf5_to_mmap, jobs)
+
+def atoms_nbytes(atoms) -> int:
+    """Rough memory footprint of a structure, for bounding the memory of preprocessing"""
+    nbytes = sum(array.nbytes for array in atoms.arrays.values())
+    if atoms.calc is not None:
+        nbytes += sum(np.asarray(value).nbytes for value in atoms.calc.results.values())
+    # Python objects of the Atoms and of its info
+    return nbytes + 1024
+
+
+def convert_and_write_shard(
+    path,
+    atoms_list,
+    process,
+    config_type_weights,
+    keys,
+    from_calc,
+    r_max=None,
+    h5_format="grouped",
+):
+    """
+    Convert structures to configurations and write them as one shard, in a worker. The
+    shard is written under a hidden name and renamed when complete, so that an
+    interrupted run never leaves a partial shard at path.
+    """
+    for atoms in atoms_list:
+        data.copy_calculator_results(atoms, **from_calc)
+    configurations = data.config_from_atoms_list(
+        atoms_list, config_type_weights=config_type_weights, **keys
+    )
+    directory, name = os.path.split(path)
+    partial_path = os.path.join(directory, "." + name + ".part")
+    with h5py.File(partial_path, "w") as f:
+        f.attrs["drop_last"] = len(configurations) % 2 == 1
+        save_shard(configurations, process, f, r_max=r_max, h5_format=h5_format)
+    os.replace(partial_path, path)
+    return sorted({int(z) for config in configurations for z in config.atomic_numbers})
+
+
+class ShardWriter:
+    """
+    Groups the structures it is given into shards of about shard_bytes, which a pool of
+    workers converts and writes as directory/name_i.h5, with i counting from
+    first_index. At most max_pending shards wait for a worker at any time. With
+    shuffle, structures are shuffled within windows of max_pending shards.
+    """
+
+    def __init__(
+        self,
+        pool,
+        directory,
+        name,
+        shard_bytes,
+        max_pending,
+        shuffle=False,
+        seed=0,
+        first_index=0,
+        **shard_kwargs,
+    ):
+        self.pool = pool
+        self.directory = directory
+        self.name = name
+        self.shard_bytes = shard_bytes
+        self.max_pending = max_pending
+        self.window = max_pending if shuffle else 1
+        self.shuffle = shuffle
+        self.rng = random.Random(seed)
+        self.shard_kwargs = shard_kwargs
+        self.first_index = first_index
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.pending = []
+        self.num_shards = 0
+        self.num_configs = 0
+        self.zs = set()
+
+    def add(self, atoms):
+        self.buffer.append(atoms)
+        self.buffer_bytes += atoms_nbytes(atoms)
+        if self.buffer_bytes >= self.window * self.shard_bytes:
+            self._flush()
+
+    def _flush(self):
+        if len(self.buffer) == 0:
+            return
+        if self.shuffle:
+            self.rng.shuffle(self.buffer)
+        num_shards = min(len(self.buffer), -(-self.buffer_bytes // self.shard_bytes))
+        for indices in np.array_split(np.arange(len(self.buffer)), num_shards):
+            self._submit([self.buffer[i] for i in indices])
+        self.buffer = []
+        self.buffer_bytes = 0
+
+    def _submit(self, atoms_list):
+        index = self.first_index + self.num_shards
+        path = os.path.join(self.directory, f"{self.name}_{index}.h5")
+        self.pending.append(
+            self.pool.apply_async(
+                convert_and_write_shard,
+                args=(path, atoms_list, index),
+                kwds=self.shard_kwargs,
+            )
+        )
+        self.num_shards += 1
+        self.num_configs += len(atoms_list)
+        while len(self.pending) > self.max_pending:
+            self.zs.update(self.pending.pop(0).get())
+
+    def close(self):
+        self._flush()
+        for result in self.pending:
+            self.zs.update(result.get())
+        self.pending = []
+
+
+def next_shard_index(directory, name):
+    """Index following those of the name_i.h5 shards already in directory"""
+    pattern = re.compile(re.escape(name) + r"_(\d+)\.h5")
+    indices = [
+        int(match.group(1))
+        for match in (pattern.fullmatch(os.path.basename(path)) for path in data.list_shards(directory))
+        if match is not None
+    ]
+    return max(indices, default=-1) + 1
+
+
+def get_xyz_keys(args):
+    """Keys of the properties of structures read from xyz files, as in load_from_xyz"""
+    keys = {
+        "energy_key": args.energy_key,
+        "forces_key": args.forces_key,
+        "stress_key": args.stress_key,
+        "virials_key": args.virials_key,
+        "dipole_key": args.dipole_key,
+        "charges_key": args.charges_key,
+    }
+    # Results of the calculator are read under _REF_ keys
+    from_calc = {}
+    for key in ("energy", "forces", "stress"):
+        from_calc[key] = keys[key + "_key"] == key
+        if from_calc[key]:
+            keys[key + "_key"] = "_REF_" + key
+    return keys, from_calc
+
+
+def convert_extxyz_file(
+    file_path, directory, valid_directory=None, valid_fraction=0.0, seed=0, **shard_kwargs
+):
+    """
+    Write the structures of an extxyz file as directory/<name>.h5, in a worker, moving a
+    random valid_fraction of them to valid_directory/<name>.h5. The shard of directory
+    is written last, so that it marks the file as processed.
+    """
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    rng = random.Random(f"{seed}:{name}")
+    atoms_list, valid_atoms_list = [], []
+    for atoms in read_atoms_file(file_path):
+        if valid_directory is not None and rng.random() < valid_fraction:
+            valid_atoms_list.append(atoms)
+        else:
+            atoms_list.append(atoms)
+    if len(valid_atoms_list) > 0:
+        convert_and_write_shard(
+            os.path.join(valid_directory, name + ".h5"), valid_atoms_list, 0, **shard_kwargs
+        )
+    convert_and_write_shard(os.path.join(directory, name + ".h5"), atoms_list, 0, **shard_kwargs)
+    return len(atoms_list), len(valid_atoms_list)
+
+
+def preprocess_extxyz_directories(args, config_type_weights, r_max=None):
+    """
+    Write each extxyz file of the train, valid and test directories as its own shard,
+    reading and writing the files in a pool of args.num_process workers so that no
+    structures go through the main process. Files whose shard already exists are
+    skipped, so an interrupted run resumes where it stopped.
+    Returns the atomic numbers of the training and validation configurations.
+    """
+    if args.deduplicate:
+        raise ValueError(
+            "Deduplication is not supported for directories of extxyz files, whose "
+            "files are converted independently"
+        )
+    keys, from_calc = get_xyz_keys(args)
+    shard_kwargs = {
+        "config_type_weights": config_type_weights,
+        "keys": keys,
+        "from_calc": from_calc,
+        "r_max": r_max,
+        "h5_format": args.h5_format,
+    }
+    jobs = [(args.train_file, "train", "val" if args.valid_file is None else None)]
+    if args.valid_file is not None:
+        jobs.append((args.valid_file, "val", None))
+    if args.test_file is not None:
+        jobs.append((args.test_file, "test", None))
+    with mp.Pool(processes=args.num_process) as pool:
+        for path, sub_dir, valid_sub_dir in jobs:
+            if not os.path.isdir(path):
+                raise ValueError(f"{path} is not a directory of extxyz files")
+            directory = args.h5_prefix + sub_dir
+            files = data.list_extxyz_files(path)
+            todo = [
+                file
+                for file in files
+                if not os.path.exists(
+                    os.path.join(
+                        directory, os.path.splitext(os.path.basename(file))[0] + ".h5"
+                    )
+                )
+            ]
+            if len(todo) < len(files):
+                logging.info(
+                    f"Skipping {len(files) - len(todo)} files of {path} already processed"
+                )
+            task = functools.partial(
+                convert_extxyz_file,
+                directory=directory,
+                valid_directory=None
+                if valid_sub_dir is None
+                else args.h5_prefix + valid_sub_dir,
+                valid_fraction=args.valid_fraction,
+                seed=args.seed,
+                **shard_kwargs,
+            )
+            chunksize = max(1, len(todo) // (4 * args.num_process))
+            num_configs, num_valid_configs = 0, 0
+            for num, num_valid in tqdm.tqdm(
+                pool.imap_unordered(task, todo, chunksize=chunksize), total=len(todo)
+            ):
+                num_configs += num
+                num_valid_configs += num_valid
+            logging.info(
+                f"Wrote {num_configs} {sub_dir} configurations"
+                + (
+                    f" and {num_valid_configs} {valid_sub_dir} configurations"
+                    if valid_sub_dir is not None
+                    else ""
+                )
+                + f" from {len(todo)} files"
+            )
+
+    zs = set()
+    for sub_dir in ("train", "val", "test"):
+        manifest = data.write_manifest(args.h5_prefix + sub_dir, r_max=args.r_max)
+        if sub_dir != "test":
+            zs.update(manifest["elements"])
+    return zs
+
+
+def preprocess_streaming(args, config_type_weights, r_max=None):
+    """
+    Read the train, valid and test files one structure at a time, and write them as
+    shards while reading, keeping about args.max_memory MB of structures in memory.
+    Returns the isolated atom energies found in the training file, and the atomic
+    numbers of the written configurations.
+    """
+    if args.train_file.endswith("xyz"):
+        keys, from_calc = get_xyz_keys(args)
+    elif args.train_file.endswith("h5") or args.train_file.endswith("hdf5"):
+        keys = {}
+        from_calc = {"energy": False, "forces": False, "stress": False}
+    else:
+        raise ValueError("Streaming preprocessing supports xyz and h5 files only")
+
+    shard_bytes = max(1, int(args.max_memory * 1024**2 / (2 * args.num_process)))
+    atomic_energies_dict = {}
+    rng = random.Random(args.seed)
+    with mp.Pool(processes=args.num_process) as pool:
+
+        def writer(sub_dir, name):
+            # When appending, new shards are numbered after the existing ones
+            directory = args.h5_prefix + sub_dir
+            return ShardWriter(
+                pool,
+                directory,
+                name,
+                shard_bytes=shard_bytes,
+                max_pending=args.num_process,
+                shuffle=args.shuffle,
+                seed=args.seed,
+                first_index=next_shard_index(directory, name) if args.append else 0,
+                config_type_weights=config_type_weights,
+                keys=keys,
+                from_calc=from_calc,
+                r_max=r_max,
+                h5_format=args.h5_format,
+            )
+
+        deduplicator = None
+        if args.deduplicate:
+            # When appending, structures already in the shards are dropped as well
+            deduplicator = data.Deduplicator.from_shards(
+                [
+                    shard
+                    for sub_dir in ("train", "val", "test")
+                    for shard in data.list_shards(args.h5_prefix + sub_dir)
+                ]
+                if args.append
+                else []
+            )
+
+        def keep(atoms):
+            return deduplicator is None or deduplicator.keep_atoms(atoms)
+
+        def read_atoms(file_path):
+            return data.iread_atoms(
+                file_path,
+                h5_positions_key=args.h5_positions_key,
+                h5_numbers_key=args.h5_numbers_key,
+                h5_energy_key=args.h5_energy_key,
+                h5_forces_key=args.h5_forces_key,
+            )
+
+        train_writer, valid_writer = writer("train", "train"), writer("val", "val")
+        for atoms in read_atoms(args.train_file):
+            if atoms.info.get("config_type") == "IsolatedAtom":
+                assert (
+                    len(atoms) == 1
+                ), f"Got config_type=IsolatedAtom for a config with len {len(atoms)}"
+                data.copy_calculator_results(atoms, **from_calc)
+                head = atoms.info.get("head", "Default")
+                energy = atoms.info.get(keys.get("energy_key", "energy"))
+                if energy is None:
+                    logging.warning(
+                        "Isolated atom without an energy, zero energy will be used"
+                    )
+                    energy = 0.0
+                atomic_energies_dict.setdefault(head, {})[
+                    atoms.get_atomic_numbers()[0]
+                ] = energy
+            elif not keep(atoms):
+                continue
+            elif args.valid_file is None and rng.random() < args.valid_fraction:
+                valid_writer.add(atoms)
+            else:
+                train_writer.add(atoms)
+        if args.valid_file is not None:
+            for atoms in read_atoms(args.valid_file):
+                if keep(atoms):
+                    valid_writer.add(atoms)
+        test_writers = {}
+        if args.test_file is not None:
+            for atoms in read_atoms(args.test_file):
+                if not keep(atoms):
+                    continue
+                config_type = atoms.info.get("config_type", "Default")
+                if config_type not in test_writers:
+                    test_writers[config_type] = writer("test", config_type)
+                test_writers[config_type].add(atoms)
+
+        zs = set()
+        for name, shard_writer in [("train", train_writer), ("valid", valid_writer)] + list(
+            test_writers.items()
+        ):
+            shard_writer.close()
+            zs.update(shard_writer.zs)
+            logging.info(
+                f"Wrote {shard_writer.num_configs} {name} configurations "
+                f"in {shard_writer.num_shards} shards"
+            )
+
+    if deduplicator is not None:
+        deduplicator.log_summary()
+    if len(atomic_energies_dict) > 0:
+        logging.info("Using isolated atom energies from training file")
+    for sub_dir in ("train", "val", "test"):
+        data.write_manifest(args.h5_prefix + sub_dir, r_max=args.r_max)
+    return atomic_energies_dict, zs
+
+
+def compute_and_save_statistics(
+    args, atomic_energies_dict, z_table, train_configs, new_shards=None
+):
+    """
+    Compute the statistics of the training shards and save them to statistics.json,
+    together with their mergeable moments. If new_shards is given and statistics were
+    saved before, only new_shards are read and their statistics are merged into the
+    saved ones, with the saved atomic energies.
+    """
+    logging.info("Computing statistics")
+    statistics_path = args.h5_prefix + "statistics.json"
+    previous = None
+    if new_shards is not None and os.path.isfile(statistics_path):
+        with open(statistics_path) as f:  # pylint: disable=W1514
+            previous = json.load(f)
+        if "moments" not in previous or not np.isclose(previous["r_max"], args.r_max):
+            logging.warning(
+                "Saved statistics cannot be updated, computing them over all shards"
+            )
+            previous = None
+
+    if previous is not None:
+        logging.info(f"Updating the statistics saved in {statistics_path}")
+        atomic_energies_dict = ast.literal_eval(previous["atomic_energies"])
+        zs = set(ast.literal_eval(previous["atomic_numbers"])) | set(z_table.zs)
+        missing = sorted(z for z in zs if z not in atomic_energies_dict)
+        if len(missing) > 0:
+            raise ValueError(
+                f"New elements {missing} have no saved atomic energies, "
+                "preprocess the whole dataset again"
+            )
+        z_table = tools.get_atomic_number_table_from_zs(zs)
+        shards = new_shards
+    else:
+        if len(atomic_energies_dict) == 0 and train_configs is None and (
+            args.E0s is not None and args.E0s.lower() == "average"
+        ):
+            # Streaming: fit the E0s over the written shards instead of configurations
+            logging.info(
+                "Computing average Atomic Energies using least squares regression"
+            )
+            atomic_energies_dict = data.compute_E0s_from_hdf5(
+                data.list_shards(args.h5_prefix + "train"),
+                z_table.zs,
+                num_workers=args.num_process,
+            )
+        elif len(atomic_energies_dict) == 0:
+            atomic_energies_dict = get_atomic_energies(args.E0s, train_configs, z_table)
+        if all(isinstance(value, dict) for value in atomic_energies_dict.values()):
+            # E0s per head, while statistics.json holds the statistics of one head
+            if len(atomic_energies_dict) != 1:
+                raise ValueError(
+                    f"Atomic energies of several heads {sorted(atomic_energies_dict)}, "
+                    "preprocess each head separately"
+                )
+            atomic_energies_dict = next(iter(atomic_energies_dict.values()))
+        shards = data.list_shards(args.h5_prefix + "train")
+    atomic_energies: np.ndarray = np.array(
+        [atomic_energies_dict[z] for z in z_table.zs]
+    )
+    logging.info(f"Atomic energies: {atomic_energies.tolist()}")
+
+    # Average number of neighbors, mean interaction energy per atom and RMS of forces
+    moments = data.compute_statistics_from_hdf5(
+        shards,
+        {None: dict(zip(z_table.zs, atomic_energies))},
+        args.r_max,
+        num_workers=args.num_process,
+    ).total()
+    if previous is not None:
+        moments.merge(data.HeadStatistics.from_dict(previous["moments"]))
+    avg_num_neighbors = moments.avg_num_neighbors
+    mean, std = moments.scaling("rms_forces_scaling")
+    logging.info(f"Average number of neighbors: {avg_num_neighbors}")
+    logging.info(f"Mean: {mean}")
+    logging.info(f"Standard deviation: {std}")
+
+    # save the statistics as a json
+    statistics = {
+        "atomic_energies": str(atomic_energies_dict),
+        "avg_num_neighbors": avg_num_neighbors,
+        "mean": mean,
+        "std": std,
+        "atomic_numbers": str(z_table.zs),
+        "r_max": args.r_max,
+        "moments": moments.to_dict(),
+    }
+
+    with open(statistics_path, "w") as f: # pylint: disable=W1514
+        json.dump(statistics, f)
+
 
 def main():
     """
@@ -110,6 +554,8 @@ def main():
     new hdf5 file that is ready for training with on-the-fly dataloading
     """
     args = tools.build_preprocess_arg_parser().parse_args()
+    args.num_process = data.get_num_workers(args.num_process)
+    num_read_workers = data.get_num_workers(args.num_read_workers)
 
     # Setup
     tools.set_seeds(args.seed)
@@ -130,11 +576,43 @@ def main():
         )
         config_type_weights = {"Default": 1.0}
 
+    # Cutoff used to precompute the graphs stored in the shards
+    graph_r_max = args.r_max if args.store_graphs else None
+
+    if args.convert_to_mmap:
+        convert_shards_to_mmap(args, graph_r_max)
+        return
+
     folders = ["train", "val", "test"]
     for sub_dir in folders:
         if not os.path.exists(args.h5_prefix + sub_dir):
             os.makedirs(args.h5_prefix + sub_dir)
 
+    if args.append and not args.streaming:
+        logging.info("Appending implies --streaming")
+        args.streaming = True
+    existing_shards = set(data.list_shards(args.h5_prefix + "train"))
+
+    if args.streaming and os.path.isdir(args.train_file):
+        atomic_energies_dict = {}
+        zs = preprocess_extxyz_directories(args, config_type_weights, graph_r_max)
+    elif args.streaming:
+        atomic_energies_dict, zs = preprocess_streaming(args, config_type_weights, graph_r_max)
+    if args.streaming:
+        if args.atomic_numbers is not None:
+            zs = ast.literal_eval(args.atomic_numbers)
+        z_table = tools.get_atomic_number_table_from_zs(zs)
+        if args.compute_statistics:
+            new_shards = None
+            if args.append:
+                new_shards = sorted(
+                    set(data.list_shards(args.h5_prefix + "train")) - existing_shards
+                )
+            compute_and_save_statistics(
+                args, atomic_energies_dict, z_table, None, new_shards=new_shards
+            )
+        return
+
     # Data preparation
     if args.train_file.endswith("xyz"):
         collections, atomic_energies_dict, _ = get_dataset_from_xyz(
@@ -150,6 +628,7 @@ def main():
             virials_key=args.virials_key,
             dipole_key=args.dipole_key,
             charges_key=args.charges_key,
+            num_workers=num_read_workers,
         )
     elif args.train_file.endswith("hdf5") or args.train_file.endswith("h5"):
         collections, atomic_energies_dict, _ = get_dataset_from_h5(
@@ -172,8 +651,19 @@ def main():
             config_type_weights=config_type_weights,
             test_path=args.test_file,
             seed=args.seed,
-        ) 
+            num_workers=num_read_workers,
+        )
+
 
+    if args.deduplicate:
+        deduplicator = data.Deduplicator()
+        collections.train = deduplicator.filter_configurations(collections.train)
+        collections.valid = deduplicator.filter_configurations(collections.valid)
+        collections.tests = [
+            (name, deduplicator.filter_configurations(subset))
+            for name, subset in collections.tests
+        ]
+        deduplicator.log_summary()
 
     # Atomic number table
     # yapf: disable
@@ -202,44 +692,16 @@ def main():
 
     processes = []
     for i in range(args.num_process):
-        p = mp.Process(target=multi_train_hdf5, args=[i, args.h5_prefix, drop_last, split_train[i]])
+        p = mp.Process(target=multi_train_hdf5, args=[i, args.h5_prefix, drop_last, split_train[i], graph_r_max, args.h5_format])
         p.start()
         processes.append(p)
 
     for i in processes:
         i.join()
+    data.write_manifest(args.h5_prefix + "train", r_max=args.r_max)
 
     if args.compute_statistics:
-        logging.info("Computing statistics")
-        if len(atomic_energies_dict) == 0:
-            atomic_energies_dict = get_atomic_energies(args.E0s, collections.train, z_table)
-            atomic_energies_dict = atomic_energies_dict["Default"] # fix definition of atomic energy dict
-        atomic_energies: np.ndarray = np.array(
-            [atomic_energies_dict[z] for z in z_table.zs]
-        )
-        logging.info(f"Atomic energies: {atomic_energies.tolist()}")
-        # import ipdb; ipdb.set_trace()
-        # avg_num_neighbors, mean, std = compute_stats_target(args.h5_prefix+'train/train_0.h5', z_table, args.r_max, atomic_energies, args.batch_size)
-        
-        _inputs = [args.h5_prefix+'train', z_table, args.r_max, atomic_energies, args.batch_size, args.num_process]
-
-        avg_num_neighbors, mean, std=pool_compute_stats(_inputs)
-        logging.info(f"Average number of neighbors: {avg_num_neighbors}")
-        logging.info(f"Mean: {mean}")
-        logging.info(f"Standard deviation: {std}")
-
-        # save the statistics as a json
-        statistics = {
-            "atomic_energies": str(atomic_energies_dict),
-            "avg_num_neighbors": avg_num_neighbors,
-            "mean": mean,
-            "std": std,
-            "atomic_numbers": str(z_table.zs),
-            "r_max": args.r_max,
-        }
-
-        with open(args.h5_prefix + "statistics.json", "w") as f: # pylint: disable=W1514
-            json.dump(statistics, f)
+        compute_and_save_statistics(args, atomic_energies_dict, z_table, collections.train)
 
     logging.info("Preparing validation set")
     if args.shuffle:
@@ -251,18 +713,25 @@ def main():
 
     processes = []
     for i in range(args.num_process):
-        p = mp.Process(target=multi_valid_hdf5, args=[i, args.h5_prefix, drop_last, split_valid[i]])
+        p = mp.Process(target=multi_valid_hdf5, args=[i, args.h5_prefix, drop_last, split_valid[i], graph_r_max, args.h5_format])
         p.start()
         processes.append(p)
 
     for i in processes:
         i.join()
+    data.write_manifest(args.h5_prefix + "val", r_max=args.r_max)
 
     if args.test_file is not None:
         def multi_test_hdf5(process, name):
             with h5py.File(args.h5_prefix + "test/" + name + "_" + str(process) + ".h5", "w") as f:
                 f.attrs["drop_last"] = drop_last
-                save_configurations_as_HDF5(split_test[process], process, f)
+                save_shard(
+                    split_test[process],
+                    process,
+                    f,
+                    r_max=graph_r_max,
+                    h5_format=args.h5_format,
+                )
 
         logging.info("Preparing test sets")
         for name, subset in collections.tests:
@@ -279,6 +748,7 @@ def main():
 
             for i in processes:
                 i.join()
+        data.write_manifest(args.h5_prefix + "test", r_max=args.r_max)
 
 
 if __name__ == "__main__":
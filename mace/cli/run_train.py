@@ -5,10 +5,12 @@
 ###########################################################################################
 
 import ast
+import atexit
 import glob
 import json
 import logging
 import os
+import shutil
 from pathlib import Path
 from typing import Optional
 import urllib.request
@@ -147,7 +149,7 @@ def main() -> None:
             head_args.atomic_numbers = statistics["atomic_numbers"]
             head_args.mean = statistics["mean"]
             head_args.std = statistics["std"]
-            if head_args.r_max == statistics["r_max"]:
+            if np.isclose(head_args.r_max, statistics["r_max"]):
                 head_args.avg_num_neighbors = statistics["avg_num_neighbors"]
                 head_args.compute_avg_num_neighbors = False
             else:
@@ -208,7 +210,42 @@ def main() -> None:
     atomic_energies = dict_to_array(atomic_energies_dict, list(args.heads.keys()))
     logging.info(f"Atomic energies shape: {atomic_energies.shape}")
     logging.info(f"Atomic energies: {atomic_energies.tolist()}")
-    
+
+    if args.shared_memory:
+        # One process per node copies the preprocessed data to shared memory, which
+        # every rank and DataLoader worker of the node then maps
+        node_leader = not args.distributed or local_rank == 0
+        for head, head_args in args.heads.items():
+            for key in ("train_file", "valid_file"):
+                path = head_args.get(key, None)
+                if path is None or path.endswith(".xyz"):
+                    continue
+                shm_path = data.shared_memory_path(
+                    path, r_max=head_args.r_max, dtype=args.default_dtype
+                )
+                if node_leader:
+                    logging.info(f"Copying {path} to shared memory at {shm_path}")
+                    data.stage_to_shared_memory(
+                        path, r_max=head_args.r_max, dtype=args.default_dtype
+                    )
+                    # Removed even if training fails
+                    atexit.register(shutil.rmtree, shm_path, ignore_errors=True)
+                # Statistics are cached under the original files
+                head_args["source_" + key] = path
+                head_args[key] = shm_path
+        if args.distributed:
+            torch.distributed.barrier()
+
+    statistics_cache = None
+    if args.statistics_cache != "":
+        statistics_cache = data.StatisticsCache(
+            args.statistics_cache
+            or os.path.join(args.checkpoints_dir, "statistics_cache.json")
+        )
+
+    cache_size = int(args.hdf5_cache_size * 1024**2)
+    # Workers must outlive an epoch for their caches to be reused
+    persistent_workers = cache_size > 0 and args.num_workers > 0
     for head, head_args in args.heads.items():
         logging.info(f"=============    Reading dataset {head} and compute     ===========")
         if head_args.train_file.endswith(".xyz"):
@@ -232,6 +269,9 @@ def main() -> None:
                 dipole_key=head_args.get('dipole_key', None),
                 charges_key=head_args.get('charges_key', None),
                 keep_isolated_atoms=head_args.get('keep_isolated_atoms', None),
+                # Ranks already parse the file concurrently, so only a single
+                # process starts a pool of parsers
+                num_workers=1 if args.distributed else max(args.num_workers, 1),
             )
 
             logging.info(
@@ -239,23 +279,21 @@ def main() -> None:
                 f"tests=[{', '.join([name + ': ' + str(len(test_configs)) for name, test_configs in collections.tests])}]"
             )
 
-            head_args.train_set = [
-                data.AtomicData.from_config(config, z_table=z_table, cutoff=head_args.r_max)
-                for config in collections.train
-            ]
-            head_args.valid_set = [
-                data.AtomicData.from_config(config, z_table=z_table, cutoff=head_args.r_max)
-                for config in collections.valid
-            ]
+            head_args.train_set = data.AtomicData.from_configs(
+                collections.train, z_table=z_table, cutoff=head_args.r_max
+            )
+            head_args.valid_set = data.AtomicData.from_configs(
+                collections.valid, z_table=z_table, cutoff=head_args.r_max
+            )
         elif head_args.train_file.endswith(".h5"):
-            head_args.train_set = data.HDF5Dataset(head_args.train_file, r_max=head_args.r_max, z_table=z_table, head=head, heads=list(args.heads.keys()))
-            head_args.valid_set = data.HDF5Dataset(head_args.valid_file, r_max=head_args.r_max, z_table=z_table, head=head, heads=list(args.heads.keys()))
+            head_args.train_set = data.HDF5Dataset(head_args.train_file, r_max=head_args.r_max, z_table=z_table, cache_size=cache_size, head=head, heads=list(args.heads.keys()))
+            head_args.valid_set = data.HDF5Dataset(head_args.valid_file, r_max=head_args.r_max, z_table=z_table, cache_size=cache_size, head=head, heads=list(args.heads.keys()))
         else:  # This case would be for when the file path is to a directory of multiple .h5 files
             head_args.train_set = data.dataset_from_sharded_hdf5(
-                head_args.train_file, r_max=head_args.r_max, z_table=z_table, head=head, heads=list(args.heads.keys()), rank=rank
+                head_args.train_file, r_max=head_args.r_max, z_table=z_table, cache_size=cache_size, head=head, heads=list(args.heads.keys()), rank=rank
             )
             head_args.valid_set = data.dataset_from_sharded_hdf5(
-                head_args.valid_file, r_max=head_args.r_max, z_table=z_table, head=head, heads=list(args.heads.keys()), rank=rank
+                head_args.valid_file, r_max=head_args.r_max, z_table=z_table, cache_size=cache_size, head=head, heads=list(args.heads.keys()), rank=rank
             )
 
         # subset train ratio
@@ -296,21 +334,59 @@ def main() -> None:
             head_args.compute_avg_num_neighbors = False
 
         # TODO: mean std avg_num_neighbor if given
-        #  avg number of neighbors
-        if head_args.get('compute_avg_num_neighbors', True): # Default True
-            logging.info("Computing avg_num_neighbors...")
-            avg_num_neighbors = modules.compute_avg_num_neighbors(head_args.train_loader, rank=rank)
+        compute_avg_num_neighbors = head_args.get('compute_avg_num_neighbors', True) # Default True
+        compute_scaling = (
+            args.scaling != "no_scaling"
+            and ('mean' not in head_args or 'std' not in head_args)
+            and args.model != "AtomicDipolesMACE"
+        )
+        if compute_avg_num_neighbors or compute_scaling:
+            head_index = list(args.heads.keys()).index(head)
+            fingerprint = data.dataset_fingerprint(
+                [head_args.get("source_train_file", head_args.train_file)],
+                r_max=head_args.r_max,
+                zs=z_table.zs,
+                E0s=atomic_energies[head_index].tolist(),
+                head_index=head_index,
+                seed=args.seed,
+                head_seed=head_args.get("seed", None),
+                valid_fraction=head_args.get("valid_fraction", None),
+                train_ratio=head_args.get("train_ratio", None),
+                keys=[head_args.get(key + "_key", None) for key in ("energy", "forces")],
+                world_size=world_size if args.distributed else 1,
+                # The training loader drops its last incomplete batch, which depends
+                # on how the training set is batched
+                batching=[
+                    args.batch_size,
+                    args.max_atoms_per_batch,
+                    args.max_edges_per_batch,
+                    args.size_buckets,
+                    args.streaming,
+                ],
+            )
+            statistics = None
+            if statistics_cache is not None and rank == 0:
+                statistics = statistics_cache.get(fingerprint)
             if args.distributed:
-                num_graphs = torch.tensor(len(head_args.train_loader.dataset)).to(device)
-                num_neighbors = num_graphs * torch.tensor(avg_num_neighbors).to(device)
-                torch.distributed.all_reduce(num_graphs, op=torch.distributed.ReduceOp.SUM)
-                torch.distributed.all_reduce(
-                    num_neighbors, op=torch.distributed.ReduceOp.SUM
-                )
-                head_args.avg_num_neighbors = (num_neighbors / num_graphs).item()
+                # Only rank 0 reads the cache, so that all ranks take the same branch
+                statistics_list = [statistics]
+                torch.distributed.broadcast_object_list(statistics_list, src=0)
+                statistics = statistics_list[0]
+            if statistics is not None:
+                logging.info(f"Using cached statistics of the training set ({fingerprint})")
             else:
-                head_args.avg_num_neighbors = avg_num_neighbors
-            logging.info("Complete")
+                # A single pass over the training set, merged exactly over ranks
+                logging.info("Computing statistics of the training set...")
+                statistics = data.compute_loader_statistics(
+                    head_args.train_loader, atomic_energies, progress=rank == 0
+                ).total()
+                logging.info("Complete")
+                if statistics_cache is not None and rank == 0:
+                    statistics_cache.put(fingerprint, statistics)
+
+        #  avg number of neighbors
+        if compute_avg_num_neighbors:
+            head_args.avg_num_neighbors = statistics.avg_num_neighbors
         logging.info(f"Average number of neighbors: {head_args.avg_num_neighbors}")
 
         # scaling
@@ -318,21 +394,35 @@ def main() -> None:
             head_args.std = 1.0
             head_args.mean = 0.0
             logging.info("No scaling selected")
-        elif ('mean' not in head_args or 'std' not in head_args) and args.model != "AtomicDipolesMACE":
+        elif compute_scaling:
             # NOTE: there is only one scaling used.
-            logging.info("Computing scaling mean and std...")
-            head_args.mean, head_args.std = modules.scaling_classes[args.scaling](
-                head_args.train_loader, atomic_energies, rank=rank
-            )
-            head_args.mean = head_args.mean[-1]
-            head_args.std = head_args.std[-1]
-            logging.info("Complete")
+            head_args.mean, head_args.std = statistics.scaling(args.scaling)
         logging.info(f"mean {head_args.mean}, std {head_args.std}")
 
     train_sets = {k:v.train_set for k,v in args.heads.items()}
     valid_sets = {k:v.valid_set for k,v in args.heads.items()}
     
-    train_set = ConcatDataset(train_sets.values())
+    train_set = data.ShardedConcatDataset(train_sets.values())
+    if args.streaming:
+        # The shards of all the heads are streamed together
+        streaming_sets = []
+        for head, head_args in args.heads.items():
+            if head_args.train_file.endswith(".xyz"):
+                raise ValueError("Streaming requires training data preprocessed with preprocess_data")
+            streaming_sets.append(
+                data.ShardedStreamingDataset.from_path(
+                    head_args.train_file,
+                    z_table=z_table,
+                    r_max=head_args.r_max,
+                    shuffle_buffer_size=args.shuffle_buffer_size,
+                    seed=args.seed,
+                    num_replicas=world_size if args.distributed else 1,
+                    rank=rank,
+                    head=head,
+                    heads=list(args.heads.keys()),
+                )
+            )
+        train_set = sum(streaming_sets[1:], streaming_sets[0])
 
 
     if args.model == "AtomicDipolesMACE":
@@ -356,7 +446,59 @@ def main() -> None:
             compute_dipole = False
 
     train_sampler, valid_sampler = None, None
-    if args.distributed:
+    dynamic_batches = (
+        args.max_atoms_per_batch is not None or args.max_edges_per_batch is not None
+    )
+    if dynamic_batches and (args.streaming or args.contiguous_batches):
+        raise ValueError(
+            "--max_atoms_per_batch and --max_edges_per_batch cannot be combined with "
+            "--streaming or --contiguous_batches"
+        )
+    if args.size_buckets > 0 and (
+        dynamic_batches or args.streaming or args.contiguous_batches
+    ):
+        raise ValueError(
+            "--size_buckets cannot be combined with --max_atoms_per_batch, "
+            "--max_edges_per_batch, --streaming or --contiguous_batches"
+        )
+    if args.pad_batches and args.size_buckets == 0:
+        raise ValueError("--pad_batches requires --size_buckets")
+    if args.streaming:
+        # The dataset deals the shards itself, and is reshuffled through set_epoch
+        train_sampler = train_set
+    elif args.contiguous_batches:
+        train_sampler = data.ContiguousBatchSampler(
+            train_set,
+            batch_size=args.batch_size,
+            shuffle=True,
+            drop_last=True,
+            seed=args.seed,
+            num_replicas=world_size if args.distributed else 1,
+            rank=rank,
+        )
+    elif args.size_buckets > 0:
+        train_sampler = data.BucketBatchSampler(
+            train_set,
+            batch_size=args.batch_size,
+            num_buckets=args.size_buckets,
+            shuffle=True,
+            drop_last=True,
+            seed=args.seed,
+            num_replicas=world_size if args.distributed else 1,
+            rank=rank,
+        )
+    elif dynamic_batches:
+        train_sampler = data.DynamicBatchSampler(
+            train_set,
+            max_atoms=args.max_atoms_per_batch,
+            max_edges=args.max_edges_per_batch,
+            shuffle=True,
+            drop_last=True,
+            seed=args.seed,
+            num_replicas=world_size if args.distributed else 1,
+            rank=rank,
+        )
+    elif args.distributed:
         train_sampler = torch.utils.data.distributed.DistributedSampler(
             train_set,
             num_replicas=world_size,
@@ -366,6 +508,7 @@ def main() -> None:
             seed=args.seed,
         )
 
+    if args.distributed:
         valid_samplers = {}
         for head, valid_set in valid_sets.items():
             valid_sampler = torch.utils.data.distributed.DistributedSampler(
@@ -378,16 +521,46 @@ def main() -> None:
             )
             valid_samplers[head] = valid_sampler
     
-    train_loader = torch_geometric.dataloader.DataLoader(
-        dataset=train_set,
-        batch_size=args.batch_size,
-        sampler=train_sampler,
-        shuffle=(train_sampler is None),
-        drop_last=(train_sampler is None),
-        pin_memory=args.pin_memory,
-        num_workers=args.num_workers,
-        generator=torch.Generator().manual_seed(args.seed),
-    )
+    if args.streaming:
+        train_loader = torch_geometric.dataloader.DataLoader(
+            dataset=train_set,
+            batch_size=args.batch_size,
+            drop_last=True,
+            pin_memory=args.pin_memory,
+            num_workers=args.num_workers,
+        )
+    elif args.pad_batches:
+        # The DataLoader of torch_geometric does not take a collate_fn
+        train_loader = torch.utils.data.DataLoader(
+            dataset=train_set,
+            batch_sampler=train_sampler,
+            collate_fn=tools.PaddingCollater(train_sampler.padded_shapes),
+            pin_memory=args.pin_memory,
+            num_workers=args.num_workers,
+            persistent_workers=persistent_workers,
+            generator=torch.Generator().manual_seed(args.seed),
+        )
+    elif args.contiguous_batches or dynamic_batches or args.size_buckets > 0:
+        train_loader = torch_geometric.dataloader.DataLoader(
+            dataset=train_set,
+            batch_sampler=train_sampler,
+            pin_memory=args.pin_memory,
+            num_workers=args.num_workers,
+            persistent_workers=persistent_workers,
+            generator=torch.Generator().manual_seed(args.seed),
+        )
+    else:
+        train_loader = torch_geometric.dataloader.DataLoader(
+            dataset=train_set,
+            batch_size=args.batch_size,
+            sampler=train_sampler,
+            shuffle=(train_sampler is None),
+            drop_last=(train_sampler is None),
+            pin_memory=args.pin_memory,
+            num_workers=args.num_workers,
+            persistent_workers=persistent_workers,
+            generator=torch.Generator().manual_seed(args.seed),
+        )
     
     valid_loaders = {}
     for head, valid_set in valid_sets.items():
@@ -399,6 +572,7 @@ def main() -> None:
             drop_last=False,
             pin_memory=args.pin_memory,
             num_workers=args.num_workers,
+            persistent_workers=persistent_workers,
             generator=torch.Generator().manual_seed(args.seed),
         )
     
@@ -860,6 +1034,8 @@ def main() -> None:
         rank=rank,
         kfac=KFACPrecond,
         kfac_scheduler=KFACScheduler,
+        prefetch_depth=args.prefetch_depth,
+        packed_transfer=args.packed_transfer,
     )
 
     logging.info("Computing metrics for training, validation, and test sets")
@@ -873,12 +1049,9 @@ def main() -> None:
     test_sets = {}
     if args.train_file.endswith(".xyz"): # TODO: train_file is now in config.yaml
         for name, subset in collections.tests:
-            test_sets[name] = [
-                data.AtomicData.from_config(
-                    config, z_table=z_table, cutoff=args.r_max, heads=heads
-                )
-                for config in subset
-            ]
+            test_sets[name] = data.AtomicData.from_configs(
+                subset, z_table=z_table, cutoff=args.r_max, heads=heads
+            )
     elif not args.multi_processed_test:
         assert False, "should not run this [temp]"
         test_files = get_files_with_suffix(args.test_dir, "_test.h5")
@@ -891,7 +1064,7 @@ def main() -> None:
         for head, head_args in args.heads.items():
             if 'test_file' in head_args:
                 assert check_folder_subfolder(head_args.test_file), f"test_file of Head {head} is not a directory or does not contains subfolders: {head_args.test_file}"
-                test_folders = glob(os.path.join(head_args.test_file) + "/*")
+                test_folders = data.list_shards(head_args.test_file)
                 for folder in test_folders:
                     name = os.path.splitext(os.path.basename(folder))[0]
                     test_sets[head + name] = data.dataset_from_sharded_hdf5(
@@ -969,6 +1142,8 @@ def main() -> None:
             torch.distributed.barrier()
 
     logging.info("Done")
+    if args.distributed:
+        torch.distributed.barrier()
     if args.distributed:
         torch.distributed.destroy_process_group()
 
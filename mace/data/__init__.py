@@ -1,24 +1,81 @@
 from .atomic_data import AtomicData
-from .hdf5_dataset import HDF5Dataset, dataset_from_sharded_hdf5
-from .neighborhood import get_neighborhood
+from .atomic_energies import E0Accumulator, compute_E0s_from_hdf5
+from .composition import (
+    composition_masks,
+    element_mask,
+    match_compositions,
+    query_shards,
+    read_composition_index,
+)
+from .hashing import (
+    Deduplicator,
+    atoms_hash,
+    configuration_hash,
+    read_shard_hashes,
+    structure_hash,
+)
+from .hdf5_dataset import (
+    AtomicDataCache,
+    HDF5Dataset,
+    ShardedConcatDataset,
+    dataset_from_sharded_hdf5,
+    get_dataset_caches,
+    log_cache_statistics,
+)
+from .manifest import list_shards, load_shard_sizes, read_manifest, write_manifest
+from .mmap_dataset import (
+    MmapDataset,
+    convert_hdf5_to_mmap,
+    save_configurations_as_mmap,
+    shared_memory_path,
+    stage_to_shared_memory,
+)
+from .neighborhood import VerletNeighborhood, get_neighborhood, get_neighborhoods
+from .samplers import (
+    BucketBatchSampler,
+    ContiguousBatchSampler,
+    DynamicBatchSampler,
+    get_dataset_sizes,
+)
+from .statistics import (
+    HeadStatistics,
+    StatisticsAccumulator,
+    StatisticsCache,
+    compute_loader_statistics,
+    compute_statistics_from_hdf5,
+    dataset_fingerprint,
+)
+from .streaming import ShardedStreamingDataset
 from .utils import (
     Configuration,
     Configurations,
     compute_average_E0s,
     config_from_atoms,
     config_from_atoms_list,
-    load_from_xyz,
-    load_from_h5,
+    configs_from_arrays,
+    configs_from_hdf5,
+    configs_from_hdf5_ani,
+    copy_calculator_results,
+    get_num_workers,
+    iread_atoms,
+    iter_atoms_from_extxyzs,
+    list_extxyz_files,
     load_from_extxyzs,
+    load_from_h5,
+    load_from_xyz,
     random_train_valid_split,
     save_AtomicData_to_HDF5,
+    save_configurations_as_columnar_HDF5,
     save_configurations_as_HDF5,
     save_dataset_as_HDF5,
     test_config_types,
 )
+from .xyz_index import build_xyz_index, load_xyz_index, read_xyz
 
 __all__ = [
     "get_neighborhood",
+    "get_neighborhoods",
+    "VerletNeighborhood",
     "Configuration",
     "Configurations",
     "random_train_valid_split",
@@ -26,11 +83,59 @@ __all__ = [
     "test_config_types",
     "config_from_atoms",
     "config_from_atoms_list",
+    "configs_from_arrays",
+    "configs_from_hdf5",
+    "configs_from_hdf5_ani",
+    "copy_calculator_results",
+    "iread_atoms",
+    "get_num_workers",
+    "iter_atoms_from_extxyzs",
+    "list_extxyz_files",
+    "build_xyz_index",
+    "load_xyz_index",
+    "read_xyz",
     "AtomicData",
     "compute_average_E0s",
     "save_dataset_as_HDF5",
     "HDF5Dataset",
+    "AtomicDataCache",
+    "get_dataset_caches",
+    "log_cache_statistics",
     "dataset_from_sharded_hdf5",
+    "ShardedConcatDataset",
+    "BucketBatchSampler",
+    "ContiguousBatchSampler",
+    "DynamicBatchSampler",
+    "get_dataset_sizes",
+    "ShardedStreamingDataset",
+    "MmapDataset",
+    "convert_hdf5_to_mmap",
+    "save_configurations_as_mmap",
+    "shared_memory_path",
+    "list_shards",
+    "load_shard_sizes",
+    "read_manifest",
+    "write_manifest",
+    "stage_to_shared_memory",
     "save_AtomicData_to_HDF5",
     "save_configurations_as_HDF5",
+    "save_configurations_as_columnar_HDF5",
+    "E0Accumulator",
+    "compute_E0s_from_hdf5",
+    "HeadStatistics",
+    "StatisticsAccumulator",
+    "StatisticsCache",
+    "compute_loader_statistics",
+    "compute_statistics_from_hdf5",
+    "dataset_fingerprint",
+    "composition_masks",
+    "element_mask",
+    "match_compositions",
+    "query_shards",
+    "read_composition_index",
+    "Deduplicator",
+    "atoms_hash",
+    "configuration_hash",
+    "read_shard_hashes",
+    "structure_hash",
 ]
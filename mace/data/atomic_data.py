@@ -4,8 +4,9 @@
 # This program is distributed under the MIT License (see MIT.md)
 ###########################################################################################
 
-from typing import Optional, Sequence
+from typing import List, Optional, Sequence, Tuple
 
+import numpy as np
 import torch.utils.data
 
 from mace.tools import (
@@ -16,7 +17,7 @@ from mace.tools import (
     voigt_to_matrix,
 )
 
-from .neighborhood import get_neighborhood
+from .neighborhood import get_neighborhood, get_neighborhoods
 from .utils import Configuration
 
 
@@ -116,10 +117,16 @@ class AtomicData(torch_geometric.data.Data):
         z_table: AtomicNumberTable,
         cutoff: float,
         heads: Optional[list] = ["Default"],
+        neighborhood: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None,
     ) -> "AtomicData":
-        edge_index, shifts, unit_shifts = get_neighborhood(
-            positions=config.positions, cutoff=cutoff, pbc=config.pbc, cell=config.cell
-        )
+        if neighborhood is None:
+            neighborhood = get_neighborhood(
+                positions=config.positions,
+                cutoff=cutoff,
+                pbc=config.pbc,
+                cell=config.cell,
+            )
+        edge_index, shifts, unit_shifts = neighborhood
         indices = atomic_numbers_to_indices(config.atomic_numbers, z_table=z_table)
         one_hot = to_one_hot(
             torch.tensor(indices, dtype=torch.long).unsqueeze(-1),
@@ -224,6 +231,31 @@ class AtomicData(torch_geometric.data.Data):
             charges=charges,
         )
 
+    @classmethod
+    def from_configs(
+        cls,
+        configs: Sequence[Configuration],
+        z_table: AtomicNumberTable,
+        cutoff: float,
+        heads: Optional[list] = ["Default"],
+    ) -> List["AtomicData"]:
+        neighborhoods = get_neighborhoods(
+            positions=[config.positions for config in configs],
+            cutoff=cutoff,
+            pbc=[config.pbc for config in configs],
+            cell=[config.cell for config in configs],
+        )
+        return [
+            cls.from_config(
+                config,
+                z_table=z_table,
+                cutoff=cutoff,
+                heads=heads,
+                neighborhood=neighborhood,
+            )
+            for config, neighborhood in zip(configs, neighborhoods)
+        ]
+
 
 def get_data_loader(
     dataset: Sequence[AtomicData],
@@ -0,0 +1,185 @@
+import logging
+import multiprocessing as mp
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import h5py
+import numpy as np
+
+from mace.data.manifest import _decode
+
+
+class E0Accumulator:
+    """
+    Least-squares fit of the atomic energies (E0s) of each head, min |A x - B|, where
+    row i of A holds the number of atoms of each element of zs in configuration i and
+    B_i is its energy. Rather than the normal equations AᵀA x = AᵀB, whose condition
+    number is the square of that of A, each head keeps the triangular factor R and QᵀB
+    of a QR decomposition of A (TSQR): blocks of configurations are stacked under R and
+    factorized again, and partial accumulators are merged the same way, so the fit
+    never needs all configurations at once.
+    """
+
+    def __init__(self, zs: Sequence[int]):
+        self.zs = [int(z) for z in zs]
+        # Column of each atomic number, -1 for elements outside of zs
+        self.columns = np.full(max(self.zs, default=0) + 1, -1, dtype=np.int64)
+        self.columns[self.zs] = np.arange(len(self.zs))
+        self.R: Dict[str, np.ndarray] = {}
+        self.QtB: Dict[str, np.ndarray] = {}
+        self.num_configs: Dict[str, int] = {}
+
+    def _head(self, head: str) -> Tuple[np.ndarray, np.ndarray]:
+        if head not in self.R:
+            self.R[head] = np.zeros((0, len(self.zs)))
+            self.QtB[head] = np.zeros(0)
+            self.num_configs[head] = 0
+        return self.R[head], self.QtB[head]
+
+    def _update(self, head: str, A: np.ndarray, B: np.ndarray) -> None:
+        # QR decomposition of R and QᵀB stacked over the rows A and B
+        R, QtB = self._head(head)
+        Q, self.R[head] = np.linalg.qr(np.concatenate([R, A]))
+        self.QtB[head] = Q.T @ np.concatenate([QtB, B])
+
+    def add(
+        self,
+        atomic_numbers: np.ndarray,
+        num_atoms: np.ndarray,
+        energies: np.ndarray,
+        heads: Sequence[str],
+    ) -> None:
+        """
+        Add a block of configurations, given by the concatenation of their atomic
+        numbers, their numbers of atoms, energies (NaN if unknown) and heads
+        """
+        atomic_numbers = np.asarray(atomic_numbers, dtype=np.int64)
+        num_atoms = np.asarray(num_atoms, dtype=np.int64)
+        energies = np.asarray(energies, dtype=np.float64)
+        heads = np.asarray(heads, dtype=object)
+        num_configs, num_zs = len(num_atoms), len(self.zs)
+        if num_configs == 0:
+            return
+
+        known = atomic_numbers < len(self.columns)
+        columns = np.full(len(atomic_numbers), -1, dtype=np.int64)
+        columns[known] = self.columns[atomic_numbers[known]]
+        rows = np.repeat(np.arange(num_configs), num_atoms)
+        in_table = columns >= 0
+        counts = np.bincount(
+            rows[in_table] * num_zs + columns[in_table],
+            minlength=num_configs * num_zs,
+        ).reshape(num_configs, num_zs)
+
+        for head in np.unique(heads):
+            selected = (heads == head) & ~np.isnan(energies)
+            self._update(head, counts[selected].astype(np.float64), energies[selected])
+            self.num_configs[head] += int(selected.sum())
+
+    def add_configurations(self, configurations: Iterable) -> None:
+        configurations = list(configurations)
+        if len(configurations) == 0:
+            return
+        self.add(
+            np.concatenate([config.atomic_numbers for config in configurations]),
+            [len(config.atomic_numbers) for config in configurations],
+            [np.nan if config.energy is None else config.energy for config in configurations],
+            [config.head for config in configurations],
+        )
+
+    def merge(self, other: "E0Accumulator") -> "E0Accumulator":
+        assert self.zs == other.zs, "Cannot merge E0 fits over different elements"
+        for head, R in other.R.items():
+            self._update(head, R, other.QtB[head])
+            self.num_configs[head] += other.num_configs[head]
+        return self
+
+    def solve(self, heads: Optional[Sequence[str]] = None) -> Dict[str, Dict[int, float]]:
+        """
+        E0s of each head. Like numpy.linalg.lstsq on A and B, elements that do not
+        appear in the configurations of a head get an E0 of zero.
+        """
+        atomic_energies_dict = {}
+        for head in self.R if heads is None else heads:
+            R, QtB = self._head(head)
+            try:
+                # Same solution as lstsq on A and B, as R has the same singular values
+                # and null space as A
+                E0s = np.linalg.lstsq(R, QtB, rcond=None)[0]
+            except np.linalg.LinAlgError:
+                logging.warning(
+                    "Failed to compute E0s using least squares regression, using the same for all atoms"
+                )
+                E0s = np.zeros(len(self.zs))
+            atomic_energies_dict[head] = {z: float(E0) for z, E0 in zip(self.zs, E0s)}
+        return atomic_energies_dict
+
+
+def _energy(value) -> float:
+    # Energies stored by save_configurations_as_HDF5 are the string "None" when unknown
+    return np.nan if isinstance(value, (bytes, str)) else float(value)
+
+
+def read_shard_compositions(
+    file_path: str,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[str]]:
+    """
+    Atomic numbers (concatenated), numbers of atoms, energies and heads of the
+    configurations of an HDF5 shard, read without building configurations
+    """
+    with h5py.File(file_path, "r") as f:
+        if f.attrs.get("format") == "columnar":
+            num_configs = int(f.attrs["num_configs"])
+            num_atoms = np.diff(f["node_ptr"][()])
+            atomic_numbers = f["atomic_numbers"][()]
+            energies = np.full(num_configs, np.nan)
+            if "energy" in f:
+                energies = f["energy"][()].astype(np.float64)
+                if "energy_mask" in f:
+                    energies[~f["energy_mask"][()]] = np.nan
+            if "head" in f:
+                vocabulary = [_decode(v) for v in f["head"].attrs["vocabulary"]]
+                heads = [vocabulary[code] for code in f["head"][()]]
+            else:
+                heads = ["Default"] * num_configs
+            return atomic_numbers, num_atoms, energies, heads
+
+        atomic_numbers, num_atoms, energies, heads = [], [], [], []
+        for batch in f.values():
+            for config in batch.values():
+                atomic_numbers.append(config["atomic_numbers"][()])
+                num_atoms.append(len(atomic_numbers[-1]))
+                energies.append(_energy(config["energy"][()]))
+                head = _decode(config["head"][()]) if "head" in config else None
+                heads.append("Default" if head is None else head)
+    return (
+        np.concatenate(atomic_numbers) if atomic_numbers else np.zeros(0, np.int64),
+        np.array(num_atoms, dtype=np.int64),
+        np.array(energies, dtype=np.float64),
+        heads,
+    )
+
+
+def accumulate_E0s_from_hdf5(file_path: str, zs: Sequence[int]) -> E0Accumulator:
+    accumulator = E0Accumulator(zs)
+    accumulator.add(*read_shard_compositions(file_path))
+    return accumulator
+
+
+def compute_E0s_from_hdf5(
+    files: Sequence[str],
+    zs: Sequence[int],
+    heads: Optional[Sequence[str]] = None,
+    num_workers: int = 1,
+) -> Dict[str, Dict[int, float]]:
+    """Least-squares E0s of each head over HDF5 shards, each read by one of num_workers"""
+    if num_workers > 1 and len(files) > 1:
+        with mp.Pool(processes=min(num_workers, len(files))) as pool:
+            accumulators = pool.starmap(
+                accumulate_E0s_from_hdf5, [(file, zs) for file in files]
+            )
+    else:
+        accumulators = [accumulate_E0s_from_hdf5(file, zs) for file in files]
+    accumulator = E0Accumulator(zs)
+    for partial in accumulators:
+        accumulator.merge(partial)
+    return accumulator.solve(heads)
@@ -0,0 +1,135 @@
+from typing import Dict, Optional, Sequence
+
+import h5py
+import numpy as np
+
+from mace.data.manifest import _decode, grouped_configs
+
+# Elements are bits of two 64-bit words, enough for atomic numbers below 128
+NUM_WORDS = 2
+FILTERING_TYPES = ("none", "combinations", "exclusive", "inclusive")
+
+
+def element_mask(atomic_numbers: Sequence[int]) -> np.ndarray:
+    """Bitmask [NUM_WORDS] of a set of elements"""
+    mask = np.zeros(NUM_WORDS, dtype=np.uint64)
+    for z in np.unique(np.asarray(atomic_numbers, dtype=np.int64)):
+        mask[z >> 6] |= np.uint64(1) << np.uint64(z & 63)
+    return mask
+
+
+def composition_masks(
+    atomic_numbers: np.ndarray, num_atoms: Sequence[int]
+) -> np.ndarray:
+    """
+    Bitmasks [num_configs, NUM_WORDS] of the elements of configurations, given the
+    concatenation of their atomic numbers and their numbers of atoms
+    """
+    atomic_numbers = np.asarray(atomic_numbers, dtype=np.uint64)
+    num_atoms = np.asarray(num_atoms, dtype=np.int64)
+    bits = np.zeros((len(atomic_numbers), NUM_WORDS), dtype=np.uint64)
+    words = (atomic_numbers >> np.uint64(6)).astype(np.int64)
+    bits[np.arange(len(atomic_numbers)), words] = np.uint64(1) << (
+        atomic_numbers & np.uint64(63)
+    )
+    masks = np.zeros((len(num_atoms), NUM_WORDS), dtype=np.uint64)
+    non_empty = num_atoms > 0
+    if non_empty.any():
+        starts = np.concatenate([[0], np.cumsum(num_atoms)[:-1]])[non_empty]
+        masks[non_empty] = np.bitwise_or.reduceat(bits, starts, axis=0)
+    return masks
+
+
+def match_compositions(
+    compositions: np.ndarray, atomic_numbers: Sequence[int], filtering_type: str
+) -> np.ndarray:
+    """
+    Which configurations pass the filter of fine_tuning_select.filter_atoms, given their
+    composition bitmasks:
+        'none' - all of them
+        'combinations' - those made only of the given elements
+        'exclusive' - those made of exactly the given elements
+        'inclusive' - those containing at least the given elements
+    """
+    compositions = np.atleast_2d(compositions)
+    mask = element_mask(atomic_numbers)
+    if filtering_type == "none":
+        return np.ones(len(compositions), dtype=bool)
+    if filtering_type == "combinations":
+        return np.all(compositions & ~mask == 0, axis=1)
+    if filtering_type == "exclusive":
+        return np.all(compositions == mask, axis=1)
+    if filtering_type == "inclusive":
+        return np.all(compositions & mask == mask, axis=1)
+    raise ValueError(
+        f"Filtering type {filtering_type} not recognised. Must be one of {FILTERING_TYPES}."
+    )
+
+
+def read_composition_index(file_path: str) -> Dict:
+    """
+    Composition bitmasks, heads and config types of the configurations of an HDF5
+    shard (either layout). Shards written without bitmasks get them from their
+    atomic numbers.
+    """
+    with h5py.File(file_path, "r") as f:
+        if f.attrs.get("format") == "columnar":
+            if "composition" in f:
+                compositions = f["composition"][()]
+            else:
+                compositions = composition_masks(
+                    f["atomic_numbers"][()], np.diff(f["node_ptr"][()])
+                )
+            index = {"composition": compositions}
+            for key in ("head", "config_type"):
+                vocabulary = np.array(
+                    [_decode(v) for v in f[key].attrs["vocabulary"]], dtype=object
+                )
+                index[key] = vocabulary[f[key][()]]
+            return index
+
+        configs = grouped_configs(f)
+        compositions = np.zeros((len(configs), NUM_WORDS), dtype=np.uint64)
+        for i, config in enumerate(configs):
+            if "composition" in config:
+                compositions[i] = config["composition"][()]
+            else:
+                compositions[i] = element_mask(config["atomic_numbers"][()])
+        return {
+            "composition": compositions,
+            "head": np.array(
+                [_decode(c["head"][()]) if "head" in c else None for c in configs],
+                dtype=object,
+            ),
+            "config_type": np.array(
+                [_decode(c["config_type"][()]) for c in configs], dtype=object
+            ),
+        }
+
+
+def query_shards(
+    files: Sequence[str],
+    atomic_numbers: Sequence[int],
+    filtering_type: str = "combinations",
+    heads: Optional[Sequence[str]] = None,
+    config_types: Optional[Sequence[str]] = None,
+) -> np.ndarray:
+    """
+    Indices, in the concatenation of files (as in dataset_from_sharded_hdf5), of the
+    configurations passing the element filter and belonging to one of heads and
+    config_types if given
+    """
+    indices = []
+    offset = 0
+    for file in files:
+        index = read_composition_index(file)
+        selected = match_compositions(
+            index["composition"], atomic_numbers, filtering_type
+        )
+        if heads is not None:
+            selected &= np.isin(index["head"], list(heads))
+        if config_types is not None:
+            selected &= np.isin(index["config_type"], list(config_types))
+        indices.append(np.flatnonzero(selected) + offset)
+        offset += len(selected)
+    return np.concatenate([np.zeros(0, dtype=np.int64)] + indices)
@@ -0,0 +1,131 @@
+import hashlib
+import logging
+from collections import Counter
+from typing import Iterable, List, Optional
+
+import ase
+import h5py
+import numpy as np
+
+HASH_PRECISION = 1e-6
+
+
+def structure_hash(
+    atomic_numbers: np.ndarray,
+    positions: np.ndarray,
+    cell: Optional[np.ndarray] = None,
+    head: Optional[str] = None,
+    precision: float = HASH_PRECISION,
+) -> int:
+    """
+    64-bit hash of a structure that does not depend on the order of its atoms: its
+    atoms, sorted by atomic number and then by position, with positions and cell
+    rounded to multiples of precision, and its head
+    """
+    atoms = np.empty((len(atomic_numbers), 4), dtype=np.int64)
+    atoms[:, 0] = atomic_numbers
+    atoms[:, 1:] = np.round(np.asarray(positions, dtype=np.float64) / precision)
+    atoms = atoms[np.lexsort(atoms.T[::-1])]
+    cell = np.zeros((3, 3)) if cell is None else np.asarray(cell, dtype=np.float64)
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(atoms.tobytes())
+    digest.update(np.round(cell / precision).astype(np.int64).tobytes())
+    digest.update(str(head).encode("utf-8"))
+    return int.from_bytes(digest.digest(), "little")
+
+
+def configuration_hash(config, precision: float = HASH_PRECISION) -> int:
+    return structure_hash(
+        config.atomic_numbers,
+        config.positions,
+        cell=config.cell,
+        head=config.head,
+        precision=precision,
+    )
+
+
+def atoms_hash(
+    atoms: ase.Atoms, head_key: str = "head", precision: float = HASH_PRECISION
+) -> int:
+    """Hash of the Configuration that config_from_atoms makes of atoms"""
+    return structure_hash(
+        atoms.get_atomic_numbers(),
+        atoms.get_positions(),
+        cell=np.array(atoms.get_cell()),
+        head=atoms.info.get(head_key, "Default"),
+        precision=precision,
+    )
+
+
+def read_shard_hashes(file_path: str) -> np.ndarray:
+    """Hashes stored in an HDF5 shard (either layout), without reading its structures"""
+    with h5py.File(file_path, "r") as f:
+        if f.attrs.get("format") == "columnar":
+            return f["hash"][()] if "hash" in f else np.zeros(0, dtype=np.uint64)
+        hashes = [
+            config["hash"][()]
+            for batch in f.values()
+            for config in batch.values()
+            if "hash" in config
+        ]
+    return np.array(hashes, dtype=np.uint64)
+
+
+class Deduplicator:
+    """
+    Keeps the first of the structures with the same hash, counting the structures
+    kept and dropped for each head and config type
+    """
+
+    def __init__(self, hashes: Iterable[int] = ()):
+        self.seen = {int(h) for h in hashes}
+        self.num_kept: Counter = Counter()
+        self.num_dropped: Counter = Counter()
+
+    @classmethod
+    def from_shards(cls, files: Iterable[str]) -> "Deduplicator":
+        """Deduplicator that also drops the structures already stored in files"""
+        deduplicator = cls()
+        for file in files:
+            hashes = read_shard_hashes(file)
+            if len(hashes) == 0:
+                logging.warning(f"{file} stores no hashes, it is not deduplicated against")
+            deduplicator.seen.update(int(h) for h in hashes)
+        return deduplicator
+
+    def keep(self, hash_value: int, head: Optional[str], config_type: Optional[str]) -> bool:
+        key = (head, config_type)
+        if hash_value in self.seen:
+            self.num_dropped[key] += 1
+            return False
+        self.seen.add(hash_value)
+        self.num_kept[key] += 1
+        return True
+
+    def keep_atoms(self, atoms: ase.Atoms, head_key: str = "head") -> bool:
+        return self.keep(
+            atoms_hash(atoms, head_key=head_key),
+            atoms.info.get(head_key, "Default"),
+            atoms.info.get("config_type", "Default"),
+        )
+
+    def filter_configurations(self, configs: List) -> List:
+        return [
+            config
+            for config in configs
+            if self.keep(configuration_hash(config), config.head, config.config_type)
+        ]
+
+    def log_summary(self) -> None:
+        logging.info(
+            f"Deduplication kept {sum(self.num_kept.values())} structures and dropped "
+            f"{sum(self.num_dropped.values())} duplicates"
+        )
+        for head, config_type in sorted(
+            set(self.num_kept) | set(self.num_dropped), key=str
+        ):
+            key = (head, config_type)
+            logging.info(
+                f"  head {head}, config_type {config_type}: kept {self.num_kept[key]}, "
+                f"dropped {self.num_dropped[key]}"
+            )
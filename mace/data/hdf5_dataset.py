@@ -1,10 +1,23 @@
-from glob import glob
-from typing import List
+import copy
+import logging
+import os
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 
 import h5py
+import numpy as np
+import torch
 from torch.utils.data import ConcatDataset, Dataset
 
 from mace.data.atomic_data import AtomicData
+from mace.data.manifest import (
+    get_shard_metadata,
+    list_shards,
+    load_shard_sizes,
+    read_manifest,
+)
+from mace.data.mmap_dataset import MmapDataset, is_mmap_dataset
+from mace.data.neighborhood import get_shifts
 from mace.data.utils import Configuration
 from mace.tools.utils import AtomicNumberTable
 
@@ -13,20 +26,159 @@ from functools import partial
 
 tqdm = partial(tqdm, ncols=55)
 
+class AtomicDataCache:
+    """
+    Least recently used cache of built AtomicData, bounded by the total number of bytes
+    of their tensors. Each process (e.g. each DataLoader worker) holds its own copy.
+    Items are stored and returned as shallow copies: attributes of a returned item can
+    be reassigned, but its tensors are shared with the cache and must not be modified
+    in place.
+    Hits, misses and cached bytes are counted per process in shared memory, so that
+    statistics() also covers the copies of the workers.
+    """
+
+    # Rows of the counters: the main process and up to MAX_WORKERS workers
+    MAX_WORKERS = 63
+    HITS, MISSES, BYTES = range(3)
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.counters = torch.zeros(
+            (self.MAX_WORKERS + 1, 3), dtype=torch.int64
+        ).share_memory_()
+        self._items = OrderedDict()
+
+    @staticmethod
+    def size_of(atomic_data: AtomicData) -> int:
+        return sum(
+            value.element_size() * value.nelement()
+            for _, value in atomic_data
+            if isinstance(value, torch.Tensor)
+        )
+
+    @property
+    def _row(self) -> torch.Tensor:
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            return self.counters[0]
+        return self.counters[1 + worker_info.id % self.MAX_WORKERS]
+
+    @property
+    def hits(self) -> int:
+        return int(self._row[self.HITS])
+
+    @property
+    def misses(self) -> int:
+        return int(self._row[self.MISSES])
+
+    def get(self, key) -> Optional[AtomicData]:
+        item = self._items.get(key)
+        if item is None:
+            self._row[self.MISSES] += 1
+            return None
+        self._row[self.HITS] += 1
+        self._items.move_to_end(key)
+        return copy.copy(item[0])
+
+    def put(self, key, atomic_data: AtomicData) -> None:
+        size = self.size_of(atomic_data)
+        if key in self._items or size > self.max_bytes:
+            return
+        while self.num_bytes + size > self.max_bytes:
+            _, (_, evicted_size) = self._items.popitem(last=False)
+            self.num_bytes -= evicted_size
+        self._items[key] = (copy.copy(atomic_data), size)
+        self.num_bytes += size
+        self._row[self.BYTES] = self.num_bytes
+
+    def statistics(self) -> Dict[str, int]:
+        """Hits, misses and cached bytes, summed over the main process and workers"""
+        hits, misses, num_bytes = self.counters.sum(dim=0).tolist()
+        return {"hits": hits, "misses": misses, "bytes": num_bytes}
+
+    def reset_statistics(self) -> None:
+        """Reset the hits and misses of all processes (not the cached bytes)"""
+        self.counters[:, [self.HITS, self.MISSES]] = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}(items={len(self)}, "
+            f"bytes={self.num_bytes}/{self.max_bytes}, "
+            f"hits={self.hits}, misses={self.misses})"
+        )
+
+
+def get_dataset_caches(dataset) -> List[AtomicDataCache]:
+    """Distinct caches of the HDF5 datasets in dataset (a concatenation or subset)"""
+    if isinstance(dataset, ConcatDataset):
+        datasets = dataset.datasets
+    elif isinstance(dataset, torch.utils.data.Subset):
+        datasets = [dataset.dataset]
+    else:
+        cache = getattr(dataset, "cache", None)
+        return [] if cache is None else [cache]
+    caches = []
+    for child in datasets:
+        for cache in get_dataset_caches(child):
+            if all(cache is not other for other in caches):
+                caches.append(cache)
+    return caches
+
+
+def log_cache_statistics(dataset, description: str, log: bool = True) -> None:
+    """Log (if log) and reset the hit and miss counts of the caches of dataset"""
+    for cache in get_dataset_caches(dataset):
+        stats = cache.statistics()
+        lookups = stats["hits"] + stats["misses"]
+        if log and lookups > 0:
+            logging.info(
+                f"{description} cache: {stats['hits']} hits, {stats['misses']} misses "
+                f"({100 * stats['hits'] / lookups:.1f}% hit rate), "
+                f"{stats['bytes'] / 1024**2:.1f} MB cached"
+            )
+        cache.reset_statistics()
+
+
 class HDF5Dataset(Dataset):
-    def __init__(self, file_path, r_max, z_table, **kwargs):
+    # Columns of the columnar layout that are sliced from the file rather than cached
+    PER_ATOM_KEYS = ("atomic_numbers", "positions", "forces", "charges")
+    PER_EDGE_KEYS = ("edge_index", "unit_shifts")
+
+    def __init__(
+        self,
+        file_path,
+        r_max,
+        z_table,
+        cache_size: int = 0,
+        metadata: Optional[Dict] = None,
+        **kwargs,
+    ):
         super(HDF5Dataset, self).__init__()  # pylint: disable=super-with-arguments
         self.file_path = file_path
         self._file = None
-        batch_key = list(self.file.keys())[0]
-        self.batch_size = len(self.file[batch_key].keys())
-        self.length = len(self.file.keys()) * self.batch_size
+        self._columns = None
+        # Built AtomicData are kept in memory up to cache_size bytes
+        self.cache = AtomicDataCache(cache_size) if cache_size > 0 else None
+        # With the metadata of a manifest, the file is only opened on first access
+        if metadata is None:
+            metadata = get_shard_metadata(self.file)
+        self.columnar = metadata["format"] == "columnar"
+        self.batch_size = metadata["batch_size"]
+        self.length = metadata["num_configs"]
+        self.drop_last = metadata["drop_last"]
         self.r_max = r_max
         self.z_table = z_table
-        try:
-            self.drop_last = bool(self.file.attrs["drop_last"])
-        except KeyError:
-            self.drop_last = False
+        # Graphs stored by preprocess_data are only valid for the cutoff they were built with
+        graph_r_max = metadata["r_max"]
+        self.use_stored_graphs = bool(
+            graph_r_max is not None
+            and r_max is not None
+            and np.isclose(graph_r_max, r_max)
+        )
         self.kwargs = kwargs
 
     @property
@@ -36,17 +188,166 @@ class HDF5Dataset(Dataset):
             self._file = h5py.File(self.file_path, "r")
         return self._file
 
+    @property
+    def columns(self):
+        # Per-config columns of a columnar file (offsets, energies, weights, ...) are
+        # small, so they are read once and kept in memory; per-atom and per-edge
+        # columns are sliced from the file on access
+        if self._columns is None:
+            self._columns = {
+                key: value[()]
+                for key, value in self.file.items()
+                if key not in self.PER_ATOM_KEYS + self.PER_EDGE_KEYS
+            }
+            for key in ("head", "config_type"):
+                self._columns[key + "_vocabulary"] = [
+                    unpack_value(value)
+                    for value in self.file[key].attrs["vocabulary"]
+                ]
+        return self._columns
+
     def __getstate__(self):
         _d = dict(self.__dict__)
 
         # An opened h5py.File cannot be pickled, so we must exclude it from the state
         _d["_file"] = None
+        _d["_columns"] = None
         return _d
 
     def __len__(self):
         return self.length
 
+    def get_sizes(self) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """
+        Numbers of atoms and of edges of the configurations, without building them.
+        Numbers of edges are None unless the graphs stored in the file are used.
+        """
+        num_atoms, num_edges = load_shard_sizes(self.file_path)
+        return num_atoms, num_edges if self.use_stored_graphs else None
+
+    def get_config(self, index):
+        """Configuration stored at index, with its stored neighborhood (or None)"""
+        if self.columnar:
+            config, neighborhood = self._get_columnar_config(index)
+        else:
+            config, neighborhood = self._get_grouped_config(index)
+        if config.head is None:
+            config.head = self.kwargs.get("head")
+        return config, neighborhood
+
     def __getitem__(self, index):
+        if self.cache is None:
+            return self._to_atomic_data(*self.get_config(index))
+        key = (self.file_path, index)
+        atomic_data = self.cache.get(key)
+        if atomic_data is None:
+            atomic_data = self._to_atomic_data(*self.get_config(index))
+            self.cache.put(key, atomic_data)
+        return atomic_data
+
+    def __getitems__(self, indices):
+        """
+        Batched version of __getitem__, used by the DataLoader when given a batch sampler.
+        For the columnar layout, each run of consecutive indices is read with one call
+        per column.
+        """
+        if not self.columnar:
+            return [self[index] for index in indices]
+        atomic_data = {}
+        if self.cache is not None:
+            for index in set(indices):
+                cached = self.cache.get((self.file_path, index))
+                if cached is not None:
+                    atomic_data[index] = cached
+        missing = np.unique([index for index in indices if index not in atomic_data])
+        runs = np.split(missing, np.flatnonzero(np.diff(missing) > 1) + 1)
+        for run in runs:
+            if len(run) == 0:
+                continue
+            block = self._read_columnar_block(run[0], run[-1] + 1)
+            for index in run.tolist():
+                atomic_data[index] = self._to_atomic_data(
+                    *self._get_columnar_config(index, block)
+                )
+                if self.cache is not None:
+                    self.cache.put((self.file_path, index), atomic_data[index])
+        return [atomic_data[index] for index in indices]
+
+    def _to_atomic_data(self, config, neighborhood):
+        return AtomicData.from_config(
+            config,
+            z_table=self.z_table,
+            cutoff=self.r_max,
+            heads=self.kwargs.get("heads", ["Default"]),
+            neighborhood=neighborhood,
+        )
+
+    def _read_columnar_block(self, start, stop):
+        # Per-atom (and per-edge) columns of configurations start, ..., stop - 1
+        columns = self.columns
+        node_ptr = columns["node_ptr"]
+        block = {"node_offset": node_ptr[start]}
+        nodes = slice(node_ptr[start], node_ptr[stop])
+        for key in self.PER_ATOM_KEYS:
+            if key in self.file:
+                block[key] = self.file[key][nodes]
+        if self.use_stored_graphs:
+            edge_ptr = columns["edge_ptr"]
+            block["edge_offset"] = edge_ptr[start]
+            edges = slice(edge_ptr[start], edge_ptr[stop])
+            block["edge_index"] = self.file["edge_index"][:, edges]
+            block["unit_shifts"] = self.file["unit_shifts"][edges]
+        return block
+
+    def _get_columnar_config(self, index, block=None):
+        columns = self.columns
+        if block is None:
+            block = self._read_columnar_block(index, index + 1)
+        node_ptr, node_offset = columns["node_ptr"], block["node_offset"]
+        nodes = slice(node_ptr[index] - node_offset, node_ptr[index + 1] - node_offset)
+
+        def get(key, rows=None):
+            if key + "_mask" in columns and not columns[key + "_mask"][index]:
+                return None
+            if rows is not None:
+                return block[key][rows] if key in block else None
+            return columns[key][index] if key in columns else None
+
+        config = Configuration(
+            atomic_numbers=get("atomic_numbers", nodes),
+            positions=get("positions", nodes),
+            energy=get("energy"),
+            forces=get("forces", nodes),
+            stress=get("stress"),
+            virials=get("virials"),
+            dipole=get("dipole"),
+            charges=get("charges", nodes),
+            weight=get("weight"),
+            # As for the grouped layout, the head given to the dataset takes precedence
+            head=None
+            if "head" in self.kwargs
+            else columns["head_vocabulary"][columns["head"][index]],
+            energy_weight=get("energy_weight"),
+            forces_weight=get("forces_weight"),
+            stress_weight=get("stress_weight"),
+            virials_weight=get("virials_weight"),
+            config_type=columns["config_type_vocabulary"][columns["config_type"][index]],
+            pbc=get("pbc"),
+            cell=get("cell"),
+        )
+        neighborhood = None
+        if self.use_stored_graphs:
+            edge_ptr, edge_offset = columns["edge_ptr"], block["edge_offset"]
+            edges = slice(edge_ptr[index] - edge_offset, edge_ptr[index + 1] - edge_offset)
+            unit_shifts = block["unit_shifts"][edges]
+            neighborhood = (
+                block["edge_index"][:, edges],
+                get_shifts(unit_shifts, pbc=config.pbc, cell=config.cell),
+                unit_shifts,
+            )
+        return config, neighborhood
+
+    def _get_grouped_config(self, index):
         # compute the index of the batch
         batch_index = index // self.batch_size
         config_index = index % self.batch_size
@@ -71,24 +372,46 @@ class HDF5Dataset(Dataset):
             pbc=unpack_value(subgrp["pbc"][()]),
             cell=unpack_value(subgrp["cell"][()]),
         )
-        if config.head is None:
-            config.head = self.kwargs.get("head")
-        try:
-            atomic_data = AtomicData.from_config(
-                config,
-                z_table=self.z_table,
-                cutoff=self.r_max,
-                heads=self.kwargs.get("heads", ["Default"]),
+        neighborhood = None
+        if self.use_stored_graphs:
+            unit_shifts = subgrp["unit_shifts"][()]
+            neighborhood = (
+                subgrp["edge_index"][()],
+                get_shifts(unit_shifts, pbc=config.pbc, cell=config.cell),
+                unit_shifts,
             )
-        except:
-            import ipdb; ipdb.set_trace()
-        return atomic_data
+        return config, neighborhood
+
+
+class ShardedConcatDataset(ConcatDataset):
+    """ConcatDataset forwarding batched reads (__getitems__) to the datasets it concatenates"""
+
+    def __getitems__(self, indices):
+        indices = np.asarray(indices)
+        dataset_indices = np.searchsorted(self.cumulative_sizes, indices, side="right")
+        offsets = np.concatenate([[0], self.cumulative_sizes])
+        items = [None] * len(indices)
+        for dataset_index in np.unique(dataset_indices):
+            positions = np.flatnonzero(dataset_indices == dataset_index)
+            dataset = self.datasets[dataset_index]
+            local_indices = (indices[positions] - offsets[dataset_index]).tolist()
+            if hasattr(dataset, "__getitems__"):
+                dataset_items = dataset.__getitems__(local_indices)
+            else:
+                dataset_items = [dataset[index] for index in local_indices]
+            for position, item in zip(positions, dataset_items):
+                items[position] = item
+        return items
 
 
 def dataset_from_sharded_hdf5(
-    files: List, z_table: AtomicNumberTable, r_max: float, **kwargs
+    files: List, z_table: AtomicNumberTable, r_max: float, cache_size: int = 0, **kwargs
 ):
-    files = glob(files + "/*")
+    if is_mmap_dataset(files):
+        return MmapDataset(files, z_table=z_table, r_max=r_max, **kwargs)
+    manifest = read_manifest(files)
+    shards = manifest["shards"] if manifest is not None else {}
+    files = list_shards(files)
     datasets = []
 
     if 'rank' not in kwargs or ('rank' in kwargs and kwargs['rank'] == 0):
@@ -97,8 +420,22 @@ def dataset_from_sharded_hdf5(
         it = files
 
     for file in it:
-        datasets.append(HDF5Dataset(file, z_table=z_table, r_max=r_max, **kwargs))
-    full_dataset = ConcatDataset(datasets)
+        if is_mmap_dataset(file):
+            datasets.append(MmapDataset(file, z_table=z_table, r_max=r_max, **kwargs))
+        else:
+            metadata = shards.get(os.path.basename(file))
+            datasets.append(
+                HDF5Dataset(
+                    file, z_table=z_table, r_max=r_max, metadata=metadata, **kwargs
+                )
+            )
+    if cache_size > 0:
+        # One budget for all the shards of the dataset
+        cache = AtomicDataCache(cache_size)
+        for dataset in datasets:
+            if isinstance(dataset, HDF5Dataset):
+                dataset.cache = cache
+    full_dataset = ShardedConcatDataset(datasets)
     return full_dataset
 
 
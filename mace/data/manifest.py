@@ -0,0 +1,197 @@
+import json
+import os
+from glob import glob
+from typing import Dict, List, Optional, Tuple
+
+import h5py
+import numpy as np
+
+MANIFEST_FILE = "manifest.json"
+# Numbers of atoms and edges of every configuration of the shards of a directory
+SIZES_FILE = "sizes.npz"
+
+
+def list_shards(directory: str) -> List[str]:
+    """Paths of the shards in a directory of shards, without its manifest"""
+    return sorted(
+        path
+        for path in glob(os.path.join(directory, "*"))
+        if os.path.basename(path) not in (MANIFEST_FILE, SIZES_FILE)
+    )
+
+
+def get_shard_metadata(h5_file: h5py.File) -> Dict:
+    """What HDF5Dataset needs to know about a file before reading from it"""
+    if h5_file.attrs.get("format") == "columnar":
+        h5_format = "columnar"
+        batch_size = None
+        num_configs = int(h5_file.attrs["num_configs"])
+        r_max = h5_file.attrs.get("r_max")
+    else:
+        h5_format = "grouped"
+        batch_key = list(h5_file.keys())[0]
+        batch_size = len(h5_file[batch_key].keys())
+        num_configs = len(h5_file.keys()) * batch_size
+        r_max = h5_file[batch_key].attrs.get("r_max")
+    return {
+        "format": h5_format,
+        "num_configs": num_configs,
+        "batch_size": batch_size,
+        "drop_last": bool(h5_file.attrs.get("drop_last", False)),
+        "r_max": None if r_max is None else float(r_max),
+    }
+
+
+def grouped_configs(h5_file: h5py.File) -> List[h5py.Group]:
+    """Groups of the configurations of a file in the grouped layout, in index order"""
+    batches = [h5_file[f"config_batch_{i}"] for i in range(len(h5_file.keys()))]
+    return [batch[f"config_{j}"] for batch in batches for j in range(len(batch.keys()))]
+
+
+def _decode(value) -> Optional[str]:
+    value = value.decode("utf-8") if isinstance(value, bytes) else str(value)
+    return None if value == "None" else value
+
+
+def summarize_shard(file_path: str) -> Dict:
+    """Metadata of an HDF5 shard, with its numbers of atoms and edges, heads and elements"""
+    with h5py.File(file_path, "r") as f:
+        summary = get_shard_metadata(f)
+        if summary["format"] == "columnar":
+            num_atoms = int(f["node_ptr"][-1])
+            num_edges = int(f["edge_ptr"][-1]) if "edge_ptr" in f else None
+            elements = np.unique(f["atomic_numbers"][()])
+            heads = {
+                _decode(f["head"].attrs["vocabulary"][code])
+                for code in np.unique(f["head"][()])
+            }
+        else:
+            num_atoms, num_edges = 0, 0
+            elements, heads = set(), set()
+            for batch in f.values():
+                for config in batch.values():
+                    atomic_numbers = config["atomic_numbers"][()]
+                    num_atoms += len(atomic_numbers)
+                    elements.update(atomic_numbers.tolist())
+                    heads.add(_decode(config["head"][()]) if "head" in config else None)
+                    if num_edges is not None and "edge_index" in config:
+                        num_edges += config["edge_index"].shape[1]
+                    else:
+                        num_edges = None
+    summary.update(
+        num_atoms=num_atoms,
+        num_edges=num_edges,
+        heads=sorted(head for head in heads if head is not None),
+        elements=sorted(int(z) for z in elements),
+    )
+    return summary
+
+
+def read_shard_sizes(file_path: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Numbers of atoms and of edges of the configurations of an HDF5 shard, read
+    without their data. Numbers of edges are None unless the shard stores graphs.
+    """
+    with h5py.File(file_path, "r") as f:
+        if f.attrs.get("format") == "columnar":
+            num_atoms = np.diff(f["node_ptr"][()])
+            num_edges = np.diff(f["edge_ptr"][()]) if "edge_ptr" in f else None
+            return num_atoms, num_edges
+        configs = grouped_configs(f)
+        num_atoms = np.array(
+            [config["atomic_numbers"].shape[0] for config in configs], dtype=np.int64
+        )
+        if not all("edge_index" in config for config in configs):
+            return num_atoms, None
+        num_edges = np.array(
+            [config["edge_index"].shape[1] for config in configs], dtype=np.int64
+        )
+    return num_atoms, num_edges
+
+
+def _stat_key(stat: os.stat_result) -> np.ndarray:
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def load_shard_sizes(file_path: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Numbers of atoms and of edges of the configurations of a shard, from the sizes
+    written with the manifest of its directory if the shard has not changed since
+    """
+    sizes_path = os.path.join(os.path.dirname(file_path), SIZES_FILE)
+    name = os.path.basename(file_path)
+    if os.path.isfile(sizes_path):
+        with np.load(sizes_path) as sizes:
+            if f"{name}:stat" in sizes and np.array_equal(
+                sizes[f"{name}:stat"], _stat_key(os.stat(file_path))
+            ):
+                num_edges = sizes.get(f"{name}:num_edges")
+                return sizes[f"{name}:num_atoms"], num_edges
+    return read_shard_sizes(file_path)
+
+
+def write_manifest(directory: str, r_max: Optional[float] = None) -> Dict:
+    """
+    Write a manifest of the HDF5 shards of a directory, so that datasets over the
+    directory can be built without opening every shard, and the numbers of atoms and
+    edges of their configurations. Shards listed in the existing manifest with the
+    same size and modification time are not summarized again.
+    """
+    previous = read_manifest(directory) or {}
+    sizes_path = os.path.join(directory, SIZES_FILE)
+    previous_sizes = {}
+    if os.path.isfile(sizes_path):
+        with np.load(sizes_path) as sizes:
+            previous_sizes = dict(sizes)
+    shards, sizes = {}, {}
+    for path in list_shards(directory):
+        if not path.endswith(".h5"):
+            continue
+        name, stat = os.path.basename(path), os.stat(path)
+        summary = previous.get("shards", {}).get(name)
+        # Shards that are unchanged since the previous manifest are not read again
+        if summary is None or (summary.get("size"), summary.get("mtime_ns")) != (
+            stat.st_size,
+            stat.st_mtime_ns,
+        ):
+            summary = summarize_shard(path)
+            summary.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        shards[name] = summary
+        if f"{name}:stat" in previous_sizes and np.array_equal(
+            previous_sizes[f"{name}:stat"], _stat_key(stat)
+        ):
+            for key in ("stat", "num_atoms", "num_edges"):
+                if f"{name}:{key}" in previous_sizes:
+                    sizes[f"{name}:{key}"] = previous_sizes[f"{name}:{key}"]
+        else:
+            num_atoms, num_edges = read_shard_sizes(path)
+            sizes[f"{name}:stat"] = _stat_key(stat)
+            sizes[f"{name}:num_atoms"] = num_atoms
+            if num_edges is not None:
+                sizes[f"{name}:num_edges"] = num_edges
+    edge_counts = [shard["num_edges"] for shard in shards.values()]
+    manifest = {
+        "r_max": r_max,
+        "num_configs": sum(shard["num_configs"] for shard in shards.values()),
+        "num_atoms": sum(shard["num_atoms"] for shard in shards.values()),
+        "num_edges": None if None in edge_counts else sum(edge_counts),
+        "heads": sorted({head for shard in shards.values() for head in shard["heads"]}),
+        "elements": sorted(
+            {z for shard in shards.values() for z in shard["elements"]}
+        ),
+        "shards": shards,
+    }
+    with open(os.path.join(directory, MANIFEST_FILE), "w") as f:  # pylint: disable=W1514
+        json.dump(manifest, f, indent=2)
+    # Written to a temporary file first, as np.savez appends .npz to other names
+    np.savez(sizes_path + ".part.npz", **sizes)
+    os.replace(sizes_path + ".part.npz", sizes_path)
+    return manifest
+
+
+def read_manifest(directory: str) -> Optional[Dict]:
+    path = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:  # pylint: disable=W1514
+        return json.load(f)
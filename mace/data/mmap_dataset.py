@@ -0,0 +1,253 @@
+import json
+import os
+import shutil
+from typing import Optional, Tuple
+
+import numpy as np
+from torch.utils.data import Dataset
+
+from mace.data.atomic_data import AtomicData
+from mace.data.manifest import list_shards
+from mace.data.neighborhood import get_shifts
+from mace.data.statistics import dataset_fingerprint
+from mace.data.utils import Configuration, Configurations, configurations_to_columns
+from mace.tools.utils import AtomicNumberTable
+
+METADATA_FILE = "metadata.json"
+
+
+def save_configurations_as_mmap(
+    configurations: Configurations,
+    out_dir: str,
+    r_max: Optional[float] = None,
+    dtype: str = "float64",
+    drop_last: bool = False,
+) -> None:
+    """
+    Save configurations as one .npy file per column of `configurations_to_columns`,
+    with floating point columns in dtype and indices in int64, so that MmapDataset only
+    copies the rows of the mapped files, without conversion.
+    """
+    columns, vocabularies = configurations_to_columns(configurations, r_max=r_max)
+    os.makedirs(out_dir, exist_ok=True)
+    for key, column in columns.items():
+        if key == "edge_index":
+            column = column.astype(np.int64)
+        elif key == "unit_shifts" or np.issubdtype(column.dtype, np.floating):
+            column = column.astype(dtype)
+        np.save(os.path.join(out_dir, key + ".npy"), column)
+    metadata = {
+        "num_configs": len(configurations),
+        "r_max": r_max,
+        "dtype": dtype,
+        "drop_last": drop_last,
+        "vocabularies": vocabularies,
+    }
+    with open(os.path.join(out_dir, METADATA_FILE), "w") as f:  # pylint: disable=W1514
+        json.dump(metadata, f)
+
+
+def convert_hdf5_to_mmap(
+    file_path: str,
+    out_dir: str,
+    r_max: Optional[float] = None,
+    dtype: str = "float64",
+) -> None:
+    """Convert an HDF5 file written by preprocess_data (either layout) to MmapDataset files"""
+    from mace.data.hdf5_dataset import (  # pylint: disable=import-outside-toplevel
+        HDF5Dataset,
+    )
+
+    dataset = HDF5Dataset(file_path, r_max=None, z_table=None)
+    configurations = [dataset.get_config(i)[0] for i in range(len(dataset))]
+    save_configurations_as_mmap(
+        configurations,
+        out_dir,
+        r_max=r_max,
+        dtype=dtype,
+        drop_last=dataset.drop_last,
+    )
+
+
+def is_mmap_dataset(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, METADATA_FILE))
+
+
+def shared_memory_path(
+    path: str,
+    r_max: Optional[float] = None,
+    dtype: str = "float64",
+    shm_dir: str = "/dev/shm",
+) -> str:
+    """
+    Location in shm_dir of the copy of path made by `stage_to_shared_memory`. It only
+    depends on its arguments and on the sizes and modification times of the files at
+    path, so that all the processes of a node agree on it without communicating, and
+    a copy left by another run is only reused if no file changed since.
+    """
+    digest = dataset_fingerprint([path], r_max=r_max, dtype=dtype)[:16]
+    return os.path.join(shm_dir, f"mace_{digest}")
+
+
+def stage_to_shared_memory(
+    path: str,
+    r_max: Optional[float] = None,
+    dtype: str = "float64",
+    shm_dir: str = "/dev/shm",
+) -> str:
+    """
+    Copy the preprocessed dataset at path (an HDF5 file, an MmapDataset directory, or a
+    directory of either) to shm_dir as MmapDataset files, unless this was already done.
+    shm_dir is backed by shared memory, so the MmapDatasets of every rank and DataLoader
+    worker of the node map the same pages. Returns the path of the copy.
+    """
+    target = shared_memory_path(path, r_max=r_max, dtype=dtype, shm_dir=shm_dir)
+    if os.path.exists(target):
+        return target
+    staging = f"{target}.{os.getpid()}"
+    if is_mmap_dataset(path):
+        shutil.copytree(path, staging)
+    elif os.path.isdir(path):
+        for file in list_shards(path):
+            name = os.path.splitext(os.path.basename(file))[0]
+            if is_mmap_dataset(file):
+                shutil.copytree(file, os.path.join(staging, name))
+            else:
+                convert_hdf5_to_mmap(
+                    file, os.path.join(staging, name), r_max=r_max, dtype=dtype
+                )
+    else:
+        convert_hdf5_to_mmap(path, staging, r_max=r_max, dtype=dtype)
+    try:
+        os.rename(staging, target)
+    except OSError:
+        # Staged concurrently by another job
+        shutil.rmtree(staging)
+    return target
+
+
+class MmapDataset(Dataset):
+    """
+    Dataset backed by memory-mapped .npy files written by `save_configurations_as_mmap`.
+    The files are mapped read-only, so the page cache is shared between all DataLoader
+    workers and ranks on a node. Items are built by AtomicData.from_config, as for
+    HDF5Dataset, so their tensors are copies of the mapped rows: they can be modified in
+    place without reaching the files.
+    """
+
+    def __init__(self, path, r_max, z_table: AtomicNumberTable, **kwargs):
+        super().__init__()
+        self.path = path
+        self.r_max = r_max
+        self.z_table = z_table
+        self._columns = None
+        with open(os.path.join(path, METADATA_FILE)) as f:  # pylint: disable=W1514
+            self.metadata = json.load(f)
+        self.length = self.metadata["num_configs"]
+        self.drop_last = self.metadata["drop_last"]
+        # Graphs stored by preprocess_data are only valid for the cutoff they were built with
+        graph_r_max = self.metadata["r_max"]
+        self.use_stored_graphs = bool(
+            graph_r_max is not None
+            and r_max is not None
+            and np.isclose(graph_r_max, r_max)
+        )
+        self.kwargs = kwargs
+
+    @property
+    def columns(self):
+        if self._columns is None:
+            # Read-only mapping: pages are shared with the page cache
+            self._columns = {
+                os.path.splitext(name)[0]: np.load(
+                    os.path.join(self.path, name), mmap_mode="r"
+                )
+                for name in os.listdir(self.path)
+                if name.endswith(".npy")
+            }
+        return self._columns
+
+    def __getstate__(self):
+        _d = dict(self.__dict__)
+
+        # Memory maps would be pickled as copies of the data, so each process maps the
+        # files itself
+        _d["_columns"] = None
+        return _d
+
+    def __len__(self):
+        return self.length
+
+    def get_sizes(self) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """
+        Numbers of atoms and of edges of the configurations, without building them.
+        Numbers of edges are None unless the stored graphs are used.
+        """
+        columns = self.columns
+        num_atoms = np.diff(columns["node_ptr"])
+        if not self.use_stored_graphs or "edge_ptr" not in columns:
+            return num_atoms, None
+        return num_atoms, np.diff(columns["edge_ptr"])
+
+    def _get(self, key, index, rows=None):
+        # Rows of column key for configuration index (all its atoms if rows is given)
+        columns = self.columns
+        if key not in columns:
+            return None
+        if key + "_mask" in columns and not columns[key + "_mask"][index]:
+            return None
+        return columns[key][index if rows is None else rows]
+
+    def get_config(self, index):
+        """Configuration stored at index, with its stored neighborhood (or None)"""
+        columns = self.columns
+        node_ptr = columns["node_ptr"]
+        nodes = slice(node_ptr[index], node_ptr[index + 1])
+
+        def vocabulary_value(key):
+            value = self.metadata["vocabularies"][key][columns[key][index]]
+            return None if value == "None" else value
+
+        config = Configuration(
+            atomic_numbers=self._get("atomic_numbers", index, nodes),
+            positions=self._get("positions", index, nodes),
+            energy=self._get("energy", index),
+            forces=self._get("forces", index, nodes),
+            stress=self._get("stress", index),
+            virials=self._get("virials", index),
+            dipole=self._get("dipole", index),
+            charges=self._get("charges", index, nodes),
+            weight=self._get("weight", index),
+            # As for HDF5Dataset, the head given to the dataset takes precedence
+            head=None if "head" in self.kwargs else vocabulary_value("head"),
+            energy_weight=self._get("energy_weight", index),
+            forces_weight=self._get("forces_weight", index),
+            stress_weight=self._get("stress_weight", index),
+            virials_weight=self._get("virials_weight", index),
+            config_type=vocabulary_value("config_type"),
+            pbc=self._get("pbc", index),
+            cell=self._get("cell", index),
+        )
+        if config.head is None:
+            config.head = self.kwargs.get("head")
+        neighborhood = None
+        if self.use_stored_graphs:
+            edge_ptr = columns["edge_ptr"]
+            edges = slice(edge_ptr[index], edge_ptr[index + 1])
+            unit_shifts = columns["unit_shifts"][edges]
+            neighborhood = (
+                columns["edge_index"][:, edges],
+                get_shifts(unit_shifts, pbc=config.pbc, cell=config.cell),
+                unit_shifts,
+            )
+        return config, neighborhood
+
+    def __getitem__(self, index):
+        config, neighborhood = self.get_config(index)
+        return AtomicData.from_config(
+            config,
+            z_table=self.z_table,
+            cutoff=self.r_max,
+            heads=self.kwargs.get("heads", ["Default"]),
+            neighborhood=neighborhood,
+        )
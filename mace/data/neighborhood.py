@@ -1,4 +1,4 @@
-from typing import Optional, Tuple
+from typing import List, Optional, Sequence, Tuple
 
 import numpy as np
 from matscipy.neighbours import neighbour_list
@@ -63,3 +63,177 @@ def get_neighborhood(
     shifts = np.dot(unit_shifts, cell)  # [n_edges, 3]
 
     return edge_index, shifts, unit_shifts
+
+
+def get_shifts(
+    unit_shifts: np.ndarray,  # [n_edges, 3]
+    pbc: Optional[Tuple[bool, bool, bool]] = None,
+    cell: Optional[np.ndarray] = None,  # [3, 3]
+) -> np.ndarray:
+    """Shift vectors of stored unit shifts, with the cell conventions of `get_neighborhood`"""
+    if pbc is None:
+        pbc = (False, False, False)
+    if cell is None or not cell.any():
+        cell = np.identity(3, dtype=float)
+    cell = np.array(cell, dtype=float)
+    # Unit shifts are zero along non-periodic directions, where `get_neighborhood`
+    # replaces the cell by a (large) diagonal one
+    for i in range(3):
+        if not pbc[i]:
+            cell[:, i] = 0.0
+    return np.dot(unit_shifts, cell)  # [n_edges, 3]
+
+
+def get_neighborhoods(
+    positions: Sequence[np.ndarray],  # [n_structures][num_positions, 3]
+    cutoff: float,
+    pbc: Optional[Sequence[Optional[Tuple[bool, bool, bool]]]] = None,
+    cell: Optional[Sequence[Optional[np.ndarray]]] = None,  # [n_structures][3, 3]
+    true_self_interaction=False,
+) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Batched version of `get_neighborhood` returning one (edge_index, shifts, unit_shifts)
+    tuple per structure. All non-periodic structures are packed into a single open box,
+    each in its own slot separated by more than the cutoff, so that a single
+    neighbour list call serves all of them. Periodic structures are treated one by one.
+    """
+    n_structures = len(positions)
+    if pbc is None:
+        pbc = [None] * n_structures
+    if cell is None:
+        cell = [None] * n_structures
+    assert len(pbc) == n_structures and len(cell) == n_structures
+
+    neighborhoods: List[Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]] = [
+        None
+    ] * n_structures
+    molecules = []
+    for i in range(n_structures):
+        if pbc[i] is None or not any(pbc[i]):
+            molecules.append(i)
+        else:
+            neighborhoods[i] = get_neighborhood(
+                positions=positions[i],
+                cutoff=cutoff,
+                pbc=pbc[i],
+                cell=None if cell[i] is None else np.array(cell[i], dtype=float),
+                true_self_interaction=true_self_interaction,
+            )
+
+    if len(molecules) > 0:
+        for i, edge_index in zip(
+            molecules,
+            _get_open_neighborhoods(
+                [np.asarray(positions[i], dtype=float) for i in molecules],
+                cutoff=cutoff,
+                true_self_interaction=true_self_interaction,
+            ),
+        ):
+            num_edges = edge_index.shape[1]
+            neighborhoods[i] = (
+                edge_index,
+                np.zeros((num_edges, 3), dtype=float),
+                np.zeros((num_edges, 3), dtype=edge_index.dtype),
+            )
+
+    return neighborhoods
+
+
+def _get_open_neighborhoods(
+    positions: List[np.ndarray], cutoff: float, true_self_interaction: bool
+) -> List[np.ndarray]:
+    num_atoms = np.array([len(p) for p in positions])
+    ptr = np.concatenate([[0], np.cumsum(num_atoms)])
+    all_positions = np.concatenate(positions, axis=0).reshape(-1, 3)
+    structure = np.repeat(np.arange(len(positions)), num_atoms)
+
+    # Move every structure to the corner of its own cubic slot in a 3D grid of slots
+    lower = np.full((len(positions), 3), np.inf)
+    upper = np.full((len(positions), 3), -np.inf)
+    np.minimum.at(lower, structure, all_positions)
+    np.maximum.at(upper, structure, all_positions)
+    slot_size = np.max(upper - lower, initial=0.0) + 2 * cutoff + 1.0
+    grid_size = int(np.ceil(len(positions) ** (1 / 3)))
+    slots = np.stack(
+        np.unravel_index(np.arange(len(positions)), (grid_size,) * 3), axis=-1
+    )
+    all_positions = all_positions + (slots * slot_size - lower)[structure]
+
+    sender, receiver = neighbour_list(
+        quantities="ij",
+        pbc=(False, False, False),
+        cell=np.identity(3) * grid_size * slot_size,
+        positions=all_positions,
+        cutoff=cutoff,
+    )
+    if not true_self_interaction:
+        keep_edge = sender != receiver
+        sender = sender[keep_edge]
+        receiver = receiver[keep_edge]
+
+    # Edges come sorted by sender, hence grouped by structure
+    edge_index = np.stack((sender, receiver)) - ptr[structure[sender]].astype(
+        sender.dtype
+    )
+    return np.split(edge_index, np.searchsorted(sender, ptr[1:-1]), axis=1)
+
+
+class VerletNeighborhood:
+    """
+    Neighbour list with a Verlet skin, reused across calls (e.g. MD steps). The list is
+    built with cutoff + skin and only rebuilt when an atom has moved by more than
+    skin / 2, or when the cell, pbc or number of atoms changed. On every call the
+    edges longer than the cutoff are dropped, so the returned neighbourhood is the one
+    `get_neighborhood` would return, up to the order of the edges.
+    """
+
+    def __init__(self, cutoff: float, skin: float):
+        assert skin > 0.0
+        self.cutoff = cutoff
+        self.skin = skin
+        self.num_builds = 0
+        self._positions = None
+        self._pbc = None
+        self._cell = None
+        self._edge_index = None
+        self._unit_shifts = None
+
+    def _needs_rebuild(self, positions, pbc, cell) -> bool:
+        if self._positions is None or positions.shape != self._positions.shape:
+            return True
+        if not np.array_equal(pbc, self._pbc) or not np.array_equal(cell, self._cell):
+            return True
+        displacements = np.sum(np.square(positions - self._positions), axis=1)
+        return bool(np.max(displacements, initial=0.0) > (self.skin / 2) ** 2)
+
+    def get_neighborhood(
+        self,
+        positions: np.ndarray,  # [num_positions, 3]
+        pbc: Optional[Tuple[bool, bool, bool]] = None,
+        cell: Optional[np.ndarray] = None,  # [3, 3]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if pbc is None:
+            pbc = (False, False, False)
+        if cell is None:
+            cell = np.zeros((3, 3))
+        if self._needs_rebuild(positions, pbc, cell):
+            self._edge_index, _, self._unit_shifts = get_neighborhood(
+                positions=positions,
+                cutoff=self.cutoff + self.skin,
+                pbc=pbc,
+                cell=np.array(cell, dtype=float),
+            )
+            self._positions = np.array(positions, dtype=float)
+            self._pbc = np.array(pbc)
+            self._cell = np.array(cell, dtype=float)
+            self.num_builds += 1
+
+        shifts = get_shifts(self._unit_shifts, pbc=pbc, cell=cell)
+        sender, receiver = self._edge_index
+        vectors = positions[receiver] - positions[sender] + shifts
+        keep_edge = np.sum(np.square(vectors), axis=1) < self.cutoff**2
+        return (
+            self._edge_index[:, keep_edge],
+            shifts[keep_edge],
+            self._unit_shifts[keep_edge],
+        )
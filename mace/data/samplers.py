@@ -0,0 +1,366 @@
+import logging
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from torch.utils.data import ConcatDataset, Dataset, Sampler, Subset
+
+
+def get_shard_sizes(dataset: Dataset) -> List[int]:
+    """Lengths of the shards (leaf datasets) making up a, possibly nested, ConcatDataset"""
+    if isinstance(dataset, ConcatDataset):
+        return [size for d in dataset.datasets for size in get_shard_sizes(d)]
+    return [len(dataset)]
+
+
+def get_dataset_sizes(dataset: Dataset) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Numbers of atoms and of edges (None if unknown) of the graphs of a, possibly
+    nested, ConcatDataset. Datasets with a get_sizes method (HDF5Dataset and
+    MmapDataset) are not read; other datasets are lists of AtomicData.
+    """
+    if isinstance(dataset, ConcatDataset):
+        sizes = [get_dataset_sizes(d) for d in dataset.datasets]
+        num_atoms = np.concatenate([num_atoms for num_atoms, _ in sizes])
+        if any(num_edges is None for _, num_edges in sizes):
+            return num_atoms, None
+        return num_atoms, np.concatenate([num_edges for _, num_edges in sizes])
+    if isinstance(dataset, Subset):
+        num_atoms, num_edges = get_dataset_sizes(dataset.dataset)
+        indices = np.asarray(dataset.indices, dtype=np.int64)
+        return num_atoms[indices], None if num_edges is None else num_edges[indices]
+    if hasattr(dataset, "get_sizes"):
+        return dataset.get_sizes()
+    num_atoms = np.array([data.num_nodes for data in dataset], dtype=np.int64)
+    num_edges = np.array([data.edge_index.shape[1] for data in dataset], dtype=np.int64)
+    return num_atoms, num_edges
+
+
+def split_batches_over_replicas(
+    batches: List[np.ndarray], num_replicas: int, rank: int, drop_last: bool
+) -> List[np.ndarray]:
+    """
+    Batches of one rank, the same number for every rank: the batches left over are
+    dropped, or with drop_last=False the first batches are repeated to fill the ranks
+    """
+    if num_replicas == 1:
+        return batches
+    if drop_last or len(batches) == 0:
+        batches = batches[: len(batches) // num_replicas * num_replicas]
+    else:
+        padding = -len(batches) % num_replicas
+        batches = batches + (batches * padding)[:padding]
+    return batches[rank::num_replicas]
+
+
+class DynamicBatchSampler(Sampler[List[int]]):
+    """
+    Batch sampler packing graphs, in a new random order each epoch, into batches of at
+    most max_atoms atoms and max_edges edges, so that the memory used by a batch does
+    not depend on the sizes of its graphs. Graphs larger than the budgets make a
+    batch of their own. The sizes of the graphs are taken from the dataset (see
+    get_dataset_sizes) unless given.
+    With num_replicas > 1, every rank gets the same number of batches.
+    """
+
+    def __init__(
+        self,
+        dataset: Optional[Dataset],
+        max_atoms: Optional[int] = None,
+        max_edges: Optional[int] = None,
+        shuffle: bool = True,
+        drop_last: bool = False,
+        seed: int = 0,
+        num_replicas: int = 1,
+        rank: int = 0,
+        num_atoms: Optional[Sequence[int]] = None,
+        num_edges: Optional[Sequence[int]] = None,
+    ):
+        super().__init__(None)
+        if max_atoms is None and max_edges is None:
+            raise ValueError("At least one of max_atoms and max_edges must be given")
+        if num_atoms is None:
+            num_atoms, dataset_num_edges = get_dataset_sizes(dataset)
+            num_edges = dataset_num_edges if num_edges is None else num_edges
+        if max_edges is not None and num_edges is None:
+            raise ValueError(
+                "The numbers of edges of the graphs are unknown. Batching by edges "
+                "requires graphs stored by preprocess_data (--store_graphs) with the "
+                "same r_max, or in-memory datasets."
+            )
+        self.num_atoms = np.asarray(num_atoms, dtype=np.int64)
+        self.num_edges = None if max_edges is None else np.asarray(num_edges, np.int64)
+        self.max_atoms = max_atoms
+        self.max_edges = max_edges
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self._batches = None
+
+        oversized = np.zeros(len(self.num_atoms), dtype=bool)
+        if max_atoms is not None:
+            oversized |= self.num_atoms > max_atoms
+        if max_edges is not None:
+            oversized |= self.num_edges > max_edges
+        if oversized.any():
+            logging.warning(
+                f"{int(oversized.sum())} graphs exceed the batch budget "
+                f"(max_atoms={max_atoms}, max_edges={max_edges}), they are batched alone"
+            )
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def _all_batches(self) -> List[np.ndarray]:
+        # Packing is sequential, so the batches of an epoch are only packed once
+        if self._batches is not None and self._batches[0] == self.epoch:
+            return self._batches[1]
+        rng = np.random.default_rng(self.seed + self.epoch)
+        num_graphs = len(self.num_atoms)
+        order = rng.permutation(num_graphs) if self.shuffle else np.arange(num_graphs)
+
+        max_atoms = float("inf") if self.max_atoms is None else self.max_atoms
+        max_edges = float("inf") if self.max_edges is None else self.max_edges
+        num_atoms = self.num_atoms[order].tolist()
+        num_edges = (
+            [0] * num_graphs
+            if self.num_edges is None
+            else self.num_edges[order].tolist()
+        )
+        starts = []
+        batch_atoms, batch_edges = 0, 0
+        for i, (atoms, edges) in enumerate(zip(num_atoms, num_edges)):
+            if (
+                i == 0
+                or batch_atoms + atoms > max_atoms
+                or batch_edges + edges > max_edges
+            ):
+                starts.append(i)
+                batch_atoms, batch_edges = 0, 0
+            batch_atoms += atoms
+            batch_edges += edges
+        batches = np.split(order, starts[1:]) if num_graphs > 0 else []
+        if self.drop_last and len(batches) > 1:
+            # Only the last batch can be underfilled
+            batches = batches[:-1]
+        self._batches = (self.epoch, batches)
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        batches = split_batches_over_replicas(
+            self._all_batches(), self.num_replicas, self.rank, self.drop_last
+        )
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self) -> int:
+        return len(
+            split_batches_over_replicas(
+                self._all_batches(), self.num_replicas, self.rank, self.drop_last
+            )
+        )
+
+
+class BucketBatchSampler(Sampler[List[int]]):
+    """
+    Batch sampler drawing each batch from one of num_buckets classes of graphs of
+    similar sizes, the quantiles of their numbers of atoms (then edges). The padded
+    shape of a bucket is (batch_size + 1 graphs, batch_size times the size_quantile
+    quantile of its numbers of atoms + 1 nodes, batch_size times that of its numbers
+    of edges), so that padding batches to the shapes of their buckets (see
+    mace.tools.padding) gives about num_buckets tensor shapes. Taking a quantile rather
+    than the largest size keeps a few outliers from inflating the shape of the top
+    bucket; the rare batches that do not fit are padded to powers of two by
+    PaddingCollater instead. Graphs are shuffled within buckets and batches across
+    buckets each epoch.
+    With num_replicas > 1, every rank gets the same number of batches.
+    """
+
+    def __init__(
+        self,
+        dataset: Optional[Dataset],
+        batch_size: int,
+        num_buckets: int = 8,
+        shuffle: bool = True,
+        drop_last: bool = False,
+        seed: int = 0,
+        num_replicas: int = 1,
+        rank: int = 0,
+        num_atoms: Optional[Sequence[int]] = None,
+        num_edges: Optional[Sequence[int]] = None,
+        size_quantile: float = 0.99,
+    ):
+        super().__init__(None)
+        if num_atoms is None:
+            num_atoms, dataset_num_edges = get_dataset_sizes(dataset)
+            num_edges = dataset_num_edges if num_edges is None else num_edges
+        num_atoms = np.asarray(num_atoms, dtype=np.int64)
+        num_edges = None if num_edges is None else np.asarray(num_edges, np.int64)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+        sort_keys = (num_atoms,) if num_edges is None else (num_edges, num_atoms)
+        order = np.lexsort(sort_keys)
+        self.buckets = [
+            bucket
+            for bucket in np.array_split(order, min(num_buckets, len(order)))
+            if len(bucket) > 0
+        ]
+
+        def size(sizes: np.ndarray) -> int:
+            # Lower quantile, one of the sizes rather than an interpolation towards
+            # the outliers
+            return int(np.sort(sizes)[int(size_quantile * (len(sizes) - 1))])
+
+        self.padded_shapes = [
+            (
+                batch_size + 1,
+                batch_size * size(num_atoms[bucket]) + 1,
+                None if num_edges is None else batch_size * size(num_edges[bucket]),
+            )
+            for bucket in self.buckets
+        ]
+        self.log_statistics(num_atoms, num_edges)
+
+    def log_statistics(
+        self, num_atoms: np.ndarray, num_edges: Optional[np.ndarray]
+    ) -> None:
+        logging.info(
+            f"Batching {len(num_atoms)} graphs in {len(self.buckets)} size buckets"
+        )
+        for i, (bucket, shape) in enumerate(zip(self.buckets, self.padded_shapes)):
+            atoms = num_atoms[bucket]
+            message = (
+                f"  bucket {i}: {len(bucket)} graphs of {atoms.min()}-{atoms.max()} "
+                f"atoms"
+            )
+            if num_edges is not None:
+                edges = num_edges[bucket]
+                message += f" and {edges.min()}-{edges.max()} edges"
+            # Fraction of the padded nodes that are real, for full batches
+            efficiency = self.batch_size * atoms.mean() / shape[1]
+            message += (
+                f", padded to {shape[1]} nodes"
+                + ("" if shape[2] is None else f" and {shape[2]} edges")
+                + f" ({100 * efficiency:.1f}% of nodes real)"
+            )
+            logging.info(message)
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def _all_batches(self) -> List[np.ndarray]:
+        rng = np.random.default_rng(self.seed + self.epoch)
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = rng.permutation(bucket)
+            bucket_batches = np.split(
+                bucket, range(self.batch_size, len(bucket), self.batch_size)
+            )
+            if self.drop_last:
+                bucket_batches = [
+                    batch for batch in bucket_batches if len(batch) == self.batch_size
+                ]
+            batches.extend(bucket_batches)
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        batches = split_batches_over_replicas(
+            self._all_batches(), self.num_replicas, self.rank, self.drop_last
+        )
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self) -> int:
+        return len(
+            split_batches_over_replicas(
+                self._all_batches(), self.num_replicas, self.rank, self.drop_last
+            )
+        )
+
+
+class ContiguousBatchSampler(Sampler[List[int]]):
+    """
+    Batch sampler yielding batches of consecutive indices within a shard, so that a
+    dataset implementing __getitems__ (e.g. HDF5Dataset with the columnar layout) can
+    read each batch with a single call per column. Each epoch, batch boundaries are
+    moved by a random offset within each shard and the order of the batches is
+    shuffled. The leftover indices at the edges of the shards are shuffled together
+    into the remaining batches.
+    With num_replicas > 1, every rank gets the same number of batches.
+    """
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        batch_size: int,
+        shuffle: bool = True,
+        drop_last: bool = False,
+        seed: int = 0,
+        num_replicas: int = 1,
+        rank: int = 0,
+        shard_sizes: Optional[List[int]] = None,
+    ):
+        super().__init__(None)
+        self.shard_sizes = (
+            get_shard_sizes(dataset) if shard_sizes is None else shard_sizes
+        )
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def _all_batches(self) -> List[np.ndarray]:
+        rng = np.random.default_rng(self.seed + self.epoch)
+        batches = []
+        leftovers = []
+        start = 0
+        for size in self.shard_sizes:
+            offset = int(rng.integers(self.batch_size)) if self.shuffle else 0
+            offset = min(offset, size)
+            num_full = (size - offset) // self.batch_size
+            stop = offset + num_full * self.batch_size
+            leftovers.append(np.arange(start, start + offset))
+            leftovers.append(np.arange(start + stop, start + size))
+            batches.extend(
+                np.arange(start + offset, start + stop).reshape(-1, self.batch_size)
+            )
+            start += size
+
+        leftovers = np.concatenate(leftovers)
+        if self.shuffle:
+            rng.shuffle(leftovers)
+        batches.extend(
+            np.split(leftovers, range(self.batch_size, len(leftovers), self.batch_size))
+        )
+        batches = [batch for batch in batches if len(batch) > 0]
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        batches = self._all_batches()
+        num_batches = len(batches) // self.num_replicas
+        for batch in batches[self.rank : num_batches * self.num_replicas : self.num_replicas]:
+            yield batch.tolist()
+
+    def __len__(self) -> int:
+        return len(self._all_batches()) // self.num_replicas
@@ -0,0 +1,430 @@
+import hashlib
+import json
+import logging
+import multiprocessing as mp
+import os
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Hashable, Optional, Sequence, Tuple
+
+import h5py
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from mace.data.manifest import _decode
+from mace.data.neighborhood import get_neighborhoods
+
+
+@dataclass
+class Moments:
+    """Count, mean and sum of squared deviations (M2) of a stream of values"""
+
+    count: int = 0
+    mean: float = 0.0
+    m2: float = 0.0
+
+    def add(self, values: np.ndarray) -> None:
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0:
+            return
+        mean = float(values.mean())
+        self.merge(Moments(len(values), mean, float(np.square(values - mean).sum())))
+
+    def merge(self, other: "Moments") -> "Moments":
+        # Chan et al. pairwise update, exact for any split of the values
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta**2 * self.count * other.count / count
+        self.count = count
+        return self
+
+    @property
+    def std(self) -> float:
+        # Unbiased, as torch.std
+        return float(np.sqrt(self.m2 / (self.count - 1))) if self.count > 1 else 0.0
+
+
+@dataclass
+class HeadStatistics:
+    """
+    Statistics of the configurations of a head: moments of the interaction energy per
+    atom, sum of squares and number of force components, and number of edges and of
+    atoms receiving at least one edge
+    """
+
+    energy: Moments = field(default_factory=Moments)
+    forces_sq_sum: float = 0.0
+    num_forces: int = 0
+    num_edges: int = 0
+    num_receivers: int = 0
+
+    def merge(self, other: "HeadStatistics") -> "HeadStatistics":
+        self.energy.merge(other.energy)
+        self.forces_sq_sum += other.forces_sq_sum
+        self.num_forces += other.num_forces
+        self.num_edges += other.num_edges
+        self.num_receivers += other.num_receivers
+        return self
+
+    @property
+    def mean(self) -> float:
+        return self.energy.mean
+
+    @property
+    def std(self) -> float:
+        return self.energy.std
+
+    @property
+    def rms_forces(self) -> float:
+        return float(np.sqrt(self.forces_sq_sum / max(self.num_forces, 1)))
+
+    @property
+    def avg_num_neighbors(self) -> float:
+        return self.num_edges / max(self.num_receivers, 1)
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, values: Dict) -> "HeadStatistics":
+        values = dict(values)
+        return cls(energy=Moments(**values.pop("energy")), **values)
+
+    def scaling(self, scaling: str) -> Tuple[float, float]:
+        """Mean and scale of the interaction energy for the scaling of run_train"""
+        if scaling == "std_scaling":
+            scale = self.std
+        elif scaling == "rms_forces_scaling":
+            scale = self.rms_forces
+        else:
+            raise ValueError(f"Unknown scaling {scaling}")
+        if scale == 0:
+            logging.warning(
+                "Standard deviation of the scaling is zero, Changing to no scaling"
+            )
+            scale = 1.0
+        return self.mean, scale
+
+
+class StatisticsAccumulator:
+    """
+    Statistics of a dataset for each head, accumulated in a single pass over blocks of
+    configurations and merged exactly across shards, processes and ranks
+    """
+
+    def __init__(self):
+        self.heads: Dict[Hashable, HeadStatistics] = {}
+
+    def head(self, head: Hashable) -> HeadStatistics:
+        if head not in self.heads:
+            self.heads[head] = HeadStatistics()
+        return self.heads[head]
+
+    def add(
+        self,
+        head: Hashable,
+        atom_energies: Optional[np.ndarray] = None,
+        forces: Optional[np.ndarray] = None,
+        neighbor_counts: Optional[np.ndarray] = None,
+    ) -> None:
+        """
+        Add the interaction energies per atom of some configurations of head, their
+        forces and the numbers of neighbors of their atoms
+        """
+        statistics = self.head(head)
+        if atom_energies is not None:
+            statistics.energy.add(atom_energies)
+        if forces is not None:
+            forces = np.asarray(forces, dtype=np.float64)
+            statistics.forces_sq_sum += float(np.square(forces).sum())
+            statistics.num_forces += forces.size
+        if neighbor_counts is not None:
+            neighbor_counts = np.asarray(neighbor_counts)
+            statistics.num_edges += int(neighbor_counts.sum())
+            statistics.num_receivers += int(np.count_nonzero(neighbor_counts))
+
+    def add_batch(self, batch, atomic_energies: np.ndarray) -> None:
+        """
+        Add a collated batch, whose head attribute indexes the rows of atomic_energies
+        ([num_heads, num_elements] or [num_elements])
+        """
+        E0s = torch.as_tensor(
+            np.atleast_2d(atomic_energies), dtype=batch.node_attrs.dtype
+        )
+        head = batch.head.cpu()
+        node_e0 = batch.node_attrs.cpu() @ E0s.T  # [n_nodes, n_heads]
+        graph_e0 = torch.zeros((batch.num_graphs, E0s.shape[0]), dtype=E0s.dtype)
+        graph_e0.index_add_(0, batch.batch.cpu(), node_e0)
+        graph_e0 = graph_e0[torch.arange(batch.num_graphs), head.clamp(max=E0s.shape[0] - 1)]
+        graph_sizes = (batch.ptr[1:] - batch.ptr[:-1]).cpu()
+        atom_energies = ((batch.energy.cpu() - graph_e0) / graph_sizes).numpy()
+        forces = batch.forces.cpu().numpy() if batch.forces is not None else None
+        node_head = head[batch.batch.cpu()].numpy()
+        neighbor_counts = np.bincount(
+            batch.edge_index[1].cpu().numpy(), minlength=batch.num_nodes
+        )
+        head = head.numpy()
+        for key in np.unique(head):
+            nodes = node_head == key
+            self.add(
+                int(key),
+                atom_energies=atom_energies[head == key],
+                forces=None if forces is None else forces[nodes],
+                neighbor_counts=neighbor_counts[nodes],
+            )
+
+    def merge(self, other: "StatisticsAccumulator") -> "StatisticsAccumulator":
+        for head, statistics in other.heads.items():
+            self.head(head).merge(statistics)
+        return self
+
+    def all_reduce(self) -> "StatisticsAccumulator":
+        """Merge the accumulators of all ranks, in rank order so that all ranks agree"""
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            accumulators = [None] * torch.distributed.get_world_size()
+            torch.distributed.all_gather_object(accumulators, self.heads)
+            self.heads = {}
+            for heads in accumulators:
+                for head, statistics in heads.items():
+                    self.head(head).merge(statistics)
+        return self
+
+    def total(self) -> HeadStatistics:
+        """Statistics of all heads together"""
+        total = HeadStatistics()
+        for statistics in self.heads.values():
+            total.merge(statistics)
+        return total
+
+
+def compute_loader_statistics(
+    data_loader: torch.utils.data.DataLoader,
+    atomic_energies: np.ndarray,
+    progress: bool = False,
+) -> StatisticsAccumulator:
+    """Statistics of the batches of data_loader, merged over all ranks if distributed"""
+    accumulator = StatisticsAccumulator()
+    for batch in tqdm(data_loader, disable=not progress):
+        accumulator.add_batch(batch, atomic_energies)
+    return accumulator.all_reduce()
+
+
+def dataset_fingerprint(paths: Sequence[str], **params) -> str:
+    """
+    Hash of the names, sizes and modification times of the files at paths (searched
+    recursively in directories), and of the JSON serializable params
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                sorted(
+                    os.path.join(root, name)
+                    for root, _, names in os.walk(path)
+                    for name in names
+                )
+            )
+        else:
+            files.append(path)
+    key = {
+        "files": [
+            (os.path.abspath(file), os.stat(file).st_size, os.stat(file).st_mtime_ns)
+            for file in files
+        ],
+        "params": params,
+    }
+    return hashlib.sha1(
+        json.dumps(key, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+class StatisticsCache:
+    """HeadStatistics saved in a JSON file, keyed by the fingerprint of their dataset"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _load(self) -> Dict:
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path) as f:  # pylint: disable=W1514
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable statistics cache {self.path}: {e}")
+            return {}
+
+    def get(self, fingerprint: str) -> Optional[HeadStatistics]:
+        values = self._load().get(fingerprint)
+        return None if values is None else HeadStatistics.from_dict(values)
+
+    def put(self, fingerprint: str, statistics: HeadStatistics) -> None:
+        entries = self._load()
+        entries[fingerprint] = statistics.to_dict()
+        # Written next to the cache and renamed, so readers never see a partial file
+        partial_path = f"{self.path}.{os.getpid()}"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(partial_path, "w") as f:  # pylint: disable=W1514
+                json.dump(entries, f, indent=2)
+            os.replace(partial_path, self.path)
+        except OSError as e:
+            logging.warning(f"Could not save statistics to {self.path}: {e}")
+
+
+def _read_shard_columns(file_path: str) -> Dict:
+    # Columns of a shard in the columnar layout, also for shards in the grouped layout
+    with h5py.File(file_path, "r") as f:
+        if f.attrs.get("format") == "columnar":
+            columns = {key: f[key][()] for key in f.keys()}
+            vocabulary = [_decode(v) for v in f["head"].attrs["vocabulary"]]
+            columns["head"] = [vocabulary[code] for code in columns["head"]]
+            columns["graph_r_max"] = f.attrs.get("r_max")
+            return columns
+
+        configs = [config for batch in f.values() for config in batch.values()]
+        graph_r_max = next(iter(f.values())).attrs.get("r_max")
+        stored_graphs = graph_r_max is not None and all("edge_index" in c for c in configs)
+        columns = {"graph_r_max": graph_r_max if stored_graphs else None}
+        atomic_numbers = [config["atomic_numbers"][()] for config in configs]
+        columns["atomic_numbers"] = np.concatenate([np.zeros(0, np.int32)] + atomic_numbers)
+        columns["node_ptr"] = np.concatenate(
+            [[0], np.cumsum([len(z) for z in atomic_numbers])]
+        ).astype(np.int64)
+        columns["positions"] = np.concatenate(
+            [np.zeros((0, 3))] + [config["positions"][()] for config in configs]
+        )
+
+        def optional(key):
+            values = [config[key][()] if key in config else "None" for config in configs]
+            return [None if isinstance(v, (bytes, str)) else v for v in values]
+
+        energies = optional("energy")
+        columns["energy"] = np.array([np.nan if e is None else e for e in energies], float)
+        forces = optional("forces")
+        columns["forces_mask"] = np.array([value is not None for value in forces])
+        columns["forces"] = np.concatenate(
+            [np.zeros((0, 3))]
+            + [
+                np.zeros((len(z), 3)) if value is None else value
+                for value, z in zip(forces, atomic_numbers)
+            ]
+        )
+        columns["cell"] = optional("cell")
+        columns["pbc"] = optional("pbc")
+        columns["head"] = [
+            _decode(config["head"][()]) if "head" in config else "Default"
+            for config in configs
+        ]
+        if stored_graphs:
+            edge_index = [config["edge_index"][()] for config in configs]
+            columns["edge_ptr"] = np.concatenate(
+                [[0], np.cumsum([e.shape[1] for e in edge_index])]
+            ).astype(np.int64)
+            columns["edge_index"] = np.concatenate(
+                [np.zeros((2, 0), np.int64)] + edge_index, axis=1
+            )
+    return columns
+
+
+def _optional_rows(columns: Dict, key: str, num_configs: int) -> list:
+    # Per configuration values of a column, None where they are missing
+    if key not in columns:
+        return [None] * num_configs
+    mask = columns.get(key + "_mask")
+    return [
+        None if mask is not None and not mask[i] else columns[key][i]
+        for i in range(num_configs)
+    ]
+
+
+def accumulate_statistics_from_hdf5(
+    file_path: str,
+    atomic_energies: Dict[Optional[str], Dict[int, float]],
+    r_max: float,
+) -> StatisticsAccumulator:
+    """
+    Statistics of the configurations of an HDF5 shard (either layout), read from its
+    arrays. The neighbors are counted from the stored graphs if they were built with
+    r_max, and otherwise from neighbor lists built for the whole shard at once.
+    atomic_energies maps each head (or None, for all heads) to its E0s.
+    """
+    columns = _read_shard_columns(file_path)
+    node_ptr = columns["node_ptr"]
+    num_configs = len(node_ptr) - 1
+    num_atoms = np.diff(node_ptr)
+    atomic_numbers = columns["atomic_numbers"].astype(np.int64)
+    config_of_node = np.repeat(np.arange(num_configs), num_atoms)
+    heads = np.asarray(columns["head"], dtype=object)
+
+    graph_r_max = columns["graph_r_max"]
+    if graph_r_max is not None and np.isclose(graph_r_max, r_max) and "edge_ptr" in columns:
+        edge_ptr = columns["edge_ptr"]
+        edge_config = np.repeat(np.arange(num_configs), np.diff(edge_ptr))
+        receivers = columns["edge_index"][1].astype(np.int64) + node_ptr[edge_config]
+    else:
+        positions = columns["positions"]
+        pbc = _optional_rows(columns, "pbc", num_configs)
+        neighborhoods = get_neighborhoods(
+            positions=[positions[node_ptr[i] : node_ptr[i + 1]] for i in range(num_configs)],
+            cutoff=r_max,
+            pbc=[None if value is None else tuple(bool(p) for p in value) for value in pbc],
+            cell=_optional_rows(columns, "cell", num_configs),
+        )
+        receivers = np.concatenate(
+            [np.zeros(0, np.int64)]
+            + [edge_index[1] + node_ptr[i] for i, (edge_index, _, _) in enumerate(neighborhoods)]
+        )
+    neighbor_counts = np.bincount(receivers, minlength=len(atomic_numbers))
+
+    energies = np.asarray(columns.get("energy", np.full(num_configs, np.nan)), float)
+    if "energy_mask" in columns:
+        energies[~columns["energy_mask"]] = np.nan
+    forces = columns.get("forces")
+    forces_mask = columns.get("forces_mask", np.ones(num_configs, dtype=bool))
+
+    accumulator = StatisticsAccumulator()
+    for head in np.unique(heads):
+        E0s = atomic_energies.get(head, atomic_energies.get(None))
+        lookup = np.zeros(max(atomic_numbers.max(initial=0), max(E0s)) + 1)
+        lookup[list(E0s)] = list(E0s.values())
+        configs = heads == head
+        graph_e0 = np.bincount(
+            config_of_node, weights=lookup[atomic_numbers], minlength=num_configs
+        )
+        with_energy = configs & ~np.isnan(energies)
+        nodes = configs[config_of_node]
+        force_nodes = nodes & forces_mask[config_of_node]
+        accumulator.add(
+            head,
+            atom_energies=(energies - graph_e0)[with_energy] / num_atoms[with_energy],
+            forces=None if forces is None else forces[force_nodes],
+            neighbor_counts=neighbor_counts[nodes],
+        )
+    return accumulator
+
+
+def compute_statistics_from_hdf5(
+    files: Sequence[str],
+    atomic_energies: Dict[Optional[str], Dict[int, float]],
+    r_max: float,
+    num_workers: int = 1,
+) -> StatisticsAccumulator:
+    """Statistics of HDF5 shards, each read by one of num_workers processes"""
+    if num_workers > 1 and len(files) > 1:
+        with mp.Pool(processes=min(num_workers, len(files))) as pool:
+            accumulators = pool.starmap(
+                accumulate_statistics_from_hdf5,
+                [(file, atomic_energies, r_max) for file in files],
+            )
+    else:
+        accumulators = [
+            accumulate_statistics_from_hdf5(file, atomic_energies, r_max) for file in files
+        ]
+    accumulator = StatisticsAccumulator()
+    for partial in accumulators:
+        accumulator.merge(partial)
+    return accumulator
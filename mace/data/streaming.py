@@ -0,0 +1,177 @@
+import json
+import os
+from itertools import islice
+from typing import Iterator, List, Optional
+
+import h5py
+import numpy as np
+from torch.utils.data import IterableDataset, get_worker_info
+
+from mace.data.atomic_data import AtomicData
+from mace.data.hdf5_dataset import HDF5Dataset
+from mace.data.manifest import list_shards, read_manifest
+from mace.data.mmap_dataset import METADATA_FILE, MmapDataset, is_mmap_dataset
+from mace.tools.utils import AtomicNumberTable
+
+
+def get_shard_length(file: str) -> int:
+    """Number of configurations in a shard, read from its metadata only"""
+    if is_mmap_dataset(file):
+        with open(os.path.join(file, METADATA_FILE)) as f:  # pylint: disable=W1514
+            return json.load(f)["num_configs"]
+    with h5py.File(file, "r") as f:
+        if f.attrs.get("format") == "columnar":
+            return int(f.attrs["num_configs"])
+        batch_keys = list(f.keys())
+        return len(batch_keys) * len(f[batch_keys[0]].keys())
+
+
+class ShardedStreamingDataset(IterableDataset):
+    """
+    Streams the shards written by preprocess_data (HDF5 files or MmapDataset directories)
+    sequentially instead of accessing them at random. Each epoch, the shards are
+    shuffled with seed + epoch and dealt to the ranks and DataLoader workers, every one
+    of which reads its shards in order through a shuffle buffer of shuffle_buffer_size
+    graphs. All ranks yield the same number of graphs (the total divided by
+    num_replicas), so that workers whose shards are smaller or larger than their share
+    repeat or skip some of their graphs.
+    Shards are only opened by the process iterating over them.
+    """
+
+    def __init__(
+        self,
+        files: List[str],
+        z_table: AtomicNumberTable,
+        r_max: float,
+        shuffle: bool = True,
+        shuffle_buffer_size: int = 1000,
+        seed: int = 0,
+        num_replicas: int = 1,
+        rank: int = 0,
+        shard_sizes: Optional[List[int]] = None,
+        read_size: int = 256,
+        **kwargs,
+    ):
+        super().__init__()
+        self.z_table = z_table
+        # Shards of several heads, each with the arguments of its dataset
+        self.shards = [(file, r_max, kwargs) for file in files]
+        self._shard_sizes = None if shard_sizes is None else list(shard_sizes)
+        self.shuffle = shuffle
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.read_size = read_size
+        self.epoch = 0
+
+    @classmethod
+    def from_path(cls, path: str, z_table: AtomicNumberTable, r_max: float, **kwargs):
+        """Dataset streaming a single shard or the shards of a directory"""
+        if is_mmap_dataset(path) or os.path.isfile(path):
+            return cls([path], z_table=z_table, r_max=r_max, **kwargs)
+        files = list_shards(path)
+        manifest = read_manifest(path)
+        if manifest is not None and "shard_sizes" not in kwargs:
+            shards = manifest["shards"]
+            if all(os.path.basename(file) in shards for file in files):
+                kwargs["shard_sizes"] = [
+                    shards[os.path.basename(file)]["num_configs"] for file in files
+                ]
+        return cls(files, z_table=z_table, r_max=r_max, **kwargs)
+
+    def __add__(self, other: "ShardedStreamingDataset") -> "ShardedStreamingDataset":
+        dataset = ShardedStreamingDataset(
+            [],
+            z_table=self.z_table,
+            r_max=None,
+            shuffle=self.shuffle,
+            shuffle_buffer_size=self.shuffle_buffer_size,
+            seed=self.seed,
+            num_replicas=self.num_replicas,
+            rank=self.rank,
+            read_size=self.read_size,
+        )
+        dataset.shards = self.shards + other.shards
+        if self._shard_sizes is not None and other._shard_sizes is not None:
+            dataset._shard_sizes = (  # pylint: disable=protected-access
+                self._shard_sizes + other._shard_sizes  # pylint: disable=protected-access
+            )
+        return dataset
+
+    @property
+    def shard_sizes(self) -> List[int]:
+        if self._shard_sizes is None:
+            self._shard_sizes = [get_shard_length(file) for file, _, _ in self.shards]
+        return self._shard_sizes
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        # Number of graphs yielded by each rank
+        return sum(self.shard_sizes) // self.num_replicas
+
+    def _open_shard(self, shard: int):
+        file, r_max, kwargs = self.shards[shard]
+        if is_mmap_dataset(file):
+            return MmapDataset(file, z_table=self.z_table, r_max=r_max, **kwargs)
+        return HDF5Dataset(file, z_table=self.z_table, r_max=r_max, **kwargs)
+
+    def _read_shard(self, shard: int) -> Iterator[AtomicData]:
+        dataset = self._open_shard(shard)
+        for start in range(0, len(dataset), self.read_size):
+            indices = list(range(start, min(start + self.read_size, len(dataset))))
+            if hasattr(dataset, "__getitems__"):
+                yield from dataset.__getitems__(indices)
+            else:
+                yield from (dataset[index] for index in indices)
+
+    def _assign_shards(self, rng: np.random.Generator):
+        # Shards and number of graphs of each worker of this rank
+        worker_info = get_worker_info()
+        num_workers = 1 if worker_info is None else worker_info.num_workers
+        worker_id = 0 if worker_info is None else worker_info.id
+        order = np.arange(len(self.shards))
+        if self.shuffle:
+            rng.shuffle(order)
+
+        num_slots = self.num_replicas * num_workers
+        slot = self.rank * num_workers + worker_id
+        shards = order[slot::num_slots].tolist()
+        if len(shards) == 0:
+            # More workers than shards: read a shard assigned to another worker
+            shards = [int(order[slot % len(order)])]
+
+        total = len(self)
+        num_graphs = total // num_workers + int(worker_id < total % num_workers)
+        return shards, num_graphs, slot
+
+    def _stream(self, shards: List[int]) -> Iterator[AtomicData]:
+        # The shards of a worker, repeated as long as more graphs are needed
+        if sum(self.shard_sizes[shard] for shard in shards) == 0:
+            return
+        while True:
+            for shard in shards:
+                yield from self._read_shard(shard)
+
+    def __iter__(self) -> Iterator[AtomicData]:
+        # The shard order is the same on all ranks and workers, the shuffle buffers differ
+        shards, num_graphs, slot = self._assign_shards(
+            np.random.default_rng(self.seed + self.epoch)
+        )
+        if num_graphs == 0:
+            return
+        rng = np.random.default_rng([self.seed, self.epoch, slot])
+        buffer = []
+        for item in islice(self._stream(shards), num_graphs):
+            if not self.shuffle:
+                yield item
+            elif len(buffer) < self.shuffle_buffer_size:
+                buffer.append(item)
+            else:
+                i = rng.integers(len(buffer))
+                yield buffer[i]
+                buffer[i] = item
+        rng.shuffle(buffer)
+        yield from buffer
@@ -8,7 +8,7 @@ import logging
 import multiprocessing as mp
 import os
 from dataclasses import dataclass
-from typing import Dict, List, Optional, Sequence, Tuple
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
 
 import ase.data
 import ase.io
@@ -18,6 +18,12 @@ import numpy as np
 from mace.tools import AtomicNumberTable
 from tqdm import tqdm
 
+from .atomic_energies import E0Accumulator
+from .composition import composition_masks, element_mask
+from .hashing import configuration_hash
+from .neighborhood import get_neighborhoods
+from .xyz_index import read_xyz
+
 Vector = np.ndarray  # [3,]
 Positions = np.ndarray  # [..., 3]
 Forces = np.ndarray  # [..., 3]
@@ -210,8 +216,9 @@ def load_from_extxyzs(
     dipole_key: str = "dipole",
     charges_key: str = "charges",
     head_key: str = "head",
+    num_workers: Optional[int] = None,
 ) -> Tuple[Dict[int, float], Configurations]:
-    atoms_list = atoms_from_oc20(file_path)
+    atoms_list = atoms_from_oc20(file_path, num_workers=num_workers)
 
     atomic_energies_dict = {}
 
@@ -233,6 +240,56 @@ def load_from_extxyzs(
     )
     return atomic_energies_dict, configs, heads
 
+def copy_calculator_results(
+    atoms: ase.Atoms, energy: bool = True, forces: bool = True, stress: bool = True
+) -> None:
+    """Store the results of the calculator attached to atoms under the _REF_ keys"""
+    if energy:
+        try:
+            atoms.info["_REF_energy"] = atoms.get_potential_energy()
+        except Exception as e:  # pylint: disable=W0703
+            logging.warning(f"Failed to extract energy: {e}")
+            atoms.info["_REF_energy"] = None
+
+    if forces:
+        try:
+            atoms.arrays["_REF_forces"] = atoms.get_forces()
+        except Exception as e:  # pylint: disable=W0703
+            logging.warning(f"Failed to extract forces: {e}")
+            atoms.arrays["_REF_forces"] = None
+
+    if stress:
+        try:
+            atoms.info["_REF_stress"] = atoms.get_stress()
+        except Exception as e:  # pylint: disable=W0703
+            atoms.info["_REF_stress"] = None
+
+
+def iread_atoms(
+    file_path: str,
+    h5_positions_key: str = "atXYZ",
+    h5_numbers_key: str = "atNUM",
+    h5_energy_key: str = "ePBE0+MBD",
+    h5_forces_key: str = "totFOR",
+) -> Iterator[ase.Atoms]:
+    """
+    Structures of an xyz file, or of an ANI-style or AQM-style HDF5 file (with the
+    h5_*_key keys), read one at a time (one group at a time for HDF5) rather than all
+    at once
+    """
+    if file_path.endswith(".h5") or file_path.endswith(".hdf5"):
+        if is_hdf5_ani(file_path):
+            return iter_atoms_from_hdf5_ani(file_path)
+        return iter_atoms_from_hdf5(
+            file_path,
+            positions_key=h5_positions_key,
+            numbers_key=h5_numbers_key,
+            energy_key=h5_energy_key,
+            forces_key=h5_forces_key,
+        )
+    return ase.io.iread(file_path, index=":")
+
+
 def load_from_xyz(
     file_path: str,
     config_type_weights: Dict,
@@ -245,8 +302,9 @@ def load_from_xyz(
     head_key: str = "head",
     extract_atomic_energies: bool = False,
     keep_isolated_atoms: bool = False,
+    num_workers: int = 1,
 ) -> Tuple[Dict[int, float], Configurations]:
-    atoms_list = ase.io.read(file_path, index=":")
+    atoms_list = read_xyz(file_path, index=":", num_workers=num_workers)
 
     energy_from_calc = False
     forces_from_calc = False
@@ -275,25 +333,12 @@ def load_from_xyz(
         stress_key = "_REF_stress"
 
     for atoms in atoms_list:
-        if energy_from_calc:
-            try:
-                atoms.info["_REF_energy"] = atoms.get_potential_energy()
-            except Exception as e:  # pylint: disable=W0703
-                logging.warning(f"Failed to extract energy: {e}")
-                atoms.info["_REF_energy"] = None
-
-        if forces_from_calc:
-            try:
-                atoms.arrays["_REF_forces"] = atoms.get_forces()
-            except Exception as e:  # pylint: disable=W0703
-                logging.warning(f"Failed to extract forces: {e}")
-                atoms.arrays["_REF_forces"] = None
-
-        if stress_from_calc:
-            try:
-                atoms.info["_REF_stress"] = atoms.get_stress()
-            except Exception as e:  # pylint: disable=W0703
-                atoms.info["_REF_stress"] = None
+        copy_calculator_results(
+            atoms,
+            energy=energy_from_calc,
+            forces=forces_from_calc,
+            stress=stress_from_calc,
+        )
 
     if not isinstance(atoms_list, list):
         atoms_list = [atoms_list]
@@ -356,115 +401,233 @@ def load_from_h5(
     h5_energy_key: str = 'ePBE0+MBD',
     h5_forces_key: str = 'totFOR',
 ) -> Tuple[Dict[int, float], Configurations]:
-    atoms_list = atoms_from_hdf5_ani(
-        file_path, 
-        positions_key=h5_positions_key,
-        numbers_key=h5_numbers_key,
-        energy_key=h5_energy_key,
-        forces_key=h5_forces_key
-    )
-
+    if is_hdf5_ani(file_path):
+        configs = configs_from_hdf5_ani(file_path, config_type_weights=config_type_weights)
+    else:
+        configs = configs_from_hdf5(
+            file_path,
+            positions_key=h5_positions_key,
+            numbers_key=h5_numbers_key,
+            energy_key=h5_energy_key,
+            forces_key=h5_forces_key,
+            config_type_weights=config_type_weights,
+        )
 
     atomic_energies_dict = {}
 
-    heads = set()
-    for atoms in atoms_list:
-        heads.add(atoms.info.get("head", "Default"))
-    heads = list(heads)
-
-    configs = config_from_atoms_list(
-        atoms_list,
-        config_type_weights=config_type_weights,
-        energy_key="energy",
-        forces_key="forces",
-        stress_key="stress",
-        virials_key="virials",
-        dipole_key="dipole",
-        charges_key="charges",
-        head_key="head",
-    )
+    heads = list({config.head for config in configs})
     return atomic_energies_dict, configs, heads
 
+
+def is_hdf5_ani(file_path: str) -> bool:
+    # ANI-style files hold one group of conformers per molecule, AQM-style files
+    # one group per conformer within a group per molecule
+    with h5py.File(file_path, "r") as f:
+        return "coordinates" in next(iter(f.values()))
+
+
+def configs_from_arrays(
+    atomic_numbers: np.ndarray,
+    positions: np.ndarray,
+    energies: np.ndarray,
+    forces: np.ndarray,
+    config_type_weights: Dict[str, float] = None,
+) -> Configurations:
+    """
+    Configurations of conformers with the same number of atoms, given as arrays of
+    shapes [n_atoms] or [n_confs, n_atoms], [n_confs, n_atoms, 3], [n_confs] and
+    [n_confs, n_atoms, 3]. They match what config_from_atoms builds from ase.Atoms
+    holding only an energy and forces, without creating them.
+    """
+    if config_type_weights is None:
+        config_type_weights = DEFAULT_CONFIG_TYPE_WEIGHTS
+    weight = config_type_weights.get(DEFAULT_CONFIG_TYPE, 1.0)
+    positions = np.asarray(positions, dtype=np.float64)
+    atomic_numbers = np.broadcast_to(atomic_numbers, positions.shape[:2]).astype(int)
+    energies = np.asarray(energies, dtype=np.float64).reshape(-1)
+    forces = np.asarray(forces, dtype=np.float64)
+    num_atoms = positions.shape[1]
+    return [
+        Configuration(
+            atomic_numbers=atomic_numbers[i],
+            positions=positions[i],
+            energy=energies[i].item(),
+            forces=forces[i],
+            stress=np.zeros(6),
+            virials=np.zeros((3, 3)),
+            dipole=np.zeros(3),
+            charges=np.zeros(num_atoms),
+            weight=weight,
+            stress_weight=0.0,
+            virials_weight=0.0,
+            pbc=(False, False, False),
+            cell=np.zeros((3, 3)),
+        )
+        for i in range(len(positions))
+    ]
+
+
+def iter_configs_from_hdf5_ani(
+    file_path: str, config_type_weights: Dict[str, float] = None
+) -> Iterator[Configurations]:
+    """
+    Configurations of an ANI-style HDF5 file, built one group at a time from its whole
+    coordinates, species, energies and forces arrays
+    """
+    with h5py.File(file_path, "r") as h5:
+        for properties in tqdm(h5.values()):
+            yield configs_from_arrays(
+                atomic_numbers=properties["species"][()],
+                positions=properties["coordinates"][()],
+                # convert to eV
+                energies=properties["energies"][()] * ase.units.Hartree,
+                forces=properties["forces"][()] * ase.units.Hartree,
+                config_type_weights=config_type_weights,
+            )
+
+
+def configs_from_hdf5_ani(
+    file_path: str, config_type_weights: Dict[str, float] = None
+) -> Configurations:
+    return [
+        config
+        for configs in iter_configs_from_hdf5_ani(file_path, config_type_weights)
+        for config in configs
+    ]
+
+
+def configs_from_hdf5(
+    file_path: str,
+    positions_key: str = "atXYZ",
+    numbers_key: str = "atNUM",
+    energy_key: str = "ePBE0+MBD",
+    forces_key: str = "totFOR",
+    config_type_weights: Dict[str, float] = None,
+) -> Configurations:
+    """
+    Configurations of an AQM-style HDF5 file, with the conformers of each molecule
+    read and converted together when they have the same number of atoms
+    """
+    configs = []
+    with h5py.File(file_path, "r") as aqm:
+        for molecule in aqm.values():
+            conformers = list(molecule.values())
+            arrays = {
+                key: [np.asarray(conformer[key][()]) for conformer in conformers]
+                for key in (numbers_key, positions_key, energy_key, forces_key)
+            }
+            if len({len(numbers) for numbers in arrays[numbers_key]}) == 1:
+                groups = [slice(None)]
+            else:
+                groups = [slice(i, i + 1) for i in range(len(conformers))]
+            for group in groups:
+                configs.extend(
+                    configs_from_arrays(
+                        atomic_numbers=np.stack(arrays[numbers_key][group]),
+                        positions=np.stack(arrays[positions_key][group]),
+                        energies=np.stack(arrays[energy_key][group]),
+                        forces=np.stack(arrays[forces_key][group]),
+                        config_type_weights=config_type_weights,
+                    )
+                )
+    return configs
+
+def iter_atoms_from_hdf5(file_path, positions_key='atXYZ', numbers_key="atNUM", energy_key='ePBE0+MBD', forces_key='totFOR'):
+    with h5py.File(file_path, "r") as aqm:
+        for molecule in aqm.values():
+            for curr_cfg in molecule.values():
+                atoms = ase.Atoms(positions=np.array(curr_cfg[positions_key]), numbers=np.array(curr_cfg[numbers_key]))
+                atoms.info['energy'] = np.array(curr_cfg[energy_key]).item()
+                atoms.arrays['forces'] = np.array(curr_cfg[forces_key])
+                # atoms.info['head'] = "Default"
+                yield atoms
+
 def atoms_from_hdf5(file_path, positions_key='atXYZ', numbers_key="atNUM", energy_key='ePBE0+MBD', forces_key='totFOR'):
-    aqm = h5py.File(file_path, "r")
-    atoms_list = []
-    AQMmol_ids = list(aqm.keys())
-
-    for molid in AQMmol_ids:
-        AQMconf_ids = list(aqm[molid].keys())
-        for confid in AQMconf_ids:
-            curr_cfg = aqm[molid][confid]
-            atoms = ase.Atoms(positions=np.array(curr_cfg[positions_key]), numbers=np.array(curr_cfg[numbers_key]))
-            atoms.info['energy'] = np.array(curr_cfg[energy_key]).item()
-            atoms.arrays['forces'] = np.array(curr_cfg[forces_key])
-            # atoms.info['head'] = "Default"
-            atoms_list.append(atoms)
-
-    return atoms_list
+    return list(iter_atoms_from_hdf5(file_path, positions_key, numbers_key, energy_key, forces_key))
+
+def iter_atoms_from_hdf5_ani(file_path, positions_key='coordinates', numbers_key="species", energy_key='energies', forces_key='forces'):
+    with h5py.File(file_path, "r") as h5:
+        for num_atoms, properties in tqdm(h5.items()):        #Iterate thorugh like a dictionary
+            coordinates = np.array(properties[positions_key])     #Output of properties is of type h5py Dataset
+            species = np.array(properties[numbers_key])
+            energies = np.array(properties[energy_key])
+            forces = np.array(properties[forces_key])
+            for c, s, e, f in zip(coordinates, species, energies, forces):
+                atoms = ase.Atoms(positions=c, numbers=s)
+                atoms.info['energy'] = e * ase.units.Hartree # convert to eV
+                atoms.arrays['forces'] = f  * ase.units.Hartree # convert to eV
+                yield atoms
 
 def atoms_from_hdf5_ani(file_path, positions_key='coordinates', numbers_key="species", energy_key='energies', forces_key='forces'):
-    h5 = h5py.File(file_path, "r")
-    atoms_list = []
-    for num_atoms, properties in tqdm(h5.items()):        #Iterate thorugh like a dictionary
-        coordinates = np.array(properties['coordinates'])     #Output of properties is of type h5py Dataset
-        species = np.array(properties['species'])
-        energies = np.array(properties['energies'])
-        forces = np.array(properties['forces'])
-        for c, s, e, f in zip(coordinates, species, energies, forces):
-            atoms = ase.Atoms(positions=c, numbers=s)
-            atoms.info['energy'] = e * ase.units.Hartree # convert to eV
-            atoms.arrays['forces'] = f  * ase.units.Hartree # convert to eV
-            atoms_list.append(atoms) 
-    return atoms_list
+    return list(iter_atoms_from_hdf5_ani(file_path, positions_key, numbers_key, energy_key, forces_key))
 
 def read_atoms_file(identifier):
     return ase.io.read(identifier, index=":")
 
-def atoms_from_oc20(file_path, positions_key='coordinates', numbers_key="species", energy_key='energies', forces_key='forces'):
-    filenames = [f for f in os.listdir(file_path) if f.endswith(".extxyz")]
-    identifiers = [os.path.join(file_path, f) for f in filenames if f.endswith(".extxyz")]
-    
-    with mp.Pool(16) as pool:
-        results = list(tqdm(pool.imap(read_atoms_file, identifiers), total=len(identifiers)))
-    
-    # Flatten the list of lists
-    atoms_list = [atom for sublist in results for atom in sublist]
-    
-    return atoms_list
+
+def _read_atoms_file_with_path(identifier):
+    return identifier, read_atoms_file(identifier)
+
+
+def get_num_workers(num_workers: Optional[int] = None) -> int:
+    """num_workers if it is positive, otherwise the number of CPUs this process may use"""
+    if num_workers is not None and num_workers > 0:
+        return num_workers
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def list_extxyz_files(directory: str) -> List[str]:
+    return sorted(
+        os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(".extxyz")
+    )
+
+
+def iter_atoms_from_extxyzs(
+    file_paths: Sequence[str],
+    num_workers: Optional[int] = None,
+    chunksize: Optional[int] = None,
+) -> Iterator[Tuple[str, List[ase.Atoms]]]:
+    """
+    Read (ext)xyz files in a pool of num_workers processes, yielding the path and the
+    structures of each file as soon as it is read, in no particular order
+    """
+    num_workers = get_num_workers(num_workers)
+    if chunksize is None:
+        chunksize = max(1, len(file_paths) // (4 * num_workers))
+    with mp.Pool(num_workers) as pool:
+        yield from pool.imap_unordered(
+            _read_atoms_file_with_path, file_paths, chunksize=chunksize
+        )
+
+
+def atoms_from_oc20(file_path, num_workers=None, chunksize=None):
+    identifiers = list_extxyz_files(file_path)
+    results = {}
+    for identifier, atoms_list in tqdm(
+        iter_atoms_from_extxyzs(identifiers, num_workers, chunksize),
+        total=len(identifiers),
+    ):
+        results[identifier] = atoms_list
+
+    # Flatten the lists in the order of the files
+    return [atoms for identifier in identifiers for atoms in results[identifier]]
 
 
 def compute_average_E0s( # TODO: compute species dependant
-    collections_train: Configurations, z_table: AtomicNumberTable, heads: List[str]
-) -> Dict[int, float]:
+    collections_train: Configurations,
+    z_table: AtomicNumberTable,
+    heads: Optional[List[str]] = None,
+) -> Dict[str, Dict[int, float]]:
     """
     Function to compute the average interaction energy of each chemical element
-    returns dictionary of E0s
+    returns dictionary of E0s of each head (of the configurations if heads is None)
     """
-    len_train = len(collections_train)
-    len_zs = len(z_table)
-    atomic_energies_dict = {}
-    for head in heads:
-        A = np.zeros((len_train, len_zs))
-        B = np.zeros(len_train)
-        if head not in atomic_energies_dict:
-            atomic_energies_dict[head] = {}
-        for i in range(len_train):
-            if collections_train[i].head != head:
-                continue
-            B[i] = collections_train[i].energy
-            for j, z in enumerate(z_table.zs):
-                A[i, j] = np.count_nonzero(collections_train[i].atomic_numbers == z)
-        try:
-            E0s = np.linalg.lstsq(A, B, rcond=None)[0]
-            for i, z in enumerate(z_table.zs):
-                atomic_energies_dict[head][z] = E0s[i]
-        except np.linalg.LinAlgError:
-            logging.warning(
-                "Failed to compute E0s using least squares regression, using the same for all atoms"
-            )
-            for i, z in enumerate(z_table.zs):
-                atomic_energies_dict[head][z] = 0.0
-    return atomic_energies_dict
+    accumulator = E0Accumulator(z_table.zs)
+    accumulator.add_configurations(collections_train)
+    return accumulator.solve(heads)
 
 
 def save_dataset_as_HDF5(dataset: List, out_name: str) -> None:
@@ -515,8 +678,23 @@ def save_AtomicData_to_HDF5(data, i, h5_file) -> None:
     grp["head"] = data.head
 
 
-def save_configurations_as_HDF5(configurations: Configurations, _, h5_file) -> None:
+def save_configurations_as_HDF5(
+    configurations: Configurations, _, h5_file, r_max: Optional[float] = None
+) -> None:
+    """
+    Save configurations to an HDF5 file. If r_max is given, the edge_index and
+    unit_shifts of each configuration are stored as well, tagged with r_max, so that
+    HDF5Dataset does not need to rebuild the neighbour lists.
+    """
     grp = h5_file.create_group("config_batch_0")
+    if r_max is not None:
+        grp.attrs["r_max"] = r_max
+        neighborhoods = get_neighborhoods(
+            positions=[config.positions for config in configurations],
+            cutoff=r_max,
+            pbc=[config.pbc for config in configurations],
+            cell=[config.cell for config in configurations],
+        )
     for j, config in enumerate(configurations):
         subgroup_name = f"config_{j}"
         subgroup = grp.create_group(subgroup_name)
@@ -537,6 +715,156 @@ def save_configurations_as_HDF5(configurations: Configurations, _, h5_file) -> N
         subgroup["stress_weight"] = write_value(config.stress_weight)
         subgroup["virials_weight"] = write_value(config.virials_weight)
         subgroup["config_type"] = write_value(config.config_type)
+        subgroup["hash"] = np.uint64(configuration_hash(config))
+        subgroup["composition"] = element_mask(config.atomic_numbers)
+        if r_max is not None:
+            edge_index, _, unit_shifts = neighborhoods[j]
+            subgroup["edge_index"] = edge_index
+            subgroup["unit_shifts"] = unit_shifts
+
+
+def configurations_to_columns(
+    configurations: Configurations, r_max: Optional[float] = None
+) -> Tuple[Dict[str, np.ndarray], Dict[str, List[str]]]:
+    """
+    Concatenate each field over all configurations into a single array (column), with
+    node_ptr (and edge_ptr if r_max is given) holding the offsets of each configuration.
+    Optional fields that are None for some configurations get a boolean <field>_mask
+    column. String fields are stored as integer codes; their vocabularies are returned
+    separately.
+    """
+    columns = {}
+    vocabularies = {}
+    num_atoms = [len(config.atomic_numbers) for config in configurations]
+    columns["node_ptr"] = np.concatenate([[0], np.cumsum(num_atoms)]).astype(np.int64)
+
+    def add_column(name, values, shape, dtype=np.float64, per_atom=False):
+        mask = np.array([value is not None for value in values], dtype=bool)
+        if not mask.any():
+            return
+        if not mask.all():
+            columns[name + "_mask"] = mask
+        if per_atom:
+            column = np.concatenate(
+                [
+                    np.zeros((n,) + shape, dtype=dtype)
+                    if value is None
+                    else np.asarray(value, dtype=dtype).reshape((n,) + shape)
+                    for value, n in zip(values, num_atoms)
+                ]
+            )
+        else:
+            column = np.stack(
+                [
+                    np.zeros(shape, dtype=dtype)
+                    if value is None
+                    else np.asarray(value, dtype=dtype).reshape(shape)
+                    for value in values
+                ]
+            ).reshape((len(values),) + shape)
+        columns[name] = column
+
+    def add_codes(name, values):
+        vocabulary = sorted({write_value(value) for value in values})
+        codes = {value: code for code, value in enumerate(vocabulary)}
+        columns[name] = np.array(
+            [codes[write_value(value)] for value in values], dtype=np.int32
+        )
+        vocabularies[name] = vocabulary
+
+    add_column(
+        "atomic_numbers",
+        [c.atomic_numbers for c in configurations],
+        (),
+        np.int32,
+        per_atom=True,
+    )
+    add_column("positions", [c.positions for c in configurations], (3,), per_atom=True)
+    add_column("forces", [c.forces for c in configurations], (3,), per_atom=True)
+    add_column("charges", [c.charges for c in configurations], (), per_atom=True)
+    add_column("energy", [c.energy for c in configurations], ())
+    add_column(
+        "stress",
+        [None if c.stress is None else _to_matrix(c.stress) for c in configurations],
+        (3, 3),
+    )
+    add_column(
+        "virials",
+        [None if c.virials is None else _to_matrix(c.virials) for c in configurations],
+        (3, 3),
+    )
+    add_column("dipole", [c.dipole for c in configurations], (3,))
+    add_column("cell", [c.cell for c in configurations], (3, 3))
+    add_column("pbc", [c.pbc for c in configurations], (3,), bool)
+    for key in (
+        "weight",
+        "energy_weight",
+        "forces_weight",
+        "stress_weight",
+        "virials_weight",
+    ):
+        add_column(key, [getattr(c, key) for c in configurations], ())
+    columns["hash"] = np.array(
+        [configuration_hash(c) for c in configurations], dtype=np.uint64
+    )
+    columns["composition"] = composition_masks(columns["atomic_numbers"], num_atoms)
+    add_codes("head", [c.head for c in configurations])
+    add_codes("config_type", [c.config_type for c in configurations])
+
+    if r_max is not None:
+        neighborhoods = get_neighborhoods(
+            positions=[config.positions for config in configurations],
+            cutoff=r_max,
+            pbc=[config.pbc for config in configurations],
+            cell=[config.cell for config in configurations],
+        )
+        num_edges = [edge_index.shape[1] for edge_index, _, _ in neighborhoods]
+        columns["edge_ptr"] = np.concatenate([[0], np.cumsum(num_edges)]).astype(
+            np.int64
+        )
+        columns["edge_index"] = np.concatenate(
+            [np.zeros((2, 0), dtype=np.int32)]
+            + [edge_index for edge_index, _, _ in neighborhoods],
+            axis=1,
+        ).astype(np.int32)
+        columns["unit_shifts"] = np.concatenate(
+            [np.zeros((0, 3), dtype=np.int32)]
+            + [unit_shifts for _, _, unit_shifts in neighborhoods],
+        ).astype(np.int32)
+    return columns, vocabularies
+
+
+def save_configurations_as_columnar_HDF5(
+    configurations: Configurations, h5_file, r_max: Optional[float] = None
+) -> None:
+    """
+    Save configurations to an HDF5 file in the columnar layout, with one dataset per
+    column of `configurations_to_columns`. Vocabularies of the string fields are stored
+    in the attributes of their datasets.
+    """
+    columns, vocabularies = configurations_to_columns(configurations, r_max=r_max)
+    h5_file.attrs["format"] = "columnar"
+    h5_file.attrs["num_configs"] = len(configurations)
+    if r_max is not None:
+        h5_file.attrs["r_max"] = r_max
+    for key, column in columns.items():
+        h5_file[key] = column
+    for key, vocabulary in vocabularies.items():
+        h5_file[key].attrs["vocabulary"] = vocabulary
+
+
+def _to_matrix(value: np.ndarray) -> np.ndarray:
+    # Same conventions as mace.tools.voigt_to_matrix
+    value = np.asarray(value)
+    if value.shape == (6,):
+        return np.array(
+            [
+                [value[0], value[5], value[4]],
+                [value[5], value[1], value[3]],
+                [value[4], value[3], value[2]],
+            ]
+        )
+    return value.reshape(3, 3)
 
 
 def write_value(value):
@@ -0,0 +1,163 @@
+import io
+import logging
+import multiprocessing as mp
+import os
+import zipfile
+from typing import List, Optional, Sequence, Union
+
+import ase.io
+import ase.io.formats
+import numpy as np
+
+XYZ_EXTENSIONS = (".xyz", ".extxyz")
+# Frames are parsed in byte ranges of about this size at most (or of one frame), so
+# that the text of a large file is never held in memory at once
+MAX_RANGE_BYTES = 1 << 22
+
+
+def index_path(file_path: str) -> str:
+    return file_path + ".idx.npz"
+
+
+def build_xyz_index(file_path: str, chunk_size: int = 1 << 26) -> np.ndarray:
+    """
+    Byte offsets of the frames of an (ext)xyz file, followed by the size of the file,
+    found by reading the atom count line of each frame and skipping the lines of its
+    atoms. The file is scanned in chunks of chunk_size bytes.
+    """
+    data = np.memmap(file_path, dtype=np.uint8, mode="r")
+    size = len(data)
+    offsets = []
+    lines_to_skip = 0
+    line_start = 0
+    for chunk_start in range(0, size, chunk_size):
+        chunk = data[chunk_start : chunk_start + chunk_size]
+        line_ends = np.flatnonzero(chunk == ord("\n")) + chunk_start
+        i = 0
+        while i < len(line_ends):
+            if lines_to_skip > 0:
+                skipped = min(lines_to_skip, len(line_ends) - i)
+                i += skipped
+                lines_to_skip -= skipped
+                line_start = int(line_ends[i - 1]) + 1
+                continue
+            header = bytes(data[line_start : line_ends[i]]).strip()
+            if len(header) > 0:
+                offsets.append(line_start)
+                # Comment line and atoms of the frame
+                lines_to_skip = int(header) + 1
+            line_start = int(line_ends[i]) + 1
+            i += 1
+    # The last line may not end with a newline
+    if line_start < size and len(bytes(data[line_start:size]).strip()) > 0:
+        lines_to_skip -= 1
+    if lines_to_skip != 0:
+        raise ValueError(f"Unexpected end of file in {file_path}")
+    offsets.append(size)
+    return np.array(offsets, dtype=np.int64)
+
+
+def load_xyz_index(file_path: str, save: bool = True) -> np.ndarray:
+    """
+    Frame offsets of an (ext)xyz file, read from the index saved next to it if it is up
+    to date and readable, and otherwise built (and saved if possible)
+    """
+    stat = os.stat(file_path)
+    path = index_path(file_path)
+    if os.path.isfile(path):
+        try:
+            with np.load(path) as index:
+                if index["size"] == stat.st_size and index["mtime"] == stat.st_mtime_ns:
+                    return index["offsets"]
+        except (OSError, ValueError, EOFError, KeyError, zipfile.BadZipFile) as e:
+            logging.warning(f"Rebuilding the unreadable frame index of {file_path}: {e}")
+    offsets = build_xyz_index(file_path)
+    if save:
+        # Written to a temporary file first, as other processes may read the index
+        # (np.savez appends .npz to other names)
+        part_path = f"{path}.{os.getpid()}.part.npz"
+        try:
+            np.savez(
+                part_path, offsets=offsets, size=stat.st_size, mtime=stat.st_mtime_ns
+            )
+            os.replace(part_path, path)
+        except OSError as e:
+            logging.warning(f"Could not save the frame index of {file_path}: {e}")
+    return offsets
+
+
+def read_xyz_range(file_path: str, start: int, stop: int) -> List[ase.Atoms]:
+    """Frames stored between the byte offsets start and stop of an (ext)xyz file"""
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        content = f.read(stop - start)
+    if len(content) == 0:
+        return []
+    # Decoded as it is parsed (io.StringIO would hold several times its size)
+    text = io.TextIOWrapper(io.BytesIO(content), encoding="utf-8")
+    atoms = ase.io.read(text, index=":", format="extxyz")
+    return atoms if isinstance(atoms, list) else [atoms]
+
+
+def _contiguous_runs(
+    frames: np.ndarray,
+    offsets: np.ndarray,
+    max_length: int,
+    max_bytes: int,
+) -> List[np.ndarray]:
+    # Split frame indices into runs of consecutive frames of at most max_length frames,
+    # and of at most about max_bytes bytes (at most 2 * max_bytes, or one frame)
+    breaks = np.flatnonzero(np.diff(frames) != 1) + 1
+    runs = []
+    for run in np.split(frames, breaks):
+        if len(run) == 0:
+            continue
+        ends = offsets[run + 1] - offsets[run[0]]
+        groups = np.stack([np.arange(len(run)) // max_length, (ends - 1) // max_bytes])
+        starts = np.flatnonzero(np.any(np.diff(groups, axis=1) != 0, axis=0)) + 1
+        runs.extend(np.split(run, starts))
+    return runs
+
+
+def read_xyz(
+    file_path: str,
+    index: Union[str, int, slice, Sequence[int]] = ":",
+    num_workers: int = 1,
+    offsets: Optional[np.ndarray] = None,
+) -> Union[ase.Atoms, List[ase.Atoms]]:
+    """
+    Drop-in for ase.io.read on (ext)xyz files that seeks to the frames of index using the
+    frame index of the file, and parses them in num_workers processes, each reading
+    disjoint byte ranges of at most a few MB. Other formats are read with ase.io.read.
+    """
+    if not file_path.endswith(XYZ_EXTENSIONS):
+        return ase.io.read(file_path, index=index)
+    if offsets is None:
+        offsets = load_xyz_index(file_path)
+    num_frames = len(offsets) - 1
+    if isinstance(index, str):
+        index = ase.io.formats.string2index(index)
+    if isinstance(index, int):
+        frame = range(num_frames)[index]
+        return read_xyz_range(file_path, offsets[frame], offsets[frame + 1])[0]
+    if isinstance(index, slice):
+        frames = np.arange(num_frames)[index]
+    else:
+        frames = np.arange(num_frames)[np.asarray(index, dtype=np.int64)]
+    if len(frames) == 0:
+        return []
+
+    # Several ranges per worker to balance frames of different sizes
+    num_ranges = 1 if num_workers <= 1 else 4 * num_workers
+    runs = _contiguous_runs(
+        frames,
+        offsets,
+        max_length=-(-len(frames) // num_ranges),
+        max_bytes=MAX_RANGE_BYTES,
+    )
+    ranges = [(file_path, offsets[run[0]], offsets[run[-1] + 1]) for run in runs]
+    if num_workers <= 1:
+        return [atoms for r in ranges for atoms in read_xyz_range(*r)]
+    with mp.Pool(processes=num_workers) as pool:
+        chunks = pool.starmap(read_xyz_range, ranges)
+    return [atoms for chunk in chunks for atoms in chunk]
@@ -14,6 +14,7 @@ from .torch_tools import (
     to_one_hot,
     voigt_to_matrix,
 )
+from .padding import PaddingCollater, pad_batch, strip_padding
 from .train import SWAContainer, evaluate, train
 from .utils import (
     AtomicNumberTable,
@@ -69,4 +70,7 @@ __all__ = [
     "load_foundations_elements",
     "extract_load",
     "build_preprocess_arg_parser",
+    "PaddingCollater",
+    "pad_batch",
+    "strip_padding",
 ]
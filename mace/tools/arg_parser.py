@@ -284,6 +284,94 @@ def build_default_arg_parser() -> argparse.ArgumentParser:
         type=int,
         default=0,
     )
+    parser.add_argument(
+        "--contiguous_batches",
+        help="Build training batches from consecutive configurations of a shard, so "
+        "that columnar h5 files are read with one call per batch",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--max_atoms_per_batch",
+        help="Build training batches of as many graphs as fit in this number of atoms, "
+        "instead of batch_size graphs",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--max_edges_per_batch",
+        help="Build training batches of as many graphs as fit in this number of edges, "
+        "instead of batch_size graphs. Requires graphs stored by preprocess_data for "
+        "the same r_max when training from h5 files",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--size_buckets",
+        help="Draw each training batch from one of this many classes of graphs of "
+        "similar sizes (0 to disable)",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--pad_batches",
+        help="Pad training batches drawn from size buckets to the shape of their "
+        "bucket, so that the model sees at most size_buckets shapes (e.g. for "
+        "torch.compile)",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--prefetch_depth",
+        help="Number of batches loaded and copied to the device in a background "
+        "thread ahead of the training and validation steps (0 to load them in the "
+        "loop)",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--packed_transfer",
+        help="Copy each batch to the device as one buffer per dtype, instead of one "
+        "copy per tensor",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--streaming",
+        help="Stream the shards of sharded training sets sequentially, dealing whole "
+        "shards to ranks and workers, instead of reading them at random",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--shuffle_buffer_size",
+        help="Number of graphs in the shuffle buffer of each worker when streaming",
+        type=int,
+        default=1000,
+    )
+    parser.add_argument(
+        "--shared_memory",
+        help="Copy the preprocessed train and validation data to /dev/shm once per node, "
+        "and map it from every rank and DataLoader worker",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--hdf5_cache_size",
+        help="Memory budget in MB, per process, for keeping the graphs built from the "
+        "HDF5 files of each head and split in memory between epochs (0 to disable)",
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        "--statistics_cache",
+        help="JSON file caching the statistics (avg_num_neighbors, mean, std) computed "
+        "from the training set of each head, keyed by a fingerprint of the files and "
+        "settings they depend on. Defaults to statistics_cache.json in checkpoints_dir; "
+        "an empty string disables the cache",
+        type=str,
+        default=None,
+    )
     parser.add_argument(
         "--pin_memory",
         help="Pin memory for data loading",
@@ -776,6 +864,13 @@ def build_preprocess_arg_parser() -> argparse.ArgumentParser:
         type=int,
         default=int(os.cpu_count() / 4),
     )
+    parser.add_argument(
+        "--num_read_workers",
+        help="Number of processes parsing the xyz file or the directory of extxyz "
+        "files (default: the number of CPUs available to the process)",
+        type=int,
+        default=None,
+    )
     parser.add_argument(
         "--valid_fraction",
         help="Fraction of training set used for validation",
@@ -878,6 +973,57 @@ def build_preprocess_arg_parser() -> argparse.ArgumentParser:
         action="store_true",
         default=False,
     )
+    parser.add_argument(
+        "--h5_format",
+        help="Layout of the h5 files: one group per configuration (grouped) or one "
+        "dataset per field concatenated over all configurations (columnar)",
+        type=str,
+        default="grouped",
+        choices=["grouped", "columnar"],
+    )
+    parser.add_argument(
+        "--streaming",
+        help="Read the input files one structure at a time and write shards while "
+        "reading, instead of loading the whole dataset in memory",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--deduplicate",
+        help="Drop structures with the same atoms, positions and cell (to 1e-6) and "
+        "head as an earlier one, across the train, valid and test files and, when "
+        "appending, the existing shards",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--append",
+        help="Add the input files to the shards already under h5_prefix, as new shards "
+        "numbered after the existing ones, and update the manifests and statistics "
+        "without reading the existing shards again (implies --streaming)",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--max_memory",
+        help="Approximate memory in MB of structures held at once when streaming",
+        type=float,
+        default=4096,
+    )
+    parser.add_argument(
+        "--convert_to_mmap",
+        help="Convert existing h5 files (train_file, valid_file and test_file, each an h5 "
+        "file or a directory of them) into memory-mapped .npy arrays under h5_prefix",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--store_graphs",
+        help="Store the edge_index and unit_shifts computed with r_max in the h5 files, "
+        "so that they are not rebuilt when training with the same r_max",
+        action="store_true",
+        default=False,
+    )
     parser.add_argument(
         "--batch_size",
         help="batch size to compute average number of neighbours",
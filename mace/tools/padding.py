@@ -0,0 +1,162 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+from .torch_geometric.batch import Batch
+
+# Shape of a padded batch: numbers of graphs, nodes and edges (None to round the
+# number of edges up to a power of two)
+PaddedShape = Tuple[int, int, Optional[int]]
+
+NODE_KEYS = ("positions", "node_attrs", "forces", "charges")
+EDGE_KEYS = ("shifts", "unit_shifts")
+NODE_OUTPUT_KEYS = ("node_energy", "forces", "node_feats", "atomic_dipoles")
+GRAPH_OUTPUT_KEYS = (
+    "energy",
+    "interaction_energy",
+    "contributions",
+    "virials",
+    "stress",
+    "displacement",
+    "dipole",
+)
+
+# Padding edges are this long, far beyond any cutoff, so that they carry no messages
+PADDING_EDGE_LENGTH = 1000.0
+
+
+def _next_power_of_two(value: int) -> int:
+    return 1 << max(value - 1, 0).bit_length()
+
+
+def pad_batch(batch: Batch, num_graphs: int, num_nodes: int, num_edges: int) -> Batch:
+    """
+    Pad a batch of AtomicData to num_graphs graphs, num_nodes nodes and num_edges
+    edges. The padding nodes and edges form one extra graph, followed by empty graphs:
+    its nodes have no element (all-zero node_attrs) and its edges, from and to its
+    first node, are longer than any cutoff, so it leaves the outputs of the other
+    graphs unchanged. Its weights are zero. The numbers of graphs, nodes and edges
+    before padding are kept in __padding__, for strip_padding.
+    """
+    real_graphs = batch.num_graphs
+    real_nodes = batch.num_nodes
+    real_edges = batch.edge_index.shape[1]
+    assert num_graphs > real_graphs and num_nodes > real_nodes
+    assert num_edges >= real_edges
+    pad_graphs = num_graphs - real_graphs
+    pad_nodes = num_nodes - real_nodes
+    pad_edges = num_edges - real_edges
+
+    def pad(item: torch.Tensor, rows: int) -> torch.Tensor:
+        padding = item.new_zeros((rows,) + tuple(item.shape[1:]))
+        return torch.cat([item, padding], dim=0)
+
+    padded = Batch()
+    for key in batch.keys:
+        item = batch[key]
+        if key == "edge_index":
+            padding = torch.full(
+                (2, pad_edges), real_nodes, dtype=item.dtype, device=item.device
+            )
+            padded[key] = torch.cat([item, padding], dim=1)
+        elif key == "batch":
+            padded[key] = torch.cat(
+                [item, item.new_full((pad_nodes,), real_graphs)], dim=0
+            )
+        elif key == "ptr":
+            padded[key] = torch.cat([item, item.new_full((pad_graphs,), num_nodes)])
+        elif key in NODE_KEYS:
+            padded[key] = pad(item, pad_nodes)
+        elif key in EDGE_KEYS:
+            padding = item.new_zeros((pad_edges,) + tuple(item.shape[1:]))
+            padding[:, 0] = 1.0 if key == "unit_shifts" else PADDING_EDGE_LENGTH
+            padded[key] = torch.cat([item, padding], dim=0)
+        elif key == "cell":
+            cells = torch.eye(3, dtype=item.dtype, device=item.device)
+            cells = (PADDING_EDGE_LENGTH * cells).repeat(pad_graphs, 1)
+            padded[key] = torch.cat([item, cells], dim=0)
+        elif isinstance(item, torch.Tensor):
+            # Graph level attributes, possibly with several rows per graph
+            padded[key] = pad(item, pad_graphs * (item.shape[0] // real_graphs))
+        else:
+            padded[key] = item
+    padded.__num_graphs__ = num_graphs
+    padded.__data_class__ = batch.__data_class__
+    padded.__padding__ = (real_graphs, real_nodes, real_edges)
+    return padded
+
+
+def strip_padding(
+    batch: Batch, output: Dict[str, Optional[torch.Tensor]]
+) -> Tuple[Batch, Dict[str, Optional[torch.Tensor]]]:
+    """Batch and model outputs without the padding added by pad_batch"""
+    padding = getattr(batch, "__padding__", None)
+    if padding is None:
+        return batch, output
+    real_graphs, real_nodes, real_edges = padding
+    num_graphs = batch.num_graphs
+
+    stripped = Batch()
+    for key in batch.keys:
+        item = batch[key]
+        if key == "edge_index":
+            stripped[key] = item[:, :real_edges]
+        elif key == "batch" or key in NODE_KEYS:
+            stripped[key] = item[:real_nodes]
+        elif key == "ptr":
+            stripped[key] = item[: real_graphs + 1]
+        elif key in EDGE_KEYS:
+            stripped[key] = item[:real_edges]
+        elif isinstance(item, torch.Tensor):
+            stripped[key] = item[: real_graphs * (item.shape[0] // num_graphs)]
+        else:
+            stripped[key] = item
+    stripped.__num_graphs__ = real_graphs
+    stripped.__data_class__ = batch.__data_class__
+
+    output = dict(output)
+    for key, value in output.items():
+        if value is None:
+            continue
+        if key in NODE_OUTPUT_KEYS:
+            output[key] = value[:real_nodes]
+        elif key in GRAPH_OUTPUT_KEYS:
+            output[key] = value[: real_graphs * (value.shape[0] // num_graphs)]
+    return stripped, output
+
+
+class PaddingCollater:
+    """
+    Collate function padding each batch to the smallest of shapes it fits in (see
+    pad_batch), so that the model only sees a bounded number of tensor shapes. The
+    number of edges of shapes without one is rounded up to a power of two, as are the
+    numbers of nodes and edges of batches that fit in none of shapes.
+    """
+
+    def __init__(self, shapes: Sequence[PaddedShape]):
+        self.shapes: List[PaddedShape] = sorted(
+            shapes, key=lambda shape: (shape[1], shape[2] or 0, shape[0])
+        )
+
+    def padded_shape(self, num_graphs: int, num_nodes: int, num_edges: int) -> Tuple:
+        for shape_graphs, shape_nodes, shape_edges in self.shapes:
+            if shape_edges is None:
+                shape_edges = _next_power_of_two(num_edges)
+            if (
+                num_graphs < shape_graphs
+                and num_nodes < shape_nodes
+                and num_edges <= shape_edges
+            ):
+                return shape_graphs, shape_nodes, shape_edges
+        return (
+            num_graphs + 1,
+            _next_power_of_two(num_nodes + 1),
+            _next_power_of_two(num_edges),
+        )
+
+    def __call__(self, data_list) -> Batch:
+        batch = Batch.from_data_list_vectorized(data_list)
+        shape = self.padded_shape(
+            batch.num_graphs, batch.num_nodes, batch.edge_index.shape[1]
+        )
+        return pad_batch(batch, *shape)
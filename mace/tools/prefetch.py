@@ -0,0 +1,135 @@
+import queue
+import threading
+import time
+from typing import Iterable, Iterator, Optional
+
+import torch
+
+from .torch_geometric.batch import Batch
+
+
+class _Failure:
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+_END = object()
+
+
+class DevicePrefetcher:
+    """
+    Iterates over a data loader in a background thread, keeping up to depth batches
+    ahead of the training loop: each batch is collated (by the loader), pinned and
+    copied to device without blocking, on a separate CUDA stream, while the previous
+    steps run. On CPU the collation is still done ahead. With depth=0, batches are
+    loaded and moved in the loop, as without a prefetcher. With packed=True, batches
+    are moved with one copy per dtype (see Data.to_packed) instead of one per tensor.
+    wait_time is the time the loop spent waiting for batches in the current
+    iteration, and last_wait_time the wait for the last batch.
+    """
+
+    def __init__(
+        self,
+        data_loader: Iterable,
+        device: torch.device,
+        depth: int = 2,
+        packed: bool = False,
+    ):
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.packed = packed
+        self.wait_time = 0.0
+        self.last_wait_time = 0.0
+        self.cuda = self.device.type == "cuda" and torch.cuda.is_available()
+
+    def __len__(self) -> int:
+        return len(self.data_loader)
+
+    def _to_device(self, batch: Batch, stream: Optional[torch.cuda.Stream]) -> Batch:
+        if stream is None:
+            if self.packed:
+                return batch.to_packed(self.device)
+            return batch.to(self.device)
+        with torch.cuda.stream(stream):
+            if self.packed:
+                batch = batch.to_packed(self.device, non_blocking=True)
+            else:
+                # Asynchronous copies need page-locked memory
+                batch = batch.apply(lambda x: x if x.is_pinned() else x.pin_memory())
+                batch = batch.to(self.device, non_blocking=True)
+            batch.__copied__ = torch.cuda.Event()
+            batch.__copied__.record(stream)
+        return batch
+
+    def _produce(
+        self,
+        batches: queue.Queue,
+        stop: threading.Event,
+        stream: Optional[torch.cuda.Stream],
+    ) -> None:
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            if stream is not None:
+                torch.cuda.set_device(self.device)
+            for batch in self.data_loader:
+                if not put(self._to_device(batch, stream)):
+                    return
+        except BaseException as e:  # pylint: disable=broad-except
+            put(_Failure(e))
+            return
+        put(_END)
+
+    def _ready(self, batch: Batch) -> Batch:
+        copied = getattr(batch, "__copied__", None)
+        if copied is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(copied)
+            # The memory of the batch must not be reused while the step uses it
+            batch.apply(lambda x: x.record_stream(stream) or x)
+            batch.__copied__ = None
+        return batch
+
+    def __iter__(self) -> Iterator[Batch]:
+        self.wait_time = 0.0
+        if self.depth <= 0:
+            iterator = iter(self.data_loader)
+            while True:
+                start = time.perf_counter()
+                try:
+                    batch = self._to_device(next(iterator), None)
+                except StopIteration:
+                    return
+                self.last_wait_time = time.perf_counter() - start
+                self.wait_time += self.last_wait_time
+                yield batch
+
+        stream = torch.cuda.Stream(self.device) if self.cuda else None
+        batches: queue.Queue = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self._produce, args=(batches, stop, stream), daemon=True
+        )
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = batches.get()
+                self.last_wait_time = time.perf_counter() - start
+                self.wait_time += self.last_wait_time
+                if item is _END:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.exception
+                yield self._ready(item)
+        finally:
+            stop.set()
+            thread.join()
@@ -42,6 +42,7 @@ def get_dataset_from_xyz(
     virials_key: str = "virials",
     dipole_key: str = "dipoles",
     charges_key: str = "charges",
+    num_workers: int = 1,
 ) -> Tuple[SubsetCollection, Optional[Dict[int, float]]]:
     """Load training and test dataset from xyz file"""
     atomic_energies_dict, all_train_configs, heads = data.load_from_xyz(
@@ -55,6 +56,7 @@ def get_dataset_from_xyz(
         charges_key=charges_key,
         extract_atomic_energies=True,
         keep_isolated_atoms=keep_isolated_atoms,
+        num_workers=num_workers,
     )
     logging.info(
         f"Loaded {len(all_train_configs)} training configurations from '{train_path}'"
@@ -70,6 +72,7 @@ def get_dataset_from_xyz(
             dipole_key=dipole_key,
             charges_key=charges_key,
             extract_atomic_energies=False,
+            num_workers=num_workers,
         )
         logging.info(
             f"Loaded {len(valid_configs)} validation configurations from '{valid_path}'"
@@ -101,6 +104,7 @@ def get_dataset_from_xyz(
             dipole_key=dipole_key,
             charges_key=charges_key,
             extract_atomic_energies=False,
+            num_workers=num_workers,
         )
         # create list of tuples (config_type, list(Atoms))
         test_configs = data.test_config_types(all_test_configs)
@@ -194,11 +198,13 @@ def get_dataset_from_extxyzs(
     config_type_weights: Dict,
     test_path: str = None,
     seed: int = 1234,
+    num_workers: Optional[int] = None,
     ) -> Tuple[SubsetCollection, Optional[Dict[int, float]]]:
     """Load training and test dataset from xyz file"""
     atomic_energies_dict, all_train_configs, heads = data.load_from_extxyzs(
         file_path=train_path,
         config_type_weights=config_type_weights,
+        num_workers=num_workers,
     )
     logging.info(
         f"Loaded {len(all_train_configs)} training configurations from '{train_path}'"
@@ -207,6 +213,7 @@ def get_dataset_from_extxyzs(
         _, valid_configs, _ = data.load_from_extxyzs(
             file_path=valid_path,
             config_type_weights=config_type_weights,
+            num_workers=num_workers,
         )
         logging.info(
             f"Loaded {len(valid_configs)} validation configurations from '{valid_path}'"
@@ -232,6 +239,7 @@ def get_dataset_from_extxyzs(
         _, all_test_configs, _ = data.load_from_extxyzs(
             file_path=test_path,
             config_type_weights=config_type_weights,
+            num_workers=num_workers,
         )
         # create list of tuples (config_type, list(Atoms))
         test_configs = data.test_config_types(all_test_configs)
@@ -502,6 +510,7 @@ def create_error_table(
             data_loader=data_loader,
             output_args=output_args,
             device=device,
+            rank=torch.distributed.get_rank() if distributed else 0,
         )
         if distributed:
             torch.distributed.barrier()
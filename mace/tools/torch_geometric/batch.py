@@ -1,4 +1,6 @@
+import re
 from collections.abc import Sequence
+from itertools import accumulate
 from typing import List
 
 import numpy as np
@@ -150,6 +152,85 @@ class Batch(Data):
 
         return batch.contiguous()
 
+    @classmethod
+    def from_data_list_vectorized(cls, data_list):
+        r"""Constructs the same batch as :meth:`from_data_list` (without
+        :obj:`follow_batch` or :obj:`exclude_keys`) with a single
+        :obj:`torch.cat` per key. The increments of the :obj:`*index*` keys and
+        the assignment vector :obj:`batch` are computed at once from the numbers
+        of nodes of the graphs. Falls back to :meth:`from_data_list` for data
+        objects that are not plain tensors with the default :meth:`__cat_dim__`
+        and :meth:`__inc__`."""
+
+        ref_data = data_list[0]
+        data_class = ref_data.__class__
+        keys = ref_data.keys
+        num_nodes_list = [data.num_nodes for data in data_list]
+        if (
+            data_class.__cat_dim__ is not Data.__cat_dim__
+            or data_class.__inc__ is not Data.__inc__
+            or any(data.__class__ is not data_class for data in data_list)
+            or any(not isinstance(ref_data[key], Tensor) for key in keys)
+            or any(num_nodes is None for num_nodes in num_nodes_list)
+            or len(keys) == 0
+        ):
+            return cls.from_data_list(data_list)
+        assert "batch" not in keys and "ptr" not in keys
+
+        batch = cls()
+        for key in ref_data.__dict__.keys():
+            if key[:2] != "__" and key[-2:] != "__":
+                batch[key] = None
+
+        num_graphs = len(data_list)
+        batch.__num_graphs__ = num_graphs
+        batch.__data_class__ = data_class
+
+        num_nodes = torch.tensor(num_nodes_list, dtype=torch.long)
+        node_offsets = torch.cumsum(num_nodes, 0) - num_nodes
+        device = data_list[-1][keys[-1]].device
+
+        slices, cumsum, cat_dims = {}, {}, {}
+        for key in keys:
+            items = [data[key] for data in data_list]
+            item = items[0]
+            if item.dim() == 0:
+                cat_dims[key] = None
+                sizes = [1] * num_graphs
+                batch[key] = torch.stack(items)
+            else:
+                cat_dim = ref_data.__cat_dim__(key, item)
+                cat_dims[key] = cat_dim
+                sizes = [item.size(cat_dim) for item in items]
+                value = torch.cat(items, cat_dim)
+                if bool(re.search("(index|face)", key)) and value.dtype != torch.bool:
+                    shape = [1] * value.dim()
+                    shape[cat_dim] = -1
+                    offsets = torch.repeat_interleave(
+                        node_offsets, torch.tensor(sizes, dtype=torch.long)
+                    )
+                    value = value + offsets.to(value.device, value.dtype).view(shape)
+                batch[key] = value
+
+            slices[key] = list(accumulate(sizes, initial=0))
+            if bool(re.search("(index|face)", key)):
+                cumsum[key] = list(accumulate(num_nodes_list, initial=0))
+            else:
+                cumsum[key] = [0] * (num_graphs + 1)
+
+        batch.batch = torch.repeat_interleave(
+            torch.arange(num_graphs, device=device), num_nodes.to(device)
+        )
+        batch.ptr = torch.tensor(list(accumulate(num_nodes_list, initial=0)))
+        batch.__slices__ = slices
+        batch.__cumsum__ = cumsum
+        batch.__cat_dims__ = cat_dims
+        batch.__num_nodes_list__ = [
+            getattr(data, "__num_nodes__", None) for data in data_list
+        ]
+
+        return batch.contiguous()
+
     def get_example(self, idx: int) -> Data:
         r"""Reconstructs the :class:`torch_geometric.data.Data` object at index
         :obj:`idx` from the batch object.
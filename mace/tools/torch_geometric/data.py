@@ -301,6 +301,32 @@ class Data(object):
         attributes."""
         return self.apply(lambda x: x.to(device, **kwargs), *keys)
 
+    def to_packed(self, device, *keys, non_blocking=False):
+        r"""Copies all attributes :obj:`*keys` to :obj:`device` like :meth:`to`,
+        but with one transfer per dtype: the CPU tensors of each dtype are
+        concatenated into a single buffer (page-locked when copying to a GPU),
+        which is copied at once, and replaced by views of the copied buffer.
+        If :obj:`*keys` is not given, all present attributes are copied."""
+        device = torch.device(device)
+        pin = device.type == "cuda" and torch.cuda.is_available()
+        groups = {}
+        for key, item in self(*keys):
+            if not torch.is_tensor(item):
+                continue
+            if item.device.type == "cpu":
+                groups.setdefault(item.dtype, []).append(key)
+            else:
+                self[key] = item.to(device, non_blocking=non_blocking)
+        for dtype, group in groups.items():
+            items = [self[key] for key in group]
+            sizes = [item.numel() for item in items]
+            buffer = torch.empty(sum(sizes), dtype=dtype, pin_memory=pin)
+            torch.cat([item.reshape(-1) for item in items], out=buffer)
+            buffer = buffer.to(device, non_blocking=non_blocking)
+            for key, item, view in zip(group, items, buffer.split(sizes)):
+                self[key] = view.view(item.shape)
+        return self
+
     def cpu(self, *keys):
         r"""Copies all attributes :obj:`*keys` to CPU memory.
         If :obj:`*keys` is not given, the conversion is applied to all present
@@ -17,6 +17,8 @@ class Collater:
     def __call__(self, batch):
         elem = batch[0]
         if isinstance(elem, Data):
+            if not any(self.follow_batch or []) and not any(self.exclude_keys or []):
+                return Batch.from_data_list_vectorized(batch)
             return Batch.from_data_list(
                 batch,
                 follow_batch=self.follow_batch,
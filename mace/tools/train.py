@@ -26,6 +26,8 @@ from torchmetrics import Metric
 
 from . import torch_geometric
 from .checkpoint import CheckpointHandler, CheckpointState
+from .padding import strip_padding
+from .prefetch import DevicePrefetcher
 from .torch_tools import to_numpy
 from .utils import (
     MetricsLogger,
@@ -161,6 +163,8 @@ def train(
     rank: Optional[int] = 0,
     kfac: Optional[KFACPreconditioner] = None,
     kfac_scheduler: Optional[LambdaParamScheduler] = None, 
+    prefetch_depth: int = 0,
+    packed_transfer: bool = False,
 ):
     lowest_loss = np.inf
     valid_loss = np.inf
@@ -215,7 +219,7 @@ def train(
         #print(f"rank {rank}: start train")
         
         # Train
-        if distributed:
+        if train_sampler is not None:
             train_sampler.set_epoch(epoch)
 
         train_one_epoch(
@@ -233,6 +237,8 @@ def train(
             rank=rank,
             kfac=kfac,
             kfac_scheduler=kfac_scheduler,
+            prefetch_depth=prefetch_depth,
+            packed_transfer=packed_transfer,
         )
         if distributed:
             torch.distributed.barrier()
@@ -255,6 +261,9 @@ def train(
                         data_loader=valid_loader,
                         output_args=output_args,
                         device=device,
+                        prefetch_depth=prefetch_depth,
+                        packed_transfer=packed_transfer,
+                        rank=rank,
                     )
                     valid_loss += valid_loss_head
 
@@ -340,9 +349,13 @@ def train_one_epoch(
     rank: Optional[int] = 0,
     kfac: Optional[KFACPreconditioner] = None,
     kfac_scheduler: Optional[LambdaParamScheduler] = None, 
+    prefetch_depth: int = 0,
+    packed_transfer: bool = False,
 ) -> None:
     model_to_train = model if distributed_model is None else distributed_model
-    
+    data_loader = DevicePrefetcher(
+        data_loader, device, depth=prefetch_depth, packed=packed_transfer
+    )
 
     if rank == 0:
         data_iter = tqdm(data_loader)
@@ -365,13 +378,32 @@ def train_one_epoch(
         )
         opt_metrics["mode"] = "opt"
         opt_metrics["epoch"] = epoch
+        opt_metrics["data_time"] = data_loader.last_wait_time
         if rank == 0:
             logger.log(opt_metrics)
+    if rank == 0:
+        logging.info(
+            f"Epoch {epoch}: waited {data_loader.wait_time:.2f} s for training data"
+        )
+    _log_cache_statistics(data_loader.data_loader, f"Epoch {epoch}: training", rank)
 
     if kfac_scheduler is not None:
         kfac_scheduler.step(step=epoch)
 
 
+def _log_cache_statistics(
+    data_loader: DataLoader, description: str, rank: Optional[int] = 0
+) -> None:
+    # mace.data imports mace.tools
+    from mace.data.hdf5_dataset import (  # pylint: disable=import-outside-toplevel
+        log_cache_statistics,
+    )
+
+    dataset = getattr(data_loader, "dataset", None)
+    if dataset is not None:
+        log_cache_statistics(dataset, description, log=rank == 0)
+
+
 def take_step(
     model: torch.nn.Module,
     loss_fn: torch.nn.Module,
@@ -396,6 +428,7 @@ def take_step(
         compute_stress=output_args["stress"],
     )
     #print(f"rank {dist.get_rank()}: end forward")
+    batch, output = strip_padding(batch, output)
     loss = loss_fn(pred=output, ref=batch)
     loss.backward()
     # TODO: gradient analysis
@@ -424,11 +457,17 @@ def evaluate(
     data_loader: DataLoader,
     output_args: Dict[str, bool],
     device: torch.device,
+    prefetch_depth: int = 0,
+    packed_transfer: bool = False,
+    rank: Optional[int] = 0,
 ) -> Tuple[float, Dict[str, Any]]:
     for param in model.parameters():
         param.requires_grad = False
 
     metrics = MACELoss(loss_fn=loss_fn).to(device)
+    data_loader = DevicePrefetcher(
+        data_loader, device, depth=prefetch_depth, packed=packed_transfer
+    )
 
     start_time = time.time()
     for batch in data_loader:
@@ -441,11 +480,14 @@ def evaluate(
             compute_virials=output_args["virials"],
             compute_stress=output_args["stress"],
         )
+        batch, output = strip_padding(batch, output)
         avg_loss, aux = metrics(batch, output)
 
     avg_loss, aux = metrics.compute()
     aux["time"] = time.time() - start_time
+    aux["data_time"] = data_loader.wait_time
     metrics.reset()
+    _log_cache_statistics(data_loader.data_loader, "Evaluation", rank)
 
     for param in model.parameters():
         param.requires_grad = True
@@ -1,20 +1,76 @@
+import argparse
+import os
 from copy import deepcopy
 from pathlib import Path
 
 import ase.build
+import ase.io
 import h5py
 import numpy as np
+import pytest
 import torch
 
+import mace.data.manifest as manifest_module
+import mace.data.xyz_index as xyz_index_module
+from mace.cli.fine_tuning_select import (
+    filter_atoms,
+    filter_atoms_list,
+    read_pretraining_set,
+)
 from mace.data import (
     AtomicData,
+    AtomicDataCache,
+    BucketBatchSampler,
     Configuration,
+    ContiguousBatchSampler,
+    Deduplicator,
+    DynamicBatchSampler,
+    E0Accumulator,
     HDF5Dataset,
+    HeadStatistics,
+    MmapDataset,
+    ShardedConcatDataset,
+    ShardedStreamingDataset,
+    StatisticsCache,
+    VerletNeighborhood,
+    atoms_hash,
+    composition_masks,
+    compute_average_E0s,
+    compute_E0s_from_hdf5,
+    compute_loader_statistics,
+    compute_statistics_from_hdf5,
     config_from_atoms,
+    config_from_atoms_list,
+    configs_from_hdf5,
+    configs_from_hdf5_ani,
+    configuration_hash,
+    convert_hdf5_to_mmap,
+    dataset_fingerprint,
+    dataset_from_sharded_hdf5,
+    get_dataset_sizes,
     get_neighborhood,
+    get_neighborhoods,
+    iread_atoms,
+    iter_atoms_from_extxyzs,
+    list_extxyz_files,
+    load_shard_sizes,
+    load_xyz_index,
+    log_cache_statistics,
+    match_compositions,
+    query_shards,
+    read_manifest,
+    read_xyz,
+    save_configurations_as_columnar_HDF5,
     save_configurations_as_HDF5,
+    shared_memory_path,
+    stage_to_shared_memory,
+    write_manifest,
 )
-from mace.tools import AtomicNumberTable, torch_geometric
+from mace.data.manifest import summarize_shard
+from mace.data.utils import atoms_from_hdf5_ani, atoms_from_oc20
+from mace.data.xyz_index import read_xyz_range
+from mace.modules import compute_statistics
+from mace.tools import AtomicNumberTable, PaddingCollater, torch_geometric
 
 mace_path = Path(__file__).parent.parent
 
@@ -70,6 +126,49 @@ class TestAtomicData:
             assert batch.energy.shape == (2,)
             assert batch.forces.shape == (6, 3)
 
+    def test_vectorized_collate(self):
+        configs = [
+            config_from_atoms(ase.build.bulk("Cu", "fcc", a=3.6, cubic=True)),
+            config_from_atoms(ase.build.molecule("CH3OH")),
+            config_from_atoms(ase.build.molecule("H2O")),
+        ]
+        configs[0].stress = np.arange(6.0)
+        table = AtomicNumberTable([1, 6, 8, 29])
+        data_list = [
+            AtomicData.from_config(config, z_table=table, cutoff=3.0)
+            for config in configs * 2
+        ]
+        expected = torch_geometric.batch.Batch.from_data_list(data_list)
+        batch = torch_geometric.batch.Batch.from_data_list_vectorized(data_list)
+
+        assert sorted(batch.keys) == sorted(expected.keys)
+        for key in expected.keys:
+            assert batch[key].dtype == expected[key].dtype
+            assert torch.equal(batch[key], expected[key])
+        assert batch.__slices__ == expected.__slices__
+        assert batch.__cumsum__ == expected.__cumsum__
+        assert batch.__cat_dims__ == expected.__cat_dims__
+
+    def test_packed_transfer(self):
+        data_list = [
+            AtomicData.from_config(self.config, z_table=self.table, cutoff=3.0)
+        ] * 3
+        expected = torch_geometric.batch.Batch.from_data_list(data_list)
+        batch = torch_geometric.batch.Batch.from_data_list(data_list)
+        batch = batch.to_packed(torch.device("cpu"))
+
+        assert sorted(batch.keys) == sorted(expected.keys)
+        storages = {}
+        for key in expected.keys:
+            assert batch[key].dtype == expected[key].dtype
+            assert torch.equal(batch[key], expected[key])
+            storages.setdefault(batch[key].dtype, set()).add(
+                batch[key].untyped_storage().data_ptr()
+            )
+        # One buffer per dtype
+        assert all(len(ptrs) == 1 for ptrs in storages.values())
+        batch.positions.requires_grad_(True)
+
     def test_to_atomic_data_dict(self):
         data1 = AtomicData.from_config(self.config, z_table=self.table, cutoff=3.0)
         data2 = AtomicData.from_config(self.config, z_table=self.table, cutoff=3.0)
@@ -133,6 +232,405 @@ class TestAtomicData:
             assert torch.all(batch_direct.energy == batch.energy)
             assert torch.all(batch_direct.forces == batch.forces)
 
+    def test_hdf5_stored_graphs(self):
+        datasets = [self.config, self.config_2] * 5
+        with h5py.File(str(mace_path) + "test_graphs.h5", "w") as f:
+            save_configurations_as_HDF5(datasets, 0, f, r_max=3.0)
+        dataset = HDF5Dataset(
+            str(mace_path) + "test_graphs.h5", z_table=self.table, r_max=3.0
+        )
+        assert dataset.use_stored_graphs
+        assert not HDF5Dataset(
+            str(mace_path) + "test_graphs.h5", z_table=self.table, r_max=2.0
+        ).use_stored_graphs
+        for i, config in enumerate(datasets):
+            data_direct = AtomicData.from_config(config, z_table=self.table, cutoff=3.0)
+            data = dataset[i]
+            assert torch.all(data_direct.edge_index == data.edge_index)
+            assert torch.all(data_direct.shifts == data.shifts)
+            assert torch.all(data_direct.unit_shifts == data.unit_shifts)
+
+    def test_hdf5_columnar(self):
+        bulk = config_from_atoms(ase.build.bulk("Cu", "fcc", cubic=True))
+        bulk.energy_weight = 0.5
+        datasets = [self.config, self.config_2, bulk] * 3
+        table = AtomicNumberTable([1, 8, 29])
+        for r_max in (None, 3.0):
+            grouped_path = str(mace_path) + f"test_grouped_{r_max}.h5"
+            columnar_path = str(mace_path) + f"test_columnar_{r_max}.h5"
+            with h5py.File(grouped_path, "w") as f:
+                save_configurations_as_HDF5(datasets, 0, f, r_max=r_max)
+            with h5py.File(columnar_path, "w") as f:
+                save_configurations_as_columnar_HDF5(datasets, f, r_max=r_max)
+            grouped = HDF5Dataset(grouped_path, z_table=table, r_max=3.0)
+            columnar = HDF5Dataset(columnar_path, z_table=table, r_max=3.0)
+            assert columnar.columnar and len(columnar) == len(grouped)
+            assert columnar.use_stored_graphs == (r_max is not None)
+            for i in range(len(datasets)):
+                data_grouped, data_columnar = grouped[i], columnar[i]
+                assert data_grouped.keys == data_columnar.keys
+                for key in data_grouped.keys:
+                    assert torch.all(data_grouped[key] == data_columnar[key]), key
+
+    def test_mmap_dataset(self, tmp_path):
+        bulk = config_from_atoms(ase.build.bulk("Cu", "fcc", cubic=True))
+        datasets = [self.config, self.config_2, bulk] * 3
+        table = AtomicNumberTable([1, 8, 29])
+        with h5py.File(tmp_path / "test.h5", "w") as f:
+            save_configurations_as_HDF5(datasets, 0, f)
+        dtype = str(torch.get_default_dtype()).split(".")[-1]
+        for r_max in (None, 3.0):
+            convert_hdf5_to_mmap(
+                str(tmp_path / "test.h5"),
+                str(tmp_path / f"mmap_{r_max}"),
+                r_max=r_max,
+                dtype=dtype,
+            )
+            hdf5_dataset = HDF5Dataset(str(tmp_path / "test.h5"), z_table=table, r_max=3.0)
+            mmap_dataset = MmapDataset(
+                str(tmp_path / f"mmap_{r_max}"), z_table=table, r_max=3.0
+            )
+            assert len(mmap_dataset) == len(hdf5_dataset)
+            assert mmap_dataset.use_stored_graphs == (r_max is not None)
+            # Cutoffs differing by rounding errors still use the stored graphs
+            assert MmapDataset(
+                str(tmp_path / f"mmap_{r_max}"), z_table=table, r_max=3.0 + 1e-12
+            ).use_stored_graphs == (r_max is not None)
+            for i in range(len(datasets)):
+                data_hdf5, data_mmap = hdf5_dataset[i], mmap_dataset[i]
+                assert data_hdf5.keys == data_mmap.keys
+                for key in data_hdf5.keys:
+                    assert torch.all(data_hdf5[key] == data_mmap[key]), key
+                config = mmap_dataset.get_config(i)[0]
+                expected = hdf5_dataset.get_config(i)[0]
+                assert (config.config_type, config.head) == (
+                    expected.config_type,
+                    expected.head,
+                )
+
+            # Changing an item leaves the dataset unchanged
+            data = mmap_dataset[1]
+            data.positions[0, 0] = 123.0
+            assert mmap_dataset[1].positions[0, 0] != 123.0
+
+    def test_hdf5_getitems(self, tmp_path):
+        datasets = [self.config, self.config_2] * 4
+        table = AtomicNumberTable([1, 8])
+        for i in range(2):
+            with h5py.File(tmp_path / f"test_{i}.h5", "w") as f:
+                save_configurations_as_columnar_HDF5(datasets, f, r_max=3.0)
+        dataset = ShardedConcatDataset(
+            [
+                HDF5Dataset(str(tmp_path / f"test_{i}.h5"), z_table=table, r_max=3.0)
+                for i in range(2)
+            ]
+        )
+        indices = [3, 4, 5, 6, 0, 9, 10, 15]
+        for data, index in zip(dataset.__getitems__(indices), indices):
+            expected = dataset[index]
+            assert data.keys == expected.keys
+            for key in data.keys:
+                assert torch.all(data[key] == expected[key]), key
+
+        sampler = ContiguousBatchSampler(dataset, batch_size=4, seed=1)
+        batches = list(sampler)
+        assert len(batches) == len(sampler)
+        assert sorted(i for batch in batches for i in batch) == list(range(16))
+        assert any(batch == list(range(batch[0], batch[0] + 4)) for batch in batches)
+        sampler.set_epoch(1)
+        assert list(sampler) != batches
+
+        data_loader = torch_geometric.dataloader.DataLoader(
+            dataset=dataset, batch_sampler=sampler
+        )
+        assert sum(batch.num_graphs for batch in data_loader) == 16
+
+    def test_stage_to_shared_memory(self, tmp_path):
+        datasets = [self.config, self.config_2] * 2
+        table = AtomicNumberTable([1, 8])
+        (tmp_path / "shards").mkdir()
+        for i in range(2):
+            with h5py.File(tmp_path / "shards" / f"train_{i}.h5", "w") as f:
+                save_configurations_as_HDF5(datasets, 0, f)
+        shm_dir = tmp_path / "shm"
+        shm_dir.mkdir()
+        path = stage_to_shared_memory(
+            str(tmp_path / "shards"), r_max=3.0, shm_dir=str(shm_dir)
+        )
+        assert path == shared_memory_path(
+            str(tmp_path / "shards"), r_max=3.0, shm_dir=str(shm_dir)
+        )
+        assert os.listdir(shm_dir) == [os.path.basename(path)]
+        # Staging again reuses the copy
+        assert (
+            stage_to_shared_memory(
+                str(tmp_path / "shards"), r_max=3.0, shm_dir=str(shm_dir)
+            )
+            == path
+        )
+
+        staged = dataset_from_sharded_hdf5(path, z_table=table, r_max=3.0)
+        original = dataset_from_sharded_hdf5(
+            str(tmp_path / "shards"), z_table=table, r_max=3.0
+        )
+        assert all(isinstance(d, MmapDataset) for d in staged.datasets)
+        assert len(staged) == len(original)
+        for i in range(len(original)):
+            for key in original[i].keys:
+                assert torch.allclose(staged[i][key], original[i][key]), key
+
+        # Changing a shard in place, which leaves the directory unchanged, gives a new
+        # copy
+        with open(tmp_path / "shards" / "train_1.h5", "ab") as f:
+            f.write(b"\0")
+        assert shared_memory_path(
+            str(tmp_path / "shards"), r_max=3.0, shm_dir=str(shm_dir)
+        ) != path
+
+    def test_streaming_dataset(self, tmp_path):
+        table = AtomicNumberTable([1, 8])
+        for i in range(4):
+            with h5py.File(tmp_path / f"train_{i}.h5", "w") as f:
+                configs = []
+                for j in range(5):
+                    config = deepcopy(self.config)
+                    config.energy = 10 * i + j
+                    configs.append(config)
+                if i % 2:
+                    save_configurations_as_columnar_HDF5(configs, f)
+                else:
+                    save_configurations_as_HDF5(configs, 0, f)
+
+        energies = []
+        for rank in range(2):
+            dataset = ShardedStreamingDataset.from_path(
+                str(tmp_path),
+                z_table=table,
+                r_max=3.0,
+                shuffle_buffer_size=3,
+                num_replicas=2,
+                rank=rank,
+            )
+            assert len(dataset) == 10
+            epoch_0 = [float(data.energy) for data in dataset]
+            dataset.set_epoch(1)
+            epoch_1 = [float(data.energy) for data in dataset]
+            assert len(epoch_0) == len(epoch_1) == 10
+            assert epoch_0 != epoch_1
+            energies.extend(epoch_0)
+        # Each rank streams two whole shards
+        assert sorted(energies) == [10 * i + j for i in range(4) for j in range(5)]
+
+        data_loader = torch_geometric.dataloader.DataLoader(
+            dataset=dataset, batch_size=3, drop_last=True
+        )
+        assert sum(batch.num_graphs for batch in data_loader) == 9
+
+    def test_manifest(self, tmp_path, monkeypatch):
+        bulk = config_from_atoms(ase.build.bulk("Cu", "fcc", cubic=True))
+        table = AtomicNumberTable([1, 8, 29])
+        with h5py.File(tmp_path / "train_0.h5", "w") as f:
+            save_configurations_as_HDF5([self.config, self.config_2], 0, f, r_max=3.0)
+        with h5py.File(tmp_path / "train_1.h5", "w") as f:
+            save_configurations_as_columnar_HDF5([bulk] * 3, f, r_max=3.0)
+        manifest = write_manifest(str(tmp_path), r_max=3.0)
+        assert manifest == read_manifest(str(tmp_path))
+        assert manifest["num_configs"] == 5
+        assert manifest["num_atoms"] == 3 + 3 + 3 * 4
+        assert manifest["elements"] == [1, 8, 29]
+        assert manifest["shards"]["train_1.h5"]["format"] == "columnar"
+        assert manifest["shards"]["train_0.h5"]["batch_size"] == 2
+
+        dataset = dataset_from_sharded_hdf5(str(tmp_path), z_table=table, r_max=3.0)
+        assert len(dataset.datasets) == 2 and len(dataset) == 5
+        # Shards are only opened when read
+        assert all(d._file is None for d in dataset.datasets)
+        assert all(d.use_stored_graphs for d in dataset.datasets)
+        for d in dataset.datasets:
+            expected = HDF5Dataset(d.file_path, z_table=table, r_max=3.0)
+            for i in range(len(d)):
+                for key in expected[i].keys:
+                    assert torch.all(d[i][key] == expected[i][key]), key
+
+        # Appending a shard only summarizes the new shard
+        with h5py.File(tmp_path / "train_2.h5", "w") as f:
+            save_configurations_as_columnar_HDF5([bulk], f, r_max=3.0)
+        summarized = []
+        monkeypatch.setattr(
+            manifest_module,
+            "summarize_shard",
+            lambda path: summarized.append(path) or summarize_shard(path),
+        )
+        manifest = write_manifest(str(tmp_path), r_max=3.0)
+        assert summarized == [str(tmp_path / "train_2.h5")]
+        assert manifest["num_configs"] == 6
+
+        # Sizes of the graphs are cached with the manifest
+        dataset = dataset_from_sharded_hdf5(str(tmp_path), z_table=table, r_max=3.0)
+        assert len(dataset.datasets) == 3
+        num_atoms, num_edges = get_dataset_sizes(dataset)
+        assert num_atoms.tolist() == [d.num_nodes for d in dataset]
+        assert num_edges.tolist() == [d.edge_index.shape[1] for d in dataset]
+        monkeypatch.setattr(manifest_module, "read_shard_sizes", None)
+        assert load_shard_sizes(str(tmp_path / "train_1.h5"))[0].tolist() == [4] * 3
+
+    def test_hdf5_cache(self, tmp_path, caplog):
+        datasets = [self.config, self.config_2] * 4
+        table = AtomicNumberTable([1, 8])
+        with h5py.File(tmp_path / "test.h5", "w") as f:
+            save_configurations_as_columnar_HDF5(datasets, f)
+        uncached = HDF5Dataset(str(tmp_path / "test.h5"), z_table=table, r_max=3.0)
+        size = AtomicDataCache.size_of(uncached[0])
+        dataset = HDF5Dataset(
+            str(tmp_path / "test.h5"), z_table=table, r_max=3.0, cache_size=3 * size
+        )
+        for _ in range(2):
+            for i in range(3):
+                data, expected = dataset[i], uncached[i]
+                for key in data.keys:
+                    assert torch.all(data[key] == expected[key]), key
+        assert (dataset.cache.hits, dataset.cache.misses) == (3, 3)
+        # Cached items are shallow copies, which share their tensors
+        data = dataset[0]
+        assert data is not dataset[0]
+        assert data.positions is dataset[0].positions
+        data.positions = data.positions + 1.0
+        assert torch.all(dataset[0].positions == uncached[0].positions)
+
+        # Least recently used items are evicted to stay within the budget
+        dataset.__getitems__([3, 4])
+        assert len(dataset.cache) == 3
+        assert dataset.cache.num_bytes <= dataset.cache.max_bytes
+        assert (dataset.file_path, 0) in dataset.cache._items
+        assert (dataset.file_path, 1) not in dataset.cache._items
+
+        # Counts of the workers are seen by the main process, and reset when logged
+        dataset = HDF5Dataset(
+            str(tmp_path / "test.h5"), z_table=table, r_max=3.0, cache_size=100 * size
+        )
+        loader = torch_geometric.dataloader.DataLoader(
+            dataset, batch_size=2, num_workers=2, persistent_workers=True
+        )
+        for _ in range(2):
+            list(loader)
+        stats = dataset.cache.statistics()
+        assert (stats["hits"], stats["misses"]) == (8, 8)
+        assert stats["bytes"] == 8 * size
+        with caplog.at_level("INFO"):
+            log_cache_statistics(torch.utils.data.ConcatDataset([dataset]), "Training")
+        assert "8 hits, 8 misses (50.0% hit rate)" in caplog.text
+        assert dataset.cache.statistics() == {"hits": 0, "misses": 0, "bytes": 8 * size}
+
+    def test_contiguous_batch_sampler_distributed(self):
+        shard_sizes = [10, 7, 13]
+        samplers = [
+            ContiguousBatchSampler(
+                None,
+                batch_size=3,
+                drop_last=True,
+                num_replicas=4,
+                rank=rank,
+                shard_sizes=shard_sizes,
+            )
+            for rank in range(4)
+        ]
+        batches = [list(sampler) for sampler in samplers]
+        assert len({len(b) for b in batches}) == 1
+        indices = [i for b in batches for batch in b for i in batch]
+        assert len(indices) == len(set(indices))
+        assert all(len(batch) == 3 for b in batches for batch in b)
+
+    def test_dynamic_batch_sampler(self):
+        rng = np.random.default_rng(0)
+        num_atoms = rng.integers(1, 20, size=100)
+        num_edges = num_atoms * rng.integers(1, 30, size=100)
+        samplers = [
+            DynamicBatchSampler(
+                None,
+                max_atoms=40,
+                max_edges=400,
+                drop_last=True,
+                num_replicas=3,
+                rank=rank,
+                num_atoms=num_atoms,
+                num_edges=num_edges,
+            )
+            for rank in range(3)
+        ]
+        batches = [list(sampler) for sampler in samplers]
+        assert len({len(b) for b in batches}) == 1
+        assert all(len(sampler) == len(batches[0]) for sampler in samplers)
+        indices = [i for b in batches for batch in b for i in batch]
+        assert len(indices) == len(set(indices))
+        for batch in (batch for b in batches for batch in b):
+            assert len(batch) == 1 or (
+                num_atoms[batch].sum() <= 40 and num_edges[batch].sum() <= 400
+            )
+        samplers[0].set_epoch(1)
+        assert list(samplers[0]) != batches[0]
+
+        # Every graph is sampled once without drop_last on a single rank
+        datasets = [self.config, self.config_2] * 3
+        dataset = [
+            AtomicData.from_config(config, z_table=self.table, cutoff=3.0)
+            for config in datasets
+        ]
+        sampler = DynamicBatchSampler(dataset, max_atoms=7)
+        assert sorted(i for batch in sampler for i in batch) == list(range(6))
+        data_loader = torch_geometric.dataloader.DataLoader(
+            dataset=dataset, batch_sampler=sampler
+        )
+        assert all(batch.num_nodes <= 7 for batch in data_loader)
+        with pytest.raises(ValueError):
+            DynamicBatchSampler(None, num_atoms=[1, 2])
+
+    def test_bucket_batch_sampler(self):
+        rng = np.random.default_rng(0)
+        num_atoms = rng.integers(1, 50, size=200)
+        num_edges = num_atoms * rng.integers(1, 30, size=200)
+        samplers = [
+            BucketBatchSampler(
+                None,
+                batch_size=8,
+                num_buckets=4,
+                drop_last=True,
+                num_replicas=2,
+                rank=rank,
+                num_atoms=num_atoms,
+                num_edges=num_edges,
+            )
+            for rank in range(2)
+        ]
+        batches = [list(sampler) for sampler in samplers]
+        assert len(batches[0]) == len(batches[1]) == len(samplers[0])
+        indices = [i for b in batches for batch in b for i in batch]
+        assert len(indices) == len(set(indices))
+        collater = PaddingCollater(samplers[0].padded_shapes)
+        shapes = set()
+        for batch in (batch for b in batches for batch in b):
+            assert len(batch) == 8
+            shapes.add(
+                collater.padded_shape(
+                    len(batch), num_atoms[batch].sum(), num_edges[batch].sum()
+                )
+            )
+        assert shapes <= set(samplers[0].padded_shapes)
+        samplers[0].set_epoch(1)
+        assert list(samplers[0]) != batches[0]
+
+        # An outlier does not set the padded shape of its bucket, its batch overflows
+        num_atoms = np.full(100, 10)
+        num_atoms[0] = 1000
+        sampler = BucketBatchSampler(
+            None, batch_size=4, num_buckets=2, shuffle=False, num_atoms=num_atoms
+        )
+        assert sampler.padded_shapes == [(5, 41, None), (5, 41, None)]
+        collater = PaddingCollater(sampler.padded_shapes)
+        batch = next(batch for batch in sampler if 0 in batch)
+        shape = collater.padded_shape(len(batch), int(num_atoms[batch].sum()), 64)
+        assert shape not in sampler.padded_shapes
+        assert shape[1] > num_atoms[batch].sum()
+
 
 class TestNeighborhood:
     def test_basic(self):
@@ -166,6 +664,55 @@ class TestNeighborhood:
         assert shifts.shape == (num_edges, 3)
         assert unit_shifts.shape == (num_edges, 3)
 
+    def test_batched(self):
+        rng = np.random.default_rng(0)
+        positions = [rng.normal(size=(n, 3)) * 2.0 for n in (1, 5, 12, 3)]
+        cell = np.array([[4.0, 0.0, 0.0], [0.5, 4.0, 0.0], [0.0, 0.0, 6.0]])
+        pbcs = [None, (False, False, False), (True, True, False), None]
+        cells = [None, None, cell, np.zeros((3, 3))]
+
+        neighborhoods = get_neighborhoods(positions, cutoff=3.0, pbc=pbcs, cell=cells)
+        assert len(neighborhoods) == len(positions)
+        for pos, pbc, c, (edge_index, shifts, unit_shifts) in zip(
+            positions, pbcs, cells, neighborhoods
+        ):
+            edge_index_ref, shifts_ref, unit_shifts_ref = get_neighborhood(
+                pos, cutoff=3.0, pbc=pbc, cell=None if c is None else c.copy()
+            )
+            edges = {
+                (s, r, *u) for (s, r), u in zip(edge_index.T, unit_shifts.tolist())
+            }
+            edges_ref = {
+                (s, r, *u)
+                for (s, r), u in zip(edge_index_ref.T, unit_shifts_ref.tolist())
+            }
+            assert edges == edges_ref
+            assert shifts.shape == shifts_ref.shape
+
+    def test_verlet_skin(self):
+        rng = np.random.default_rng(0)
+        cell = np.identity(3) * 6.0
+        positions = rng.uniform(0.0, 6.0, size=(20, 3))
+        neighborhood = VerletNeighborhood(cutoff=3.0, skin=0.5)
+        for _ in range(20):
+            positions = positions + rng.normal(scale=0.02, size=positions.shape)
+            edge_index, shifts, unit_shifts = neighborhood.get_neighborhood(
+                positions, pbc=(True, True, True), cell=cell
+            )
+            edge_index_ref, _, unit_shifts_ref = get_neighborhood(
+                positions, cutoff=3.0, pbc=(True, True, True), cell=cell.copy()
+            )
+            edges = {
+                (s, r, *u) for (s, r), u in zip(edge_index.T, unit_shifts.tolist())
+            }
+            edges_ref = {
+                (s, r, *u)
+                for (s, r), u in zip(edge_index_ref.T, unit_shifts_ref.tolist())
+            }
+            assert edges == edges_ref
+            assert shifts.shape == (edge_index.shape[1], 3)
+        assert 1 <= neighborhood.num_builds < 20
+
 
 # Based on mir-group/nequip
 def test_periodic_edge():
@@ -205,3 +752,338 @@ def test_half_periodic():
         vectors[:, 2],
         np.zeros(vectors.shape[0]),
     )
+
+
+def test_xyz_index(tmp_path, monkeypatch):
+    frames = []
+    for i in range(7):
+        atoms = ase.build.bulk("Cu", "fcc", cubic=True).repeat((1, 1, i % 3 + 1))
+        atoms.info["REF_energy"] = float(i)
+        atoms.arrays["REF_forces"] = np.full((len(atoms), 3), float(i))
+        frames.append(atoms)
+    path = str(tmp_path / "frames.xyz")
+    ase.io.write(path, frames)
+
+    offsets = load_xyz_index(path)
+    assert len(offsets) == len(frames) + 1
+    assert os.path.isfile(path + ".idx.npz")
+    for index in (":", "2:6", [5, 1, 2], -1):
+        expected = ase.io.read(path, index=index) if not isinstance(index, list) else [
+            ase.io.read(path, index=i) for i in index
+        ]
+        for num_workers in (1, 2):
+            atoms_list = read_xyz(path, index=index, num_workers=num_workers)
+            if isinstance(index, int):
+                atoms_list, expected_list = [atoms_list], [expected]
+            else:
+                expected_list = expected
+            assert len(atoms_list) == len(expected_list)
+            for atoms, ref in zip(atoms_list, expected_list):
+                assert atoms.info == ref.info
+                assert np.allclose(atoms.positions, ref.positions)
+                assert np.allclose(atoms.arrays["REF_forces"], ref.arrays["REF_forces"])
+
+    # Large files are parsed in ranges of bounded size
+    ranges = []
+    monkeypatch.setattr(xyz_index_module, "MAX_RANGE_BYTES", 2 * int(offsets[1]))
+    monkeypatch.setattr(
+        xyz_index_module,
+        "read_xyz_range",
+        lambda *r: ranges.append(r) or read_xyz_range(*r),
+    )
+    atoms_list = read_xyz(path)
+    assert len(atoms_list) == len(frames)
+    assert len(ranges) > 2
+    assert max(stop - start for _, start, stop in ranges) <= 4 * offsets[1]
+    for atoms, ref in zip(atoms_list, frames):
+        assert np.allclose(atoms.positions, ref.positions)
+    monkeypatch.undo()
+
+    # The saved index is rebuilt when the file changes
+    ase.io.write(path, frames[:3])
+    assert len(load_xyz_index(path)) == 4
+
+    # A truncated index, e.g. being written by another process, is rebuilt
+    with open(path + ".idx.npz", "r+b") as f:
+        f.truncate(10)
+    assert len(load_xyz_index(path)) == 4
+    assert len(load_xyz_index(path)) == 4
+    assert not any(name.endswith(".part.npz") for name in os.listdir(tmp_path))
+
+
+def test_configs_from_hdf5_ani(tmp_path):
+    rng = np.random.default_rng(0)
+    with h5py.File(tmp_path / "ani.h5", "w") as f:
+        for num_atoms in (3, 5):
+            group = f.create_group(f"mol_{num_atoms}")
+            group["coordinates"] = rng.normal(size=(4, num_atoms, 3))
+            group["species"] = np.tile(rng.integers(1, 9, size=num_atoms), (4, 1))
+            group["energies"] = rng.normal(size=4)
+            group["forces"] = rng.normal(size=(4, num_atoms, 3))
+    configs = configs_from_hdf5_ani(str(tmp_path / "ani.h5"))
+    expected = config_from_atoms_list(atoms_from_hdf5_ani(str(tmp_path / "ani.h5")))
+    assert len(configs) == len(expected) == 8
+    for config, ref in zip(configs, expected):
+        for field in ref.__dataclass_fields__:
+            value, ref_value = getattr(config, field), getattr(ref, field)
+            if isinstance(ref_value, np.ndarray):
+                assert np.allclose(value, ref_value), field
+            else:
+                assert value == ref_value or np.isclose(value, ref_value), field
+
+
+def test_iread_atoms_hdf5_aqm(tmp_path):
+    rng = np.random.default_rng(0)
+    with h5py.File(tmp_path / "aqm.h5", "w") as f:
+        for num_atoms in (3, 5):
+            molecule = f.create_group(f"mol_{num_atoms}")
+            numbers = rng.integers(1, 9, size=num_atoms)
+            for i in range(2):
+                conformer = molecule.create_group(f"conf_{i}")
+                conformer["xyz"] = rng.normal(size=(num_atoms, 3))
+                conformer["z"] = numbers
+                conformer["e"] = rng.normal()
+                conformer["f"] = rng.normal(size=(num_atoms, 3))
+    keys = {"positions_key": "xyz", "numbers_key": "z", "energy_key": "e"}
+    configs = configs_from_hdf5(str(tmp_path / "aqm.h5"), forces_key="f", **keys)
+    atoms_list = list(
+        iread_atoms(
+            str(tmp_path / "aqm.h5"),
+            h5_forces_key="f",
+            **{"h5_" + key: value for key, value in keys.items()},
+        )
+    )
+    assert len(atoms_list) == len(configs) == 4
+    for atoms, config in zip(atoms_list, configs):
+        assert np.array_equal(atoms.numbers, config.atomic_numbers)
+        assert np.allclose(atoms.positions, config.positions)
+        assert np.isclose(atoms.info["energy"], config.energy)
+        assert np.allclose(atoms.arrays["forces"], config.forces)
+
+
+def test_atoms_from_extxyz_directory(tmp_path):
+    frames = [ase.build.bulk("Cu", "fcc", a=3.6 + 0.01 * i) for i in range(9)]
+    for k in range(3):
+        ase.io.write(tmp_path / f"part_{k}.extxyz", frames[3 * k : 3 * k + 3])
+    files = list_extxyz_files(str(tmp_path))
+    read = dict(iter_atoms_from_extxyzs(files, num_workers=2))
+    assert sorted(read) == files
+    atoms_list = atoms_from_oc20(str(tmp_path), num_workers=2)
+    assert len(atoms_list) == len(frames)
+    for atoms, ref in zip(atoms_list, frames):
+        assert np.allclose(atoms.cell, ref.cell)
+
+
+def test_compute_E0s(tmp_path):
+    rng = np.random.default_rng(0)
+    true_E0s = {1: -13.6, 6: -1030.0, 8: -2040.0}
+    configs = []
+    for i in range(40):
+        numbers = rng.choice([1, 6, 8], size=rng.integers(2, 8))
+        energy = sum(true_E0s[z] for z in numbers) + 0.01 * rng.normal()
+        configs.append(
+            Configuration(
+                atomic_numbers=numbers,
+                positions=rng.normal(size=(len(numbers), 3)),
+                energy=energy,
+                head="a" if i % 2 else "b",
+            )
+        )
+    z_table = AtomicNumberTable([1, 6, 8])
+    E0s = compute_average_E0s(configs, z_table, heads=["a", "b"])
+    for head in ("a", "b"):
+        head_configs = [config for config in configs if config.head == head]
+        A = np.array(
+            [[np.count_nonzero(c.atomic_numbers == z) for z in z_table.zs] for c in head_configs]
+        )
+        expected = np.linalg.lstsq(A, [c.energy for c in head_configs], rcond=None)[0]
+        assert np.allclose([E0s[head][z] for z in z_table.zs], expected)
+
+    # Partial fits over shards of either layout give the same E0s
+    files = []
+    for i, save in enumerate((save_configurations_as_HDF5, save_configurations_as_columnar_HDF5)):
+        files.append(str(tmp_path / f"shard_{i}.h5"))
+        with h5py.File(files[-1], "w") as f:
+            chunk = configs[20 * i : 20 * (i + 1)]
+            if save is save_configurations_as_HDF5:
+                save(chunk, 0, f)
+            else:
+                save(chunk, f)
+    shard_E0s = compute_E0s_from_hdf5(files, z_table.zs)
+    for head in ("a", "b"):
+        assert np.allclose(
+            [shard_E0s[head][z] for z in z_table.zs], [E0s[head][z] for z in z_table.zs]
+        )
+
+
+def test_E0_accumulator_ill_conditioned():
+    # Compositions of nearly fixed stoichiometry, for which AᵀA is nearly singular
+    rng = np.random.default_rng(0)
+    num_h = rng.integers(1, 200, size=1000)
+    A = np.stack([num_h, 2 * num_h + (rng.random(1000) < 0.01)], axis=1)
+    B = A @ np.array([-13.6, -2040.0]) + 1e-3 * rng.normal(size=1000)
+    accumulator = E0Accumulator([1, 8])
+    for block in np.array_split(np.arange(1000), 10):
+        partial = E0Accumulator([1, 8])
+        partial.add(
+            np.concatenate([np.repeat([1, 8], counts) for counts in A[block]]),
+            A[block].sum(axis=1),
+            B[block],
+            ["Default"] * len(block),
+        )
+        accumulator.merge(partial)
+    E0s = accumulator.solve()["Default"]
+    expected = np.linalg.lstsq(A.astype(np.float64), B, rcond=None)[0]
+    assert np.allclose([E0s[1], E0s[8]], expected, rtol=1e-8)
+
+
+def test_dataset_statistics(tmp_path):
+    rng = np.random.default_rng(0)
+    configs = []
+    for i in range(12):
+        atoms = ase.build.bulk("Cu", "fcc", a=3.6, cubic=True) if i % 3 == 0 else ase.build.molecule("H2O")
+        atoms.rattle(0.05, seed=i)
+        config = config_from_atoms(atoms)
+        config.energy = float(rng.normal())
+        config.forces = rng.normal(size=(len(atoms), 3))
+        configs.append(config)
+    table = AtomicNumberTable([1, 8, 29])
+    atomic_energies = np.array([-1.0, -2.0, -3.0])
+    loader = torch_geometric.dataloader.DataLoader(
+        [AtomicData.from_config(config, z_table=table, cutoff=3.0) for config in configs],
+        batch_size=5,
+        shuffle=False,
+    )
+    statistics = compute_loader_statistics(loader, atomic_energies).total()
+    avg_num_neighbors, mean, rms = compute_statistics(loader, atomic_energies)
+    assert np.isclose(statistics.avg_num_neighbors, avg_num_neighbors)
+    assert np.isclose(statistics.mean, mean)
+    assert np.isclose(statistics.rms_forces, rms)
+    atom_energies = [
+        (c.energy - sum(atomic_energies[table.z_to_index(z)] for z in c.atomic_numbers))
+        / len(c.atomic_numbers)
+        for c in configs
+    ]
+    assert np.isclose(statistics.std, np.std(atom_energies, ddof=1))
+
+    # Shards of either layout, with or without stored graphs, give the same statistics
+    files = [str(tmp_path / "grouped.h5"), str(tmp_path / "columnar.h5")]
+    with h5py.File(files[0], "w") as f:
+        save_configurations_as_HDF5(configs[:7], 0, f)
+    with h5py.File(files[1], "w") as f:
+        save_configurations_as_columnar_HDF5(configs[7:], f, r_max=3.0)
+    shard_statistics = compute_statistics_from_hdf5(
+        files, {None: dict(zip(table.zs, atomic_energies))}, r_max=3.0
+    ).total()
+    assert shard_statistics.num_edges == statistics.num_edges
+    assert shard_statistics.num_receivers == statistics.num_receivers
+    assert shard_statistics.energy.count == statistics.energy.count
+    assert np.isclose(shard_statistics.mean, statistics.mean)
+    assert np.isclose(shard_statistics.std, statistics.std)
+    assert np.isclose(shard_statistics.rms_forces, statistics.rms_forces)
+
+
+def test_statistics_cache(tmp_path):
+    shards = tmp_path / "train"
+    shards.mkdir()
+    (shards / "train_0.h5").write_bytes(b"0" * 10)
+    fingerprint = dataset_fingerprint([str(shards)], r_max=5.0, zs=[1, 8])
+    assert fingerprint == dataset_fingerprint([str(shards)], r_max=5.0, zs=[1, 8])
+    assert fingerprint != dataset_fingerprint([str(shards)], r_max=4.0, zs=[1, 8])
+
+    cache = StatisticsCache(str(tmp_path / "cache.json"))
+    assert cache.get(fingerprint) is None
+    statistics = HeadStatistics(num_edges=12, num_receivers=5)
+    statistics.energy.add([1.0, 2.0, 4.0])
+    cache.put(fingerprint, statistics)
+    assert cache.get(fingerprint) == statistics
+
+    # Adding a shard changes the fingerprint
+    (shards / "train_1.h5").write_bytes(b"1" * 10)
+    assert dataset_fingerprint([str(shards)], r_max=5.0, zs=[1, 8]) != fingerprint
+
+
+def test_deduplicate(tmp_path):
+    atoms = ase.build.molecule("CH3OH")
+    permuted = atoms[[3, 0, 5, 1, 4, 2]]
+    shifted = atoms.copy()
+    shifted.positions += 1e-9
+    other_head = atoms.copy()
+    other_head.info["head"] = "other"
+    moved = atoms.copy()
+    moved.positions[0] += 0.01
+    configs = [config_from_atoms(a) for a in (atoms, permuted, shifted, other_head, moved)]
+    assert len({configuration_hash(config) for config in configs}) == 3
+    assert atoms_hash(permuted) == configuration_hash(configs[0])
+
+    deduplicator = Deduplicator()
+    kept = deduplicator.filter_configurations(configs)
+    assert kept == [configs[0], configs[3], configs[4]]
+    assert deduplicator.num_dropped[("Default", "Default")] == 2
+
+    # Hashes are stored in shards of both layouts
+    with h5py.File(tmp_path / "grouped.h5", "w") as f:
+        save_configurations_as_HDF5(kept[:2], 0, f)
+    with h5py.File(tmp_path / "columnar.h5", "w") as f:
+        save_configurations_as_columnar_HDF5(kept[2:], f)
+    deduplicator = Deduplicator.from_shards(
+        [str(tmp_path / "grouped.h5"), str(tmp_path / "columnar.h5")]
+    )
+    assert deduplicator.filter_configurations(configs) == []
+
+
+def test_composition_index(tmp_path):
+    molecules = ["H2O", "CH4", "CH3OH", "H2", "NH3", "CO2", "C6H6", "HCN"]
+    atoms_list = [ase.build.molecule(name) for name in molecules] * 2
+    atoms_list.append(ase.Atoms("Og", positions=[[0.0, 0.0, 0.0]]))
+    configs = [config_from_atoms(atoms) for atoms in atoms_list]
+    compositions = composition_masks(
+        np.concatenate([config.atomic_numbers for config in configs]),
+        [len(config.atomic_numbers) for config in configs],
+    )
+    for filtering_type in ("none", "combinations", "exclusive", "inclusive"):
+        for subset in (["H", "O"], ["C", "H", "O"], ["Og"]):
+            expected = [filter_atoms(a, subset, filtering_type) for a in atoms_list]
+            selected = filter_atoms_list(atoms_list, subset, filtering_type)
+            assert selected.tolist() == expected
+    with pytest.raises(ValueError):
+        match_compositions(compositions, [1], "unknown")
+
+    # Shards of both layouts are queried in the order of dataset_from_sharded_hdf5
+    with h5py.File(tmp_path / "a.h5", "w") as f:
+        save_configurations_as_HDF5(configs[:12], 0, f)
+    with h5py.File(tmp_path / "b.h5", "w") as f:
+        save_configurations_as_columnar_HDF5(configs[12:], f)
+    files = [str(tmp_path / "a.h5"), str(tmp_path / "b.h5")]
+    indices = query_shards(files, [1, 6, 8], "combinations")
+    expected = [
+        i
+        for i, atoms in enumerate(atoms_list)
+        if filter_atoms(atoms, ["H", "C", "O"], "combinations")
+    ]
+    assert indices.tolist() == expected
+    assert query_shards(files, [1], "inclusive", config_types=["other"]).size == 0
+
+    # fine_tuning_select reads the same pretraining set from shards as from xyz
+    (tmp_path / "shards").mkdir()
+    for file in files:
+        os.rename(file, tmp_path / "shards" / os.path.basename(file))
+    ase.io.write(tmp_path / "pt.xyz", atoms_list)
+    for num_samples in (None, 12):
+        read = []
+        for configs_pt in (str(tmp_path / "shards"), str(tmp_path / "pt.xyz")):
+            args = argparse.Namespace(
+                configs_pt=configs_pt,
+                filtering_type="combinations",
+                num_samples=num_samples,
+                num_workers=1,
+            )
+            np.random.seed(0)
+            read.append(read_pretraining_set(args, ["H", "C", "O"]))
+        (shard_atoms, shard_indices), (xyz_atoms, xyz_indices) = read
+        assert shard_indices.tolist() == xyz_indices.tolist()
+        assert len(shard_indices) == (len(expected) if num_samples is None else 12)
+        assert shard_indices[: len(expected)].tolist() == expected
+        for atoms, ref in zip(shard_atoms, xyz_atoms):
+            assert np.array_equal(atoms.numbers, ref.numbers)
+            assert np.allclose(atoms.positions, ref.positions)
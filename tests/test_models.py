@@ -249,3 +249,69 @@ def test_mace_multi_reference():
     output2 = model_compiled(batch.to_dict(), training=True)
     assert torch.allclose(output1["energy"][0], output2["energy"][0])
     assert output2["energy"].shape[0] == 2
+
+
+def test_padded_batch():
+    model_config = dict(
+        r_max=3.0,
+        num_bessel=8,
+        num_polynomial_cutoff=6,
+        max_ell=2,
+        interaction_cls=modules.interaction_classes[
+            "RealAgnosticResidualInteractionBlock"
+        ],
+        interaction_cls_first=modules.interaction_classes[
+            "RealAgnosticResidualInteractionBlock"
+        ],
+        num_interactions=2,
+        num_elements=2,
+        hidden_irreps=o3.Irreps("16x0e + 16x1o"),
+        MLP_irreps=o3.Irreps("16x0e"),
+        gate=torch.nn.functional.silu,
+        atomic_energies=atomic_energies,
+        avg_num_neighbors=4,
+        atomic_numbers=table.zs,
+        correlation=3,
+        radial_type="bessel",
+        atomic_inter_scale=1.0,
+        atomic_inter_shift=0.0,
+    )
+    model = modules.ScaleShiftMACE(**model_config)
+    periodic = data.Configuration(
+        atomic_numbers=np.array([8, 1]),
+        positions=np.array([[0.0, 0.0, 0.0], [1.0, 0.5, 0.0]]),
+        energy=-1.0,
+        forces=np.ones((2, 3)),
+        stress=np.ones(6),
+        cell=np.eye(3) * 3.5,
+        pbc=(True, True, True),
+        charges=np.zeros(2),
+        dipole=np.zeros(3),
+    )
+    data_list = [
+        data.AtomicData.from_config(c, z_table=table, cutoff=3.0)
+        for c in (config, periodic, config_rotated)
+    ]
+    batch = torch_geometric.batch.Batch.from_data_list(data_list)
+    collater = tools.PaddingCollater([(4, 20, None)])
+    padded = collater(data_list)
+    assert padded.num_graphs == 4 and padded.num_nodes == 20
+    # The number of edges is rounded up to a power of two
+    num_edges = padded.edge_index.shape[1]
+    assert num_edges >= batch.edge_index.shape[1] and num_edges & (num_edges - 1) == 0
+
+    loss_fn = modules.WeightedEnergyForcesLoss(energy_weight=1.0, forces_weight=10.0)
+    outputs, losses = [], []
+    for b in (batch, padded):
+        output = model(b.to_dict(), training=True, compute_stress=True)
+        b, output = tools.strip_padding(b, output)
+        model.zero_grad()
+        loss = loss_fn(ref=b, pred=output)
+        loss.backward()
+        outputs.append(output)
+        losses.append((loss, [p.grad.clone() for p in model.parameters()]))
+    for key in ("energy", "forces", "stress"):
+        assert torch.allclose(outputs[0][key], outputs[1][key])
+    assert torch.allclose(losses[0][0], losses[1][0])
+    for grad, padded_grad in zip(losses[0][1], losses[1][1]):
+        assert torch.allclose(grad, padded_grad)
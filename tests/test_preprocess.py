@@ -0,0 +1,177 @@
+import json
+import os
+import sys
+
+import ase.build
+import ase.io
+import numpy as np
+import pytest
+
+from mace.cli import preprocess_data
+
+E0S = {1: -13.6, 7: -1480.0, 8: -2040.0}
+
+
+def make_frames(num_frames, head=None, seed=0, isolated_atoms=True, molecule="H2O"):
+    rng = np.random.default_rng(seed)
+    info = {} if head is None else {"head": head}
+    frames = []
+    if isolated_atoms:
+        for z in (1, 8):
+            atoms = ase.Atoms(numbers=[z], positions=[[0.0, 0.0, 0.0]])
+            atoms.info.update(REF_energy=E0S[z], config_type="IsolatedAtom", **info)
+            frames.append(atoms)
+    for _ in range(num_frames):
+        atoms = ase.build.molecule(molecule)
+        atoms.positions += 0.05 * rng.normal(size=atoms.positions.shape)
+        atoms.info.update(REF_energy=-2070.0 + 0.1 * rng.normal(), **info)
+        atoms.arrays["REF_forces"] = rng.normal(size=(len(atoms), 3))
+        frames.append(atoms)
+    return frames
+
+
+def list_shard_names(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(".h5"))
+
+
+def assert_same_statistics(statistics, expected):
+    assert statistics["atomic_energies"] == expected["atomic_energies"]
+    assert statistics["atomic_numbers"] == expected["atomic_numbers"]
+    assert statistics["r_max"] == expected["r_max"]
+    for key in ("avg_num_neighbors", "mean", "std"):
+        assert np.isclose(statistics[key], expected[key]), key
+    moments, expected_moments = statistics["moments"], expected["moments"]
+    for key in ("num_forces", "num_edges", "num_receivers"):
+        assert moments[key] == expected_moments[key], key
+    assert moments["energy"]["count"] == expected_moments["energy"]["count"]
+    assert np.isclose(moments["forces_sq_sum"], expected_moments["forces_sq_sum"])
+
+
+def run_preprocess(monkeypatch, train_file, h5_prefix, *extra_args):
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "preprocess_data",
+            "--train_file",
+            str(train_file),
+            "--h5_prefix",
+            str(h5_prefix),
+            "--r_max",
+            "3.0",
+            "--energy_key",
+            "REF_energy",
+            "--forces_key",
+            "REF_forces",
+            "--num_process",
+            "1",
+            "--valid_fraction",
+            "0.1",
+            "--compute_statistics",
+            *extra_args,
+        ],
+    )
+    preprocess_data.main()
+    with open(str(h5_prefix) + "statistics.json") as f:  # pylint: disable=W1514
+        return json.load(f)
+
+
+def test_streaming_statistics_of_named_head(tmp_path, monkeypatch):
+    ase.io.write(tmp_path / "pt.xyz", make_frames(10, head="pt"))
+    statistics = run_preprocess(
+        monkeypatch, tmp_path / "pt.xyz", f"{tmp_path}/out/", "--streaming"
+    )
+    assert statistics["atomic_energies"] == str({1: E0S[1], 8: E0S[8]})
+    assert statistics["avg_num_neighbors"] > 0.0
+
+    # The statistics of several heads do not fit in one file
+    ase.io.write(
+        tmp_path / "mixed.xyz",
+        make_frames(4, head="pt") + make_frames(4, head="ft", seed=1),
+    )
+    with pytest.raises(ValueError, match="several heads"):
+        run_preprocess(
+            monkeypatch, tmp_path / "mixed.xyz", f"{tmp_path}/mixed/", "--streaming"
+        )
+
+
+def test_append_matches_single_pass(tmp_path, monkeypatch, caplog):
+    frames_a = make_frames(10, seed=0)
+    frames_b = make_frames(8, seed=1, isolated_atoms=False)
+    ase.io.write(tmp_path / "a.xyz", frames_a)
+    ase.io.write(tmp_path / "b.xyz", frames_b)
+    ase.io.write(tmp_path / "ab.xyz", frames_a + frames_b)
+    ase.io.write(tmp_path / "valid.xyz", make_frames(2, seed=2, isolated_atoms=False))
+    # Small shards, so that each run writes several of them
+    options = ["--valid_file", str(tmp_path / "valid.xyz"), "--max_memory", "0.002"]
+
+    expected = run_preprocess(
+        monkeypatch, tmp_path / "ab.xyz", f"{tmp_path}/ab/", "--streaming", *options
+    )
+    prefix = f"{tmp_path}/appended/"
+    run_preprocess(monkeypatch, tmp_path / "a.xyz", prefix, "--streaming", *options)
+    names_a = list_shard_names(prefix + "train")
+    assert len(names_a) > 1
+    statistics = run_preprocess(
+        monkeypatch, tmp_path / "b.xyz", prefix, "--append", *options
+    )
+
+    # New shards are numbered after the existing ones
+    names = list_shard_names(prefix + "train")
+    assert set(names_a) < set(names)
+    assert sorted(names, key=lambda name: int(name[6:-3])) == [
+        f"train_{i}.h5" for i in range(len(names))
+    ]
+    assert len(names) > len(names_a)
+    assert_same_statistics(statistics, expected)
+
+    # Statistics saved for another cutoff are computed again over all the shards
+    expected = run_preprocess(
+        monkeypatch,
+        tmp_path / "ab.xyz",
+        f"{tmp_path}/ab_4/",
+        "--streaming",
+        "--r_max",
+        "4.0",
+        *options,
+    )
+    prefix = f"{tmp_path}/appended_4/"
+    run_preprocess(monkeypatch, tmp_path / "a.xyz", prefix, "--streaming", *options)
+    with caplog.at_level("WARNING"):
+        statistics = run_preprocess(
+            monkeypatch,
+            tmp_path / "b.xyz",
+            prefix,
+            "--append",
+            "--r_max",
+            "4.0",
+            "--E0s",
+            str({1: E0S[1], 8: E0S[8]}),
+            *options,
+        )
+    assert "Saved statistics cannot be updated" in caplog.text
+    assert_same_statistics(statistics, expected)
+
+    # New elements have no saved E0s
+    ase.io.write(
+        tmp_path / "c.xyz",
+        make_frames(3, seed=3, isolated_atoms=False, molecule="NH3"),
+    )
+    with pytest.raises(ValueError, match="no saved atomic energies"):
+        run_preprocess(
+            monkeypatch,
+            tmp_path / "c.xyz",
+            prefix,
+            "--append",
+            "--r_max",
+            "4.0",
+            *options,
+        )
+
+
+def test_next_shard_index(tmp_path):
+    assert preprocess_data.next_shard_index(str(tmp_path), "train") == 0
+    for name in ("train_0.h5", "train_3.h5", "val_7.h5", "train_x.h5"):
+        (tmp_path / name).touch()
+    assert preprocess_data.next_shard_index(str(tmp_path), "train") == 4
+    assert preprocess_data.next_shard_index(str(tmp_path), "val") == 8
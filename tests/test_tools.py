@@ -1,6 +1,7 @@
 import tempfile
 
 import numpy as np
+import pytest
 import torch
 import torch.nn.functional
 from torch import nn, optim
@@ -11,6 +12,9 @@ from mace.tools import (
     CheckpointState,
     atomic_numbers_to_indices,
 )
+from mace.tools.prefetch import DevicePrefetcher
+from mace.tools.torch_geometric.batch import Batch
+from mace.tools.torch_geometric.data import Data
 
 
 def test_atomic_number_table():
@@ -46,3 +50,31 @@ def test_save_load():
 
         handler.load_latest(state=CheckpointState(model, optimizer, scheduler))
         assert np.isclose(optimizer.param_groups[0]["lr"], initial_lr)
+
+
+def test_device_prefetcher():
+    batches = [
+        Batch.from_data_list([Data(x=torch.full((i + 1, 2), float(i)))])
+        for i in range(5)
+    ]
+    for depth, packed in ((0, False), (2, False), (2, True)):
+        prefetcher = DevicePrefetcher(
+            batches, torch.device("cpu"), depth=depth, packed=packed
+        )
+        assert len(prefetcher) == 5
+        for _ in range(2):
+            prefetched = list(prefetcher)
+            assert [b.x[0, 0].item() for b in prefetched] == list(range(5))
+            assert prefetcher.wait_time >= prefetcher.last_wait_time >= 0.0
+
+    # Stopping early and errors in the loader do not leave the thread running
+    prefetcher = DevicePrefetcher(batches * 10, torch.device("cpu"), depth=1)
+    for _ in zip(range(2), prefetcher):
+        pass
+
+    def failing_loader():
+        yield batches[0]
+        raise RuntimeError("failed to load")
+
+    with pytest.raises(RuntimeError, match="failed to load"):
+        list(DevicePrefetcher(failing_loader(), torch.device("cpu"), depth=2))